@@ -0,0 +1,133 @@
+import random
+import re
+
+import models
+
+# requests using any of these are never merged, they either work on per request inputs
+# or only handle the first image of a batch
+UNBATCHABLE = {"image", "mask", "area", "cn", "cn_image", "cn_opts", "detailers", "keep_artifacts",
+               "subseed", "merge_lora_recipe", "merge_checkpoint_recipe", "tile_size"}
+
+# these are combined across the merged requests, everything else must match exactly
+PER_REQUEST = {"prompt", "seed", "batch_size"}
+
+CHUNK_SIZE = 75
+
+TOKENIZER = None
+
+def get_tokenizer():
+    global TOKENIZER
+    if TOKENIZER == None:
+        TOKENIZER = models.Tokenizer("SDv1")
+    return TOKENIZER
+
+def estimate_chunks(text):
+    # prompts with a different number of chunks get padded when batched, which changes their output.
+    # this is only an estimate, embeddings and weighting syntax can shift the real count
+    tokens = len(get_tokenizer()(text)["input_ids"]) - 2
+    return max(tokens - 1, 0) // CHUNK_SIZE + text.count("BREAK")
+
+def get_batch_size(data):
+    return max(data.get("batch_size") or 1, len(data.get("prompt") or []))
+
+def get_seeds(seed, batch_size):
+    # same expansion as GenerationParameters.get_seeds, done ahead of time so each request keeps its seeds
+    seeds = list(seed) if type(seed) == list else [seed]
+    seeds = [int(s) for s in seeds]
+    for i in range(len(seeds)):
+        if seeds[i] == -1:
+            seeds[i] = random.randrange(2147483646)
+    if len(seeds) < batch_size:
+        last_seed = seeds[-1]
+        seeds += [last_seed + i + 1 for i in range(batch_size-len(seeds))]
+    return seeds
+
+def get_batch_key(request):
+    # malformed requests are never merged, run alone they get their own error without failing the others
+    try:
+        return get_valid_batch_key(request)
+    except Exception:
+        return None
+
+def get_valid_batch_key(request):
+    if request["type"] != "txt2img":
+        return None
+    data = request["data"]
+
+    if any([data.get(k) for k in UNBATCHABLE]):
+        return None
+
+    prompt = data.get("prompt")
+    seed = data.get("seed", -1)
+    if type(prompt) != list or len(prompt) != get_batch_size(data):
+        return None
+    if type(seed) == list and len(seed) > len(prompt):
+        return None
+    for s in (seed if type(seed) == list else [seed]):
+        int(s)
+
+    texts = []
+    for positives, negatives in prompt:
+        texts += positives + negatives
+
+    networks = tuple(sorted(set(sum([re.findall(r"<[^>]*>", t) for t in texts], []))))
+    chunks = max([estimate_chunks(t) for t in texts] or [0])
+    parameters = repr(sorted([(k, v) for k, v in data.items() if not k in PER_REQUEST]))
+
+    return (parameters, networks, chunks)
+
+def merge_requests(requests):
+    prompts = []
+    seeds = []
+    groups = []
+
+    for _, id, request in requests:
+        data = request["data"]
+        batch_size = get_batch_size(data)
+        prompts += data["prompt"]
+        seeds += get_seeds(data.get("seed", -1), batch_size)
+        groups += [(id, batch_size)]
+
+    data = requests[0][2]["data"].copy()
+    data["prompt"] = prompts
+    data["seed"] = seeds
+    data["batch_size"] = len(seeds)
+
+    return data, groups
+
+class Batcher():
+    def __init__(self, requests, max_size=1, window=0):
+        self.requests = requests
+        self.max_size = max_size
+        self.window = window
+
+    def collect(self, item):
+        # pull queued requests that can share a denoising run with item, waiting up to the window for more
+        _, _, request = item
+        if self.max_size <= 1:
+            return [item]
+
+        key = get_batch_key(request)
+        if key == None:
+            return [item]
+
+        capacity = self.max_size - get_batch_size(request["data"])
+        keys = {}
+
+        def accept(other):
+            nonlocal capacity
+            _, id, other_request = other
+            if not id in keys:
+                keys[id] = get_batch_key(other_request)
+            if keys[id] != key:
+                return False
+            size = get_batch_size(other_request["data"])
+            if size > capacity:
+                return False
+            capacity -= size
+            return True
+
+        def full():
+            return capacity <= 0
+
+        return [item] + self.requests.take(accept, full, self.window / 1000)
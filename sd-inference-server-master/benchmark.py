@@ -0,0 +1,675 @@
+import warnings
+warnings.filterwarnings("ignore", category=UserWarning)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+import argparse
+import json
+import os
+import queue
+import random
+import resource
+import secrets
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import PIL.Image
+import torch
+import accelerate
+import safetensors.torch
+import bson
+import websockets.sync.client
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import server
+import storage
+import wrapper
+import encoder
+import prompts
+import models
+import guidance
+import convert
+
+def report(label, samples, unit="ms"):
+    samples = sorted(samples)
+    p50 = samples[len(samples)//2]
+    p99 = samples[min(len(samples)-1, int(len(samples)*0.99))]
+    print(f"{label:>24}: mean {statistics.mean(samples):8.3f}{unit}, p50 {p50:8.3f}{unit}, p99 {p99:8.3f}{unit}, max {samples[-1]:8.3f}{unit}")
+
+class NullStorage():
+    path = "."
+    prefetch_stats = {"hits": 0, "misses": 0}
+    def clear_vram(self):
+        pass
+
+    def prefetch(self, models, keep={}):
+        pass
+
+    def do_gc(self):
+        pass
+
+class NullWrapper():
+    # stands in for GenerationParameters, enough for requests that never reach the models
+    def __init__(self):
+        self.storage = NullStorage()
+        self.callback = None
+
+    def reset(self):
+        pass
+
+    def set_request(self, request_id):
+        pass
+
+    def get_device_name(self):
+        return "null"
+
+class FakeModel():
+    def __init__(self, device):
+        self.device = device
+
+class FakeStorage(NullStorage):
+    def __init__(self, device):
+        self.device = device
+        self.loaded = {"UNET": {}, "CLIP": {}, "VAE": {}}
+        self.loads = 0
+
+    def get_residency(self, comp, name):
+        model = self.loaded[comp].get(name, None)
+        return str(model.device) if model != None else None
+
+class FakeWorker(NullWrapper):
+    # pretends to be a GenerationParameters on its own device, holding one model at a time
+    def __init__(self, device, load_time, generate_time):
+        super().__init__()
+        self.storage = FakeStorage(device)
+        self.device = device
+        self.load_time = load_time
+        self.generate_time = generate_time
+        self.temporary = {}
+        self.model = None
+
+    def get_device_name(self):
+        return str(self.device)
+
+    def set(self, **kwargs):
+        self.model = kwargs["model"]
+
+    def txt2img(self):
+        loaded = self.storage.loaded
+        if not self.model in loaded["UNET"]:
+            time.sleep(self.load_time)
+            self.storage.loads += 1
+            for comp in loaded:
+                loaded[comp].clear()
+                loaded[comp][self.model] = FakeModel(self.device)
+        time.sleep(self.generate_time)
+        self.callback({"type": "result", "data": {}})
+
+class LeastLoadedRouter(server.Router):
+    def get_affinity(self, worker, request):
+        return 0
+
+def polling_worker(requests, callback, stopping):
+    # the previous Inference.run loop, kept here to compare against
+    while not stopping.is_set():
+        try:
+            _, id, _ = requests.get(False)
+            callback(id, {"type": "pong"})
+            requests.task_done()
+        except queue.Empty:
+            time.sleep(0.01)
+
+def bench_queue(args):
+    def measure(label, requests, start):
+        started = {}
+        done = threading.Event()
+        def callback(id, response):
+            started[id] = time.perf_counter()
+            if len(started) == args.count:
+                done.set()
+            return True
+
+        stop = start(requests, callback)
+
+        acked = {}
+        for i in range(args.count):
+            if args.interval:
+                time.sleep(args.interval / 1000)
+            acked[i] = time.perf_counter()
+            requests.put((0, i, {"type": "ping"}))
+        done.wait()
+        stop()
+
+        report(label, [(started[i] - acked[i]) * 1000 for i in range(args.count)])
+
+    def start_polling(requests, callback):
+        stopping = threading.Event()
+        thread = threading.Thread(target=polling_worker, args=(requests, callback, stopping), daemon=True)
+        thread.start()
+        return stopping.set
+
+    def start_blocking(requests, callback):
+        inference = server.Inference(NullWrapper(), False, False, callback)
+        inference.requests = requests
+        inference.start()
+        def stop():
+            inference.stop()
+            inference.join()
+        return stop
+
+    print(f"ack-to-start latency, {args.count} ping requests, {args.interval}ms apart")
+    measure("polling (get + sleep)", queue.Queue(), start_polling)
+    measure("blocking (RequestQueue)", server.RequestQueue(), start_blocking)
+
+def bench_pool(args):
+    def measure(label, router_class):
+        random.seed(0)
+        done = threading.Semaphore(0)
+        def callback(id, response):
+            done.release()
+            return True
+
+        wrappers = [FakeWorker(torch.device("cpu"), args.load / 1000, args.generate / 1000) for _ in range(args.workers)]
+        workers = [server.Inference(w, False, False, callback) for w in wrappers]
+        for worker, w in zip(workers, wrappers):
+            worker.name = w.get_device_name()
+            worker.start()
+        router = router_class(workers)
+
+        start = time.perf_counter()
+        for i in range(args.count):
+            request = {"type": "txt2img", "data": {"model": f"SD/model_{random.randrange(args.models)}.safetensors"}}
+            router.route(request).requests.put((0, i, request))
+            time.sleep(args.interval / 1000)
+        for _ in range(args.count):
+            done.acquire()
+        elapsed = time.perf_counter() - start
+
+        for worker in workers:
+            worker.stop()
+            worker.join()
+
+        loads = sum([w.storage.loads for w in wrappers])
+        print(f"{label:>24}: {elapsed:8.3f}s total, {loads} model loads")
+
+    print(f"{args.count} txt2img requests over {args.models} models on {args.workers} workers")
+    measure("least loaded", LeastLoadedRouter)
+    measure("model affinity", server.Router)
+
+def write_synthetic_checkpoint(model_type, file):
+    # random weights in the original checkpoint layout, streamed out one tensor at a time
+    with accelerate.init_empty_weights():
+        comps = {"UNET": models.UNET(model_type, "", "epsilon", torch.float16), "CLIP": models.CLIP(model_type, torch.float16), "VAE": models.VAE(model_type, torch.float16)}
+
+    state_dict = {}
+    for comp, model in comps.items():
+        for k, v in model.state_dict().items():
+            state_dict[f"{model_type}.{comp}.{k}"] = v
+    state_dict = convert.revert(model_type, state_dict)
+
+    header = {"__metadata__": {"model_type": model_type, "prediction_type": "epsilon", "model_variant": ""}}
+    offset = 0
+    for k, v in state_dict.items():
+        size = v.numel() * 2
+        header[k] = {"dtype": "F16", "shape": list(v.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+
+    with open(file + ".tmp", "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for v in state_dict.values():
+            f.write(torch.randn(v.shape, dtype=torch.float32).to(torch.float16).numpy().tobytes())
+    os.replace(file + ".tmp", file)
+
+def measure_load(args):
+    # runs in its own process so the peak RSS belongs to this load alone
+    model_storage = storage.ModelStorage(args.folder, torch.float16, torch.float32)
+    name = os.path.join("SD", args.measure)
+    if args.eager:
+        # everything read into memory up front, the way checkpoints were loaded before they were mapped
+        def load_file(file, comp):
+            with open(file, "rb") as f:
+                state_dict = safetensors.torch.load(f.read())
+            return model_storage.parse_model(*convert.convert_checkpoint(state_dict))
+        model_storage.load_file = load_file
+
+    device = torch.device(args.device)
+    start = time.perf_counter()
+    loaded = [model_storage.get_unet(name, device), model_storage.get_clip(name, device), model_storage.get_vae(name, device)]
+    model_storage.clear_file_cache()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    # mapped weights are only read in when used, touch them all so the peak includes them
+    for model in loaded:
+        for p in model.parameters():
+            p.data.sum()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"time": elapsed, "peak": peak}))
+
+def bench_load(args):
+    if args.measure:
+        return measure_load(args)
+
+    sd_folder = os.path.join(args.folder, "SD")
+    os.makedirs(sd_folder, exist_ok=True)
+
+    print(f"loading UNET, CLIP and VAE to {args.device}, wall time and peak RSS once every weight was used")
+    for model_type in args.types.split(","):
+        name = f"synthetic-{model_type}.safetensors"
+        file = os.path.join(sd_folder, name)
+        if not os.path.exists(file):
+            print(f"writing {file}")
+            write_synthetic_checkpoint(model_type, file)
+        size = os.path.getsize(file) / 1024**2
+
+        for label, eager in [("read", True), ("mapped", False)]:
+            command = [sys.executable, __file__, "load", "--folder", args.folder, "--device", args.device, "--measure", name]
+            if eager:
+                command += ["--eager"]
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"{model_type + ' ' + label:>24}: failed ({result.returncode})")
+                continue
+            result = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"{model_type + ' ' + label:>24}: {result['time']:8.3f}s, peak RSS {result['peak']:8.0f}MB ({result['peak']/size:.2f}x the {size:.0f}MB file)")
+
+def bench_swap(args):
+    sd_folder = os.path.join(args.folder, "SD")
+    os.makedirs(sd_folder, exist_ok=True)
+    name = f"synthetic-{args.type}.safetensors"
+    file = os.path.join(sd_folder, name)
+    if not os.path.exists(file):
+        print(f"writing {file}")
+        write_synthetic_checkpoint(args.type, file)
+
+    device = torch.device(args.device)
+    model_storage = storage.ModelStorage(args.folder, torch.float16, torch.float32)
+    params = wrapper.GenerationParameters(model_storage, device)
+    params.pin_device()
+
+    request = {
+        "model": os.path.join("SD", name), "prompt": [[["a photo of a cat"], [""]]],
+        "width": args.size, "height": args.size, "steps": args.steps, "scale": 7, "sampler": "Euler", "seed": 0,
+        "hr_factor": 2, "hr_steps": args.steps, "vram_mode": "Minimal", "precision": "FP32" if device.type == "cpu" else "FP16"
+    }
+
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    # the previous moves, synchronous and followed by a full collection each
+    def legacy_load(model, device, dtype=None):
+        if dtype:
+            model.to(device, dtype)
+        else:
+            model.to(device)
+        model_storage.do_gc()
+
+    def legacy_unload(model):
+        model.to("cpu")
+        model_storage.do_gc()
+
+    def measure(label, load, unload):
+        moves = []
+        def timed(function):
+            def inner(*args, **kwargs):
+                start = time.perf_counter()
+                function(*args, **kwargs)
+                moves[-1] += time.perf_counter() - start
+            return inner
+        model_storage.load, model_storage.unload = timed(load), timed(unload)
+
+        totals = []
+        for i in range(args.count + 1):
+            moves += [0]
+            sync()
+            start = time.perf_counter()
+            params.reset()
+            params.set(**request)
+            params.txt2img()
+            sync()
+            totals += [time.perf_counter() - start]
+        # the first run includes loading from disk
+        report(f"{label} moves", moves[1:], "s")
+        report(f"{label} total", totals[1:], "s")
+
+    print(f"Minimal VRAM txt2img with hires fix on {device}, {args.size}px, {args.steps}+{args.steps} steps, {args.count} runs")
+    measure("synchronous", legacy_load, legacy_unload)
+    measure("pinned", storage.ModelStorage.load.__get__(model_storage), storage.ModelStorage.unload.__get__(model_storage))
+
+def transport_client(endpoint, password, key=None, ticket=None):
+    # connect and wait for a pong, without a key this is a client from before the handshake.
+    # returns the latency and the ticket the server issued
+    start = time.perf_counter()
+    with websockets.sync.client.connect(endpoint, max_size=None, open_timeout=None) as client:
+        session_key = None
+        if key == None and ticket == None:
+            scheme = server.get_scheme(password)
+        else:
+            client_nonce = secrets.token_bytes(16)
+            client.send(server.HANDSHAKE + client_nonce + (ticket[1] if ticket else b""))
+            reply = client.recv()
+            server_nonce, status = reply[len(server.HANDSHAKE):len(server.HANDSHAKE)+16], reply[len(server.HANDSHAKE)+16]
+            if status == server.HANDSHAKE_RESUMED:
+                session_key = server.get_session_key(ticket[0], client_nonce, server_nonce)
+            else:
+                session_key = server.get_session_key(key or server.get_key(password), client_nonce, server_nonce)
+            scheme = AESGCM(session_key)
+
+        client.send(server.encrypt(scheme, bson.dumps({"type": "ping", "id": server.get_id()})))
+        new_ticket = None
+        while True:
+            response = bson.loads(server.decrypt(scheme, client.recv()))
+            if response["type"] == "session":
+                new_ticket = (server.get_session_key(session_key, b"", b"", b"resume"), response["data"]["ticket"])
+            if response["type"] == "pong":
+                break
+    return time.perf_counter() - start, new_ticket
+
+def bench_transport(args):
+    start = time.perf_counter()
+    instance = server.Server(NullWrapper(), "127.0.0.1", args.port, args.password)
+    print(f"password key derived in {time.perf_counter() - start:.3f}s")
+    instance.start()
+    endpoint = f"ws://127.0.0.1:{args.port}"
+
+    def measure(label, key=None, tickets=None):
+        results = [None] * args.count
+        def connect(i):
+            results[i] = transport_client(endpoint, args.password, key, tickets[i] if tickets else None)
+        threads = [threading.Thread(target=connect, args=(i,)) for i in range(args.count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        report(label, [r[0] * 1000 for r in results])
+        print(f"{'':>24}  {elapsed:8.3f}s for all {args.count}")
+        return [r[1] for r in results]
+
+    print(f"{args.count} concurrent connections, connect to pong")
+    measure("password key each")
+    tickets = measure("session handshake", server.get_key(args.password))
+    measure("resumed ticket", None, tickets)
+
+    instance.stop()
+
+    print(f"per message AES-GCM, {args.repeat} repeats")
+    scheme = AESGCM(secrets.token_bytes(32))
+    for size in [1, 20]:
+        data = secrets.token_bytes(size * 1024**2)
+        encrypt, decrypt = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            encrypted = server.encrypt(scheme, data)
+            encrypt += [(time.perf_counter() - start) * 1000]
+            start = time.perf_counter()
+            server.decrypt(scheme, encrypted)
+            decrypt += [(time.perf_counter() - start) * 1000]
+        report(f"encrypt {size}MB", encrypt)
+        report(f"decrypt {size}MB", decrypt)
+
+def bench_encode(args):
+    # noise compresses worst of all, blurred noise is closer to a real image
+    images = []
+    for _ in range(args.batch):
+        noise = np.random.randint(0, 255, (args.size // 8, args.size // 8, 3), dtype=np.uint8)
+        images += [PIL.Image.fromarray(noise).resize((args.size, args.size), PIL.Image.Resampling.BICUBIC)]
+
+    def measure(label, workers):
+        params = wrapper.GenerationParameters(NullStorage(), torch.device("cpu"))
+        params.encoder = encoder.EncoderPool(workers, args.compression)
+        received = {}
+        def callback(response, id=None):
+            if response["type"] == "result":
+                received[id] = time.perf_counter()
+            return True
+        params.callback = callback
+
+        started, busy = {}, []
+        start = time.perf_counter()
+        for i in range(args.count):
+            started[i] = time.perf_counter()
+            # the generation itself, the GPU loop waits on the device the same way
+            time.sleep(args.generate / 1000)
+            params.reset()
+            params.set(output_format=args.format, batch_groups=[(i, args.batch)])
+            params.on_complete(images, [{}] * args.batch)
+            busy += [(time.perf_counter() - started[i]) * 1000]
+        params.encoder.flush()
+        elapsed = time.perf_counter() - start
+
+        report(f"{label} inference", busy)
+        report(f"{label} to result", [(received[i] - started[i]) * 1000 for i in range(args.count)])
+        print(f"{'':>24}  {elapsed:8.3f}s for all {args.count}")
+
+    print(f"{args.count} requests of {args.batch} {args.size}px {args.format} images, {args.generate}ms generating each")
+    measure("inline", 0)
+    measure("pooled", args.workers)
+
+PROMPT_CORPUS = [
+    "masterpiece, best quality, 1girl, solo, long hair, looking at viewer, smile, (detailed eyes:1.2), outdoors, sky, cloud, [sunset:night sky:0.6], <lora:detail_tweaker:0.5>",
+    "a photo of a [cat|dog] sitting on a windowsill, (soft lighting:1.1), bokeh, 85mm, [film grain::0.3], highly detailed, sharp focus",
+    "(worst quality, low quality:1.4), (bad anatomy:1.2), extra fingers, blurry, watermark, text, signature, jpeg artifacts",
+    "[oil painting:photograph:12] of an old lighthouse on a cliff, stormy sea, ((dramatic)), [[muted colors]], <lora:painterly:[0.8:0.2:0.5]>",
+    "portrait of a knight in ornate armor, [gold|silver|bronze] trim, (intricate:[1.0:1.3:HR]), castle background, volumetric fog, [mist:haze:0.4]",
+    "landscape, mountains, lake reflection, [spring|summer|autumn|winter], golden hour, (ultra wide:0.8), <lora:scenery:1,0.5,0.2:0.7>",
+    "cyberpunk city street at night, neon signs, rain, reflections, (crowd:0.6), [flying cars::0.7], [blade runner style:anime style:20]",
+    "simple icon of a leaf, flat design, white background",
+]
+
+def bench_prompts(args):
+    # the grammar, then walking the tree every step against only at the steps a schedule triggers, and both from the cache
+    print(f"{len(PROMPT_CORPUS)} prompts, each parsed {args.count} times")
+    for steps in args.steps:
+        trees = [prompts.prompt_grammar.parse(p) for p in PROMPT_CORPUS]
+        for tree in trees:
+            if prompts.get_schedules(tree, steps, every_step=True) != prompts.get_schedules(tree, steps):
+                print(f"{steps} steps: schedules differ!")
+
+        def measure(label, function):
+            samples = []
+            for _ in range(args.count):
+                for i, prompt in enumerate(PROMPT_CORPUS):
+                    start = time.perf_counter()
+                    function(i, prompt)
+                    samples += [(time.perf_counter() - start) * 1000]
+            report(f"{steps} steps {label}", samples)
+
+        measure("grammar", lambda i, p: prompts.prompt_grammar.parse(p))
+        measure("every step", lambda i, p: prompts.get_schedules(trees[i], steps, every_step=True))
+        measure("boundaries", lambda i, p: prompts.get_schedules(trees[i], steps))
+        prompts.parse_cached.cache_clear()
+        measure("cached", lambda i, p: prompts.parse_prompt(p, steps))
+
+def bench_cfg(args):
+    # the guidance around a unet call, composing per batch item against all at once
+    device = torch.device(args.device)
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    shape = (4, args.size // 8, args.size // 8)
+    print(f"{args.size}px latents, {args.prompts} positive and 1 negative prompt, {args.count} steps")
+    for batch in args.batch:
+        denoiser = guidance.GuidedDenoiser.__new__(guidance.GuidedDenoiser)
+        denoiser.device, denoiser.dtype, denoiser.scale = device, dtype, 7.0
+        denoiser.cfg_pp, denoiser.cfg_rescale = False, args.rescale
+        ones = torch.ones((args.prompts, 1, 1, 1), dtype=dtype, device=device)
+        denoiser.compositions = [((ones, ones), ones[:1])] * batch
+        denoiser.compile_compositions()
+        stacked = denoiser.stack_compositions()
+
+        latents = torch.randn((batch, *shape), dtype=dtype, device=device)
+        pred = torch.randn((batch * (args.prompts + 1), *shape), dtype=dtype, device=device)
+
+        def measure(label, compose):
+            samples = []
+            for _ in range(args.count):
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                denoiser.get_model_inputs(latents)
+                result = compose(pred)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                samples += [(time.perf_counter() - start) * 1000]
+            report(f"batch {batch} {label}", samples)
+            return result
+
+        denoiser.stacked = None
+        each = measure("each", denoiser.compose_each_prediction)
+        denoiser.stacked = stacked
+        batched = measure("batched", denoiser.compose_predictions)
+        if not torch.equal(each, batched):
+            print(f"batch {batch}: predictions differ!")
+
+def bench_adaptive(args):
+    # full guidance against adaptive guidance and feature caching on the same seeds, unet rows run and how far the images end up from full.
+    # synthetic weights only say anything about speed, point --folder and --model at a real checkpoint for the quality
+    if not args.model:
+        sd_folder = os.path.join(args.folder, "SD")
+        os.makedirs(sd_folder, exist_ok=True)
+        args.model = os.path.join("SD", f"synthetic-{args.type}.safetensors")
+        file = os.path.join(args.folder, args.model)
+        if not os.path.exists(file):
+            print(f"writing {file}")
+            write_synthetic_checkpoint(args.type, file)
+
+    device = torch.device(args.device)
+    model_storage = storage.ModelStorage(args.folder, torch.float16, torch.float32)
+    params = wrapper.GenerationParameters(model_storage, device)
+    params.pin_device()
+
+    request = {
+        "model": args.model, "prompt": [[[args.prompt], [args.negative_prompt]]], "batch_size": args.batch,
+        "width": args.size, "height": args.size, "steps": args.steps, "scale": 7, "sampler": args.sampler, "seed": 0,
+        "precision": "FP32" if device.type == "cpu" else "FP16"
+    }
+
+    rows = []
+    predict = guidance.GuidedDenoiser.predict
+    def counted(self, latents, *args, **kwargs):
+        rows[-1] += latents.shape[0]
+        return predict(self, latents, *args, **kwargs)
+    guidance.GuidedDenoiser.predict = counted
+
+    def run(**kwargs):
+        rows.append(0)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        params.reset()
+        params.set(**request, **kwargs)
+        images = params.txt2img()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return time.perf_counter() - start, rows[-1], np.stack([np.asarray(i, dtype=np.float32) for i in images])
+
+    # the first run includes loading from disk
+    run()
+    print(f"txt2img on {device}, {args.batch} {args.size}px images, {args.steps} steps of {args.sampler}")
+    elapsed, full_rows, full = run()
+    print(f"{'full':>24}: {elapsed:8.3f}s, {full_rows:4d} unet rows")
+
+    variants = [("cutoff", {"cfg_cutoff": c}) for c in args.cutoff] + [("similarity", {"cfg_similarity": s}) for s in args.similarity] + \
+               [("cache interval", {"cache_interval": n}) for n in args.cache_interval]
+    for label, kwargs in variants:
+        elapsed, variant_rows, images = run(**kwargs)
+        mse = float(np.mean((images - full) ** 2))
+        psnr = 10 * np.log10(255**2 / mse) if mse else float("inf")
+        print(f"{label + ' ' + str(list(kwargs.values())[0]):>24}: {elapsed:8.3f}s, {variant_rows:4d} unet rows ({variant_rows/full_rows:.2f}x), PSNR {psnr:6.2f}dB against full")
+
+    guidance.GuidedDenoiser.predict = predict
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='sd-inference-server benchmarks')
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    queue_parser = subparsers.add_parser("queue", help="request queue ack-to-start latency")
+    queue_parser.add_argument('--count', type=int, help='number of ping requests', default=1000)
+    queue_parser.add_argument('--interval', type=float, help='milliseconds between requests, 0 for a single burst', default=0)
+    queue_parser.set_defaults(func=bench_queue)
+
+    pool_parser = subparsers.add_parser("pool", help="device pool routing with fake workers")
+    pool_parser.add_argument('--workers', type=int, help='number of fake CPU workers', default=4)
+    pool_parser.add_argument('--models', type=int, help='number of distinct models requested', default=4)
+    pool_parser.add_argument('--count', type=int, help='number of txt2img requests', default=64)
+    pool_parser.add_argument('--load', type=float, help='milliseconds to load a model', default=100)
+    pool_parser.add_argument('--generate', type=float, help='milliseconds to generate', default=20)
+    pool_parser.add_argument('--interval', type=float, help='milliseconds between requests', default=5)
+    pool_parser.set_defaults(func=bench_pool)
+
+    load_parser = subparsers.add_parser("load", help="checkpoint loading with synthetic models")
+    load_parser.add_argument('--folder', type=str, help='models folder to write the synthetic checkpoints to', default="benchmark_models")
+    load_parser.add_argument('--types', type=str, help='comma separated model types', default="SDv1,SDXL-Base")
+    load_parser.add_argument('--device', type=str, help='device to load to', default="cpu")
+    load_parser.add_argument('--measure', type=str, help=argparse.SUPPRESS, default=None)
+    load_parser.add_argument('--eager', help=argparse.SUPPRESS, action='store_true')
+    load_parser.set_defaults(func=bench_load)
+
+    swap_parser = subparsers.add_parser("swap", help="model moves during a Minimal VRAM txt2img with hires fix")
+    swap_parser.add_argument('--folder', type=str, help='models folder to write the synthetic checkpoint to', default="benchmark_models")
+    swap_parser.add_argument('--type', type=str, help='model type', default="SDv1")
+    swap_parser.add_argument('--device', type=str, help='device to generate on', default="cuda")
+    swap_parser.add_argument('--size', type=int, help='width and height of the base pass', default=512)
+    swap_parser.add_argument('--steps', type=int, help='steps for each pass', default=10)
+    swap_parser.add_argument('--count', type=int, help='number of measured runs', default=5)
+    swap_parser.set_defaults(func=bench_swap)
+
+    transport_parser = subparsers.add_parser("transport", help="encrypted transport connects and per message cost")
+    transport_parser.add_argument('--port', type=int, help='port for the local server', default=28889)
+    transport_parser.add_argument('--password', type=str, help='server password', default="qDiffusion")
+    transport_parser.add_argument('--count', type=int, help='number of concurrent connections', default=100)
+    transport_parser.add_argument('--repeat', type=int, help='repeats of each message size', default=10)
+    transport_parser.set_defaults(func=bench_transport)
+
+    encode_parser = subparsers.add_parser("encode", help="result encoding on the inference thread or an encoder pool")
+    encode_parser.add_argument('--batch', type=int, help='images per request', default=8)
+    encode_parser.add_argument('--size', type=int, help='width and height of the images', default=1024)
+    encode_parser.add_argument('--format', type=str, help='PNG, JPEG, WEBP or WEBP Lossless', default="PNG")
+    encode_parser.add_argument('--compression', type=int, help='PNG compression level', default=encoder.DEFAULT_COMPRESSION)
+    encode_parser.add_argument('--workers', type=int, help='encoder threads for the pooled run', default=encoder.DEFAULT_WORKERS)
+    encode_parser.add_argument('--count', type=int, help='number of requests', default=5)
+    encode_parser.add_argument('--generate', type=float, help='milliseconds of generation before each result', default=2000)
+    encode_parser.set_defaults(func=bench_encode)
+
+    prompts_parser = subparsers.add_parser("prompts", help="prompt schedule parsing over a corpus of prompts")
+    prompts_parser.add_argument('--steps', type=int, nargs="+", help='step counts to parse for', default=[20, 50, 150])
+    prompts_parser.add_argument('--count', type=int, help='times each prompt is parsed', default=20)
+    prompts_parser.set_defaults(func=bench_prompts)
+
+    cfg_parser = subparsers.add_parser("cfg", help="classifier-free guidance composition around each unet call")
+    cfg_parser.add_argument('--batch', type=int, nargs="+", help='batch sizes', default=[1, 4, 8, 16])
+    cfg_parser.add_argument('--size', type=int, help='width and height of the images', default=1024)
+    cfg_parser.add_argument('--prompts', type=int, help='positive prompts per batch item', default=1)
+    cfg_parser.add_argument('--rescale', type=float, help='CFG rescale', default=0.0)
+    cfg_parser.add_argument('--device', type=str, help='device to compose on', default="cpu")
+    cfg_parser.add_argument('--count', type=int, help='number of steps', default=20)
+    cfg_parser.set_defaults(func=bench_cfg)
+
+    adaptive_parser = subparsers.add_parser("adaptive", help="adaptive guidance and feature caching speed and quality against full computation")
+    adaptive_parser.add_argument('--folder', type=str, help='models folder', default="benchmark_models")
+    adaptive_parser.add_argument('--model', type=str, help='checkpoint relative to the models folder, a synthetic one if not given', default=None)
+    adaptive_parser.add_argument('--type', type=str, help='model type of the synthetic checkpoint', default="SDv1")
+    adaptive_parser.add_argument('--device', type=str, help='device to generate on', default="cuda")
+    adaptive_parser.add_argument('--prompt', type=str, help='positive prompt', default="a photo of a cat sitting on a windowsill, soft lighting")
+    adaptive_parser.add_argument('--negative-prompt', type=str, help='negative prompt', default="blurry, low quality")
+    adaptive_parser.add_argument('--sampler', type=str, help='sampler', default="Euler")
+    adaptive_parser.add_argument('--size', type=int, help='width and height of the images', default=512)
+    adaptive_parser.add_argument('--batch', type=int, help='images per run', default=1)
+    adaptive_parser.add_argument('--steps', type=int, help='steps', default=20)
+    adaptive_parser.add_argument('--cutoff', type=float, nargs="*", help='cfg_cutoff values to compare', default=[0.5, 0.7, 0.9])
+    adaptive_parser.add_argument('--similarity', type=float, nargs="*", help='cfg_similarity values to compare', default=[0.95, 0.99])
+    adaptive_parser.add_argument('--cache-interval', type=int, nargs="*", help='cache_interval values to compare', default=[2, 3, 5])
+    adaptive_parser.set_defaults(func=bench_adaptive)
+
+    args = parser.parse_args()
+    args.func(args)
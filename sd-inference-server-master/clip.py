@@ -35,10 +35,10 @@ class CustomSDXLCLIP(torch.nn.Module):
         clip_skip = 2
 
         open_clip_input_ids = input_ids
-        ldm_clip_input_ids = [49407 if type(i) == int and i == 0 else i for i in input_ids]
+        ldm_clip_input_ids = [[49407 if type(i) == int and i == 0 else i for i in row] for row in input_ids]
 
-        open_clip_input_ids = [i[:1280] if type(i) == torch.Tensor else i for i in open_clip_input_ids]
-        ldm_clip_input_ids = [i[1280:] if type(i) == torch.Tensor else i for i in ldm_clip_input_ids]
+        open_clip_input_ids = [[i[:1280] if type(i) == torch.Tensor else i for i in row] for row in open_clip_input_ids]
+        ldm_clip_input_ids = [[i[1280:] if type(i) == torch.Tensor else i for i in row] for row in ldm_clip_input_ids]
 
         open_clip_outputs = self.open_clip.text_model(open_clip_input_ids)
         ldm_clip_outputs = self.ldm_clip.text_model(ldm_clip_input_ids)
@@ -47,7 +47,7 @@ class CustomSDXLCLIP(torch.nn.Module):
         ldm_clip_cond = ldm_clip_outputs.hidden_states[-clip_skip]
         cond = torch.cat([ldm_clip_cond, open_clip_cond], dim=2)
         
-        emb = self.open_clip.text_projection(open_clip_outputs.pooler_output)[0]
+        emb = self.open_clip.text_projection(open_clip_outputs.pooler_output)
 
         return cond, emb
 
@@ -59,16 +59,16 @@ class CustomCLIPTextTransformer(CLIPTextTransformer):
         output_hidden_states = output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
-        # tensors are already embedded so bypass the token_embedding
-        tensors = [t if type(t) == torch.Tensor else None for t in input_ids]
-        input_ids = [t if type(t) != torch.Tensor else 0 for t in input_ids]
-        input_ids = torch.tensor([input_ids], dtype=torch.long, device=self.device)
+        # a batch of token rows, tensors are already embedded so bypass the token_embedding
+        tensors = [[t if type(t) == torch.Tensor else None for t in row] for row in input_ids]
+        input_ids = [[t if type(t) != torch.Tensor else 0 for t in row] for row in input_ids]
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
         
-        inputs_embeds = [e for e in self.embeddings.token_embedding(input_ids)[0]]
-        for i in range(len(inputs_embeds)):
-            if tensors[i] != None:
-                inputs_embeds[i] = tensors[i].to(inputs_embeds[i].dtype)
-        inputs_embeds = torch.stack(inputs_embeds).unsqueeze(0)
+        inputs_embeds = self.embeddings.token_embedding(input_ids)
+        for b in range(len(tensors)):
+            for i in range(len(tensors[b])):
+                if tensors[b][i] != None:
+                    inputs_embeds[b, i] = tensors[b][i].to(inputs_embeds.dtype)
 
         position_ids = self.embeddings.position_ids[:, :inputs_embeds.shape[1]]
         position_embeddings = self.embeddings.position_embedding(position_ids)
@@ -34,11 +34,6 @@ def SDv1_convert(state_dict):
         if not k in mapping:
             del state_dict[k]
 
-    # cast to fp16
-    for k in state_dict:
-        if state_dict[k].dtype in {torch.float32, torch.float64, torch.bfloat16}:
-            state_dict[k] = state_dict[k].to(torch.float16)
-
     # most keys are just renamed
     for src, dst in mapping.items():
         if src in state_dict:
@@ -159,11 +154,6 @@ def SDv2_convert(state_dict):
             print("DEL", k)
             del state_dict[k]
 
-    # cast to fp16
-    for k in state_dict:
-        if state_dict[k].dtype in {torch.float32, torch.float64, torch.bfloat16}:
-            state_dict[k] = state_dict[k].to(torch.float16)
-
     # most keys are just renamed
     for src, dst in mapping.items():
         if src in state_dict:
@@ -240,10 +230,6 @@ def SDXL_Base_convert(state_dict):
         if not k in mapping:
             del state_dict[k]
 
-    for k in state_dict:
-        if state_dict[k].dtype in {torch.float32, torch.float64, torch.bfloat16}:
-            state_dict[k] = state_dict[k].to(torch.float16)
-
     for src, dst in mapping.items():
         if src in state_dict:
             state_dict[dst] = state_dict[src]
@@ -259,6 +245,12 @@ def SDXL_Base_convert(state_dict):
 
     return state_dict
 
+def cast_fp16(state_dict):
+    for k in state_dict:
+        if state_dict[k].dtype in {torch.float32, torch.float64, torch.bfloat16}:
+            state_dict[k] = state_dict[k].to(torch.float16)
+    return state_dict
+
 def clean_component(state_dict):
     valid = set()
     with open(utils.relative_file(os.path.join("mappings", "COMP_valid.txt"))) as file:
@@ -285,12 +277,9 @@ def convert_checkpoint(in_file):
             if 'state_dict' in state_dict:
                 state_dict = state_dict['state_dict']
         elif in_file.endswith(".safetensors"):
-            state_dict = {}
-            with safetensors.safe_open(in_file, framework="pt", device="cpu") as f:
-                metadata = f.metadata() or {}
-                state_dict = {}
-                for k in f.keys():
-                    state_dict[k] = f.get_tensor(k)
+            # views into a mapping of the file, the remapping below only moves them around.
+            # they are materialized once, when loaded into their final dtype and device
+            state_dict, metadata = utils.map_safetensors(in_file)
     elif type(in_file) == dict:
         state_dict = in_file
         in_file, name = "", ""
@@ -338,6 +327,7 @@ def convert_checkpoint(in_file):
 def convert_checkpoint_save(in_file, out_folder):
     name = in_file.split(os.path.sep)[-1].split(".")[0]
     state_dict, metadata = convert_checkpoint(in_file)
+    cast_fp16(state_dict)
     
     out_file = os.path.join(out_folder, f"{name}.qst")
     print(f"SAVING {out_file}")
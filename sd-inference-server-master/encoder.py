@@ -0,0 +1,70 @@
+import io
+import concurrent.futures
+import PIL.Image
+
+FORMATS = {"PNG": "PNG", "JPEG": "JPEG", "WEBP": "WEBP", "WEBP Lossless": "WEBP"}
+
+DEFAULT_WORKERS = 4
+DEFAULT_COMPRESSION = 6
+
+POOL = None
+
+def encode(image, format="PNG", compression=DEFAULT_COMPRESSION, quality=90, size=None):
+    if size:
+        image = image.copy()
+        image.thumbnail(size, PIL.Image.Resampling.LANCZOS)
+    bytesio = io.BytesIO()
+    if format == "PNG":
+        image.save(bytesio, format="PNG", compress_level=compression)
+    elif format == "JPEG":
+        image.save(bytesio, format="JPEG", quality=quality)
+    elif format == "WEBP":
+        image.save(bytesio, format="WEBP", quality=quality)
+    elif format == "WEBP Lossless":
+        image.save(bytesio, format="WEBP", lossless=True)
+    else:
+        raise ValueError(f"unknown image format: {format}")
+    return bytesio.getvalue()
+
+class EncoderPool():
+    # images are encoded on worker threads, PIL lets go of the GIL while compressing so they run alongside inference.
+    # responses waiting on them are delivered by a single thread, in the order they were submitted.
+    # with no workers everything runs inline, the way it was done before
+    def __init__(self, workers=DEFAULT_WORKERS, compression=DEFAULT_COMPRESSION):
+        self.workers = workers
+        self.compression = compression
+        self.encoders = None
+        self.delivery = None
+        if workers:
+            self.encoders = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="encoder")
+            self.delivery = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="delivery")
+
+    def submit(self, executor, function, *args, **kwargs):
+        if executor == None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return executor.submit(function, *args, **kwargs)
+
+    def encode(self, image, format="PNG", compression=None, quality=90, size=None):
+        if compression == None:
+            compression = self.compression
+        return self.submit(self.encoders, encode, image, format, compression, quality, size)
+
+    def deliver(self, function, *args, **kwargs):
+        return self.submit(self.delivery, function, *args, **kwargs)
+
+    def flush(self):
+        self.deliver(lambda: None).result()
+
+def configure(workers=DEFAULT_WORKERS, compression=DEFAULT_COMPRESSION):
+    global POOL
+    POOL = EncoderPool(workers, compression)
+
+def get_pool():
+    if POOL == None:
+        configure()
+    return POOL
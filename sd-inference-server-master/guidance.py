@@ -1,7 +1,20 @@
 import torch
+import timing
+
+class FeatureCache():
+    # deep unet features reused between full passes, refreshed every interval steps and whenever the conditioning changes
+    def __init__(self, interval):
+        self.interval = interval
+        self.features = None
+        self.refresh = True
+
+    def set_step(self, step, changed):
+        self.refresh = changed or step % self.interval == 0
+        if self.refresh:
+            self.features = None
 
 class GuidedDenoiser():
-    def __init__(self, unet, device, conditioning_schedule, scale, cfg_rescale, prediction_type=None):
+    def __init__(self, unet, device, conditioning_schedule, scale, cfg_rescale, prediction_type=None, cfg_cutoff=None, cfg_similarity=None, cache_interval=None):
         self.unet = unet
         self.conditioning_schedule = conditioning_schedule
         self.conditioning = None
@@ -21,10 +34,26 @@ class GuidedDenoiser():
         self.cfg_pp = False
         self.uncond_pred = None
 
+        # adaptive guidance, past the cutoff the negatives are skipped and the last guidance term is reused
+        self.cfg_cutoff = cfg_cutoff
+        self.cfg_similarity = cfg_similarity
+        # steps the sampler actually runs, a HR pass or img2img below full strength run fewer than the schedule
+        self.steps = conditioning_schedule.steps
+        self.guidance = None
+        self.similar = False
+        self.cut = False
+
+        self.feature_cache = None
+        self.set_cache_interval(cache_interval)
+
         self.predictions = None
 
         self.inpainting_input = None
 
+        self.timeline = None
+        self.current = None
+        self.networks = None
+
         self.get_conditioning()
 
     def get_prediction_type(self):
@@ -41,9 +70,16 @@ class GuidedDenoiser():
 
     def get_conditioning(self):
         self.compositions = self.conditioning_schedule.get_compositions(self.dtype, self.device)
+        self.compile_compositions()
+        self.timeline = self.conditioning_schedule.compile(self.dtype, self.device)
+        self.cut_entries = {}
+        self.current = None
+        self.networks = None
 
     def set_unet(self, unet):
         self.unet = unet
+        self.current = None
+        self.networks = None
 
     def set_mask(self, mask, original):
         self.mask = mask.to(self.dtype)
@@ -61,6 +97,12 @@ class GuidedDenoiser():
     def set_cfg_pp(self, cfg_pp):
         self.cfg_pp = cfg_pp
 
+    def set_steps(self, steps):
+        self.steps = steps
+
+    def set_cache_interval(self, cache_interval):
+        self.feature_cache = FeatureCache(cache_interval) if cache_interval and cache_interval > 1 else None
+
     def set_prediction_type(self, prediction_type):
         self.override_prediction_type = prediction_type
 
@@ -70,9 +112,15 @@ class GuidedDenoiser():
     def predict(self, latents, timestep, conditioning):
         timestep = torch.ceil_(timestep)
         inputs = self.get_additional_inputs(latents)
-        return self.unet(inputs, timestep, encoder_hidden_states=conditioning,
-                         added_cond_kwargs=self.additional_conditioning,
-                         added_cross_kwargs=self.additional_kwargs).sample
+        with timing.span("unet"):
+            if self.feature_cache:
+                return self.unet(inputs, timestep, encoder_hidden_states=conditioning,
+                                 added_cond_kwargs=self.additional_conditioning,
+                                 added_cross_kwargs=self.additional_kwargs,
+                                 feature_cache=self.feature_cache).sample
+            return self.unet(inputs, timestep, encoder_hidden_states=conditioning,
+                             added_cond_kwargs=self.additional_conditioning,
+                             added_cross_kwargs=self.additional_kwargs).sample
 
     def predict_noise_epsilon(self, latents, timestep, conditioning, alpha):
         noise_pred = self.predict(latents, timestep, conditioning)
@@ -88,13 +136,67 @@ class GuidedDenoiser():
             latents = (noised_original * self.mask) + (latents * (1 - self.mask))
         return latents
     
-    def get_model_inputs(self, latents):
-        model_input = []
+    def compile_compositions(self):
+        # each batch item is repeated once per prompt it has
+        expansion = []
+        positive_rows, negative_rows = [], []
         for i, ((m, p), n) in enumerate(self.compositions):
-            model_input += [latents[i:i+1]]*(len(p) + len(n))
-        model_input = torch.cat(model_input)
+            positive_rows += [len(expansion)]
+            negative_rows += [len(expansion) + len(p)]
+            expansion += [i]*(len(p) + len(n))
+        self.expansion = torch.tensor(expansion, dtype=torch.long, device=self.device)
+
+        # the main positive and negative prompt of each batch item, past the cutoff only the positive is run
+        self.positive_list = positive_rows
+        self.positive_rows = torch.tensor(positive_rows, dtype=torch.long, device=self.device)
+        self.negative_rows = torch.tensor(negative_rows, dtype=torch.long, device=self.device)
+
+        # a fixed number of kernels instead of some per batch item, on the cpu the per item loop stays in cache so is kept
+        self.stacked = None
+        self.segments = None
+        if torch.device(self.device).type != "cpu":
+            self.stacked = self.stack_compositions()
+            if self.stacked == None:
+                self.segments = self.segment_compositions()
+
+    def stack_compositions(self):
+        # only when every batch item has the same number of prompts and masks of the same shape
+        shapes = set([(len(p), len(n), tuple(m.shape)) for (m, p), n in self.compositions])
+        if len(shapes) != 1:
+            return None
+        masks = torch.stack([m for (m, _), _ in self.compositions])
+        pos_weights = torch.stack([p for (_, p), _ in self.compositions])
+        neg_weights = torch.stack([n for _, n in self.compositions])
+        neg_total = torch.stack([torch.sum(n) for _, n in self.compositions]).reshape(-1,1,1,1,1)
+        return masks, pos_weights, neg_weights, neg_total
+
+    def segment_compositions(self):
+        # batch items with different numbers of prompts or mask shapes, each row is summed into its item by index
+        pos_rows, pos_items, neg_rows, neg_items = [], [], [], []
+        i = 0
+        for b, ((m, p), n) in enumerate(self.compositions):
+            pos_rows += list(range(i, i + len(p)))
+            pos_items += [b] * len(p)
+            neg_rows += list(range(i + len(p), i + len(p) + len(n)))
+            neg_items += [b] * len(n)
+            i += len(p) + len(n)
+
+        try:
+            shape = torch.broadcast_shapes(*[tuple(m.shape[1:]) for (m, _), _ in self.compositions])
+        except RuntimeError:
+            return None
+        masks = torch.cat([m.expand(len(m), *shape) for (m, _), _ in self.compositions])
+        pos_weights = torch.cat([p for (_, p), _ in self.compositions])
+        neg_weights = torch.cat([n for _, n in self.compositions])
+        neg_total = torch.stack([torch.sum(n) for _, n in self.compositions]).reshape(-1,1,1,1)
+
+        index = lambda rows: torch.tensor(rows, dtype=torch.long, device=self.device)
+        return index(pos_rows), index(pos_items), index(neg_rows), index(neg_items), masks, pos_weights, neg_weights, neg_total
 
-        return model_input
+    def get_model_inputs(self, latents):
+        if self.cut:
+            return latents
+        return latents.index_select(0, self.expansion)
     
     def get_additional_inputs(self, latents):
         if self.inpainting_input != None:
@@ -103,6 +205,62 @@ class GuidedDenoiser():
         return latents
     
     def compose_predictions(self, pred):
+        if self.segments != None:
+            return self.compose_segmented_predictions(pred)
+        if self.stacked == None:
+            return self.compose_each_prediction(pred)
+
+        masks, pos_weights, neg_weights, neg_total = self.stacked
+        batch, pos_len = masks.shape[0], masks.shape[1]
+        pred = pred.reshape(batch, -1, *pred.shape[1:])
+        pos = pred[:, :pos_len]
+        neg = pred[:, pos_len:]
+
+        # the same operations as compose_each_prediction, along a batch dimension
+        neg = (neg*neg_weights).sum(dim=1, keepdims=True) / neg_total
+        pos = pos * masks + (neg * (1 - masks))
+
+        if self.cfg_pp:
+            self.uncond_pred = neg[:, 0]
+
+        cfg = neg + ((pos - neg) * (pos_weights * self.scale)).sum(dim=1, keepdims=True)
+
+        if self.cfg_rescale:
+            std = torch.std(pos.reshape(batch, -1), dim=1) / torch.std(cfg.reshape(batch, -1), dim=1)
+            factor = self.cfg_rescale*std.reshape(-1,1,1,1,1) + (1-self.cfg_rescale)
+            cfg = cfg * factor
+
+        return cfg[:, 0]
+
+    def compose_segmented_predictions(self, pred):
+        pos_rows, pos_items, neg_rows, neg_items, masks, pos_weights, neg_weights, neg_total = self.segments
+        batch = neg_total.shape[0]
+        zeros = lambda: pred.new_zeros((batch, *pred.shape[1:]))
+
+        # the same operations as compose_each_prediction, sums over each item's rows are index_add_ into its own row
+        neg = zeros().index_add_(0, neg_items, pred.index_select(0, neg_rows) * neg_weights) / neg_total
+        item_neg = neg.index_select(0, pos_items)
+        pos = pred.index_select(0, pos_rows) * masks + (item_neg * (1 - masks))
+
+        if self.cfg_pp:
+            self.uncond_pred = neg
+
+        cfg = neg + zeros().index_add_(0, pos_items, (pos - item_neg) * (pos_weights * self.scale))
+
+        if self.cfg_rescale:
+            # std over all of an item's positive rows, as a mean then the squared deviations from it
+            flat = pos.reshape(pos.shape[0], -1).float()
+            count = torch.zeros((batch,), device=pred.device).index_add_(0, pos_items, torch.full_like(pos_items, flat.shape[1], dtype=torch.float))
+            mean = torch.zeros((batch,), device=pred.device).index_add_(0, pos_items, flat.sum(dim=1)) / count
+            deviation = ((flat - mean.index_select(0, pos_items).unsqueeze(1))**2).sum(dim=1)
+            std = (torch.zeros((batch,), device=pred.device).index_add_(0, pos_items, deviation) / (count - 1)).sqrt()
+            std = std / torch.std(cfg.reshape(batch, -1).float(), dim=1)
+            factor = self.cfg_rescale*std.reshape(-1,1,1,1) + (1-self.cfg_rescale)
+            cfg = cfg * factor.to(cfg.dtype)
+
+        return cfg
+
+    def compose_each_prediction(self, pred):
         composed_pred = []
         composed_uncond_pred = [] if self.cfg_pp else None
         i = 0
@@ -138,7 +296,24 @@ class GuidedDenoiser():
         
         return torch.cat(composed_pred)
 
+    def cache_guidance(self, pred, composed_pred, sigma=1, origin=0):
+        # the guidance term as noise, relative to the main positive prompt
+        if not (self.cfg_cutoff or self.cfg_similarity) or self.cfg_pp:
+            return
+        cond = pred.index_select(0, self.positive_rows)
+        self.guidance = (composed_pred - cond) / sigma
+
+        if self.cfg_similarity and not self.similar:
+            uncond = pred.index_select(0, self.negative_rows)
+            cond, uncond = (origin - cond).flatten(1), (origin - uncond).flatten(1)
+            similarity = torch.nn.functional.cosine_similarity(cond.float(), uncond.float(), dim=1).min()
+            self.similar = similarity.item() >= self.cfg_similarity
+
     def predict_noise(self, latents, timestep, alpha):
+        with timing.span("guidance"):
+            return self.predict_guided_noise(latents, timestep, alpha)
+
+    def predict_guided_noise(self, latents, timestep, alpha):
         model_input = self.get_model_inputs(latents)
         conditioning = self.conditioning
 
@@ -149,7 +324,11 @@ class GuidedDenoiser():
         elif prediction_type == "v":
             noise_pred = self.predict_noise_v(model_input, timestep, conditioning, alpha)
 
+        if self.cut:
+            return noise_pred + self.guidance
+
         composed_pred = self.compose_predictions(noise_pred)
+        self.cache_guidance(noise_pred, composed_pred)
         return composed_pred
 
     def predict_original_epsilon(self, latents, timestep, sigma, conditioning):
@@ -174,6 +353,10 @@ class GuidedDenoiser():
         return original_pred
 
     def predict_original(self, latents, timestep, sigma):
+        with timing.span("guidance"):
+            return self.predict_guided_original(latents, timestep, sigma)
+
+    def predict_guided_original(self, latents, timestep, sigma):
         model_input = self.get_model_inputs(latents)
         conditioning = self.conditioning
 
@@ -186,15 +369,59 @@ class GuidedDenoiser():
         else:
             raise RuntimeError(f"Unknown prediction type: {prediction_type}")
 
-        composed_pred = self.compose_predictions(original_pred)
+        if self.cut:
+            composed_pred = original_pred - self.guidance * sigma
+        else:
+            composed_pred = self.compose_predictions(original_pred)
+            self.cache_guidance(original_pred, composed_pred, -sigma, latents)
         masked_pred = self.mask_original(composed_pred)
         return masked_pred
 
+    def set_cutoff(self, step):
+        if step == 0:
+            self.guidance = None
+            self.similar = False
+
+        self.cut = False
+        if self.guidance != None and not self.cfg_pp:
+            if self.cfg_cutoff and step >= self.cfg_cutoff * self.steps:
+                self.cut = True
+            if self.similar:
+                self.cut = True
+
+    def get_entry(self, index):
+        entry = self.timeline.entries[index]
+        if not self.cut:
+            return entry
+
+        # the same entry for just the main positive prompts
+        if not index in self.cut_entries:
+            conditioning, additional_conditioning, additional_kwargs, networks = entry
+            conditioning = conditioning.index_select(0, self.positive_rows)
+            additional_conditioning = {k: v.index_select(0, self.positive_rows) for k, v in additional_conditioning.items()}
+            additional_kwargs = {k: [v[i] for i in self.positive_list] for k, v in additional_kwargs.items()}
+            self.cut_entries[index] = (conditioning, additional_conditioning, additional_kwargs, networks)
+        return self.cut_entries[index]
+
     def set_step(self, step):
-        self.conditioning = self.conditioning_schedule.get_conditioning_at_step(step, self.dtype, self.device)
-        self.additional_conditioning = self.conditioning_schedule.get_additional_conditioning_at_step(step, self.dtype, self.device)
-        self.additional_kwargs = self.conditioning_schedule.get_additional_attention_kwargs_at_step(step)
-        self.unet.additional.set_strength(self.conditioning_schedule.get_networks_at_step(step))
+        profile = timing.current()
+        if profile != None:
+            profile.begin_step(self.device)
+
+        self.set_cutoff(step)
+
+        # nothing to do until the step crosses into a different entry of the timeline
+        index = (self.timeline.get_index(step), self.cut)
+        if self.feature_cache:
+            self.feature_cache.set_step(step, index != self.current)
+        if index == self.current:
+            return
+        self.current = index
+
+        self.conditioning, self.additional_conditioning, self.additional_kwargs, networks = self.get_entry(index[0])
+        if networks != self.networks:
+            self.unet.additional.set_strength(networks)
+            self.networks = networks
         
     def reset(self):
         self.mask = None
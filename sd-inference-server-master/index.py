@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+
+INDEX_FILE = ".model_index.json"
+
+# inotify events that mean a model folder changed
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_ISDIR = 0x40000000
+IN_CHANGES = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")
+
+class ModelIndex():
+    # facts about model files that take opening the file to work out (LoRA type, metadata, TI shape).
+    # kept next to the models keyed by path, size and mtime, so an unchanged file is never opened again
+    def __init__(self, path):
+        self.file = os.path.join(path, INDEX_FILE)
+        self.entries = {}
+        self.modified = False
+        self.seen = set()
+        self.lock = threading.Lock()
+        try:
+            with open(self.file, "r") as f:
+                self.entries = json.load(f)
+        except Exception:
+            self.entries = {}
+
+    def get_stamp(self, file):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get_entry(self, file):
+        stamp = self.get_stamp(file)
+        if stamp == None:
+            return None
+        key = os.path.abspath(file)
+        self.seen.add(key)
+        entry = self.entries.get(key, None)
+        if entry == None or entry["stamp"] != stamp:
+            entry = {"stamp": stamp}
+            self.entries[key] = entry
+            self.modified = True
+        return entry
+
+    def get(self, file, field, compute):
+        with self.lock:
+            entry = self.get_entry(file)
+            if entry != None and field in entry:
+                return entry[field]
+        value = compute(file)
+        with self.lock:
+            if entry != None:
+                entry[field] = value
+                self.modified = True
+        return value
+
+    def begin_scan(self):
+        with self.lock:
+            self.seen = set()
+
+    def prune(self):
+        # entries the scan didnt come across, unless the file is still there (metadata of a checkpoint)
+        with self.lock:
+            for key in [k for k in self.entries if not k in self.seen and not os.path.exists(k)]:
+                del self.entries[key]
+                self.modified = True
+
+    def save(self):
+        with self.lock:
+            if not self.modified:
+                return
+            tmp = f"{self.file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.file)
+                self.modified = False
+            except Exception:
+                # read-only model folder, the index just lives in memory
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+class ModelWatcher():
+    # notices any change under the model folders with inotify, so a rescan only happens after one.
+    # linux only, elsewhere (or when out of watches) every scan goes ahead
+    def __init__(self, folders):
+        self.changed = True
+        self.watches = {}
+        self.fd = -1
+        self.closed = False
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        try:
+            for folder, recursive in folders:
+                self.watch(folder, recursive)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+        # written to on close, the thread then lets go of the inotify descriptor itself
+        self.wake, self.waker = os.pipe()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def watch(self, folder, recursive):
+        if not os.path.isdir(folder):
+            return
+        wd = self.inotify_add_watch(self.fd, os.fsencode(folder), IN_CHANGES)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"cannot watch {folder}")
+        self.watches[wd] = (folder, recursive)
+        if recursive:
+            for entry in os.scandir(folder):
+                if entry.is_dir(follow_symlinks=False):
+                    self.watch(entry.path, recursive)
+
+    def run(self):
+        while True:
+            readable, _, _ = select.select([self.fd, self.wake], [], [])
+            if self.wake in readable:
+                break
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0").decode("utf-8", "replace")
+                offset += EVENT.size + length
+
+                if name.startswith(INDEX_FILE):
+                    continue
+                self.changed = True
+
+                folder, recursive = self.watches.get(wd, (None, False))
+                if folder and recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.watch(os.path.join(folder, name), True)
+                    except OSError:
+                        pass
+        # closed here rather than in close, a read blocked on it would go on to whatever reuses the number
+        os.close(self.fd)
+        os.close(self.wake)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        os.write(self.waker, b"\0")
+        os.close(self.waker)
+
+    def check(self):
+        # cleared before the scan, a change during it is picked up by the next
+        changed = self.changed
+        self.changed = False
+        return changed
+
+def get_watcher(folders):
+    if not sys.platform.startswith("linux"):
+        print("SERVER: model watching needs inotify, only available on linux")
+        return None
+    try:
+        return ModelWatcher(folders)
+    except Exception as e:
+        print(f"SERVER: cannot watch the model folders ({e}), rescanning on every request")
+        return None
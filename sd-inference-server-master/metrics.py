@@ -0,0 +1,220 @@
+import os
+import sys
+import threading
+import http.server
+import torch
+
+import timing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# request types are labels, anything a client makes up is counted together
+REQUEST_TYPES = {"txt2img", "img2img", "options", "upscale", "convert", "manage", "annotate", "segmentation", "train_lora", "train_upload",
+                 "metadata", "cache_stats", "metrics", "download", "chunk", "ping"}
+
+# disconnected clients keep their series for a while, older ones are folded into a single "departed" series
+DEPARTED_SERIES = 32
+
+def get_rss():
+    # resident memory of this process, /proc is only on linux so elsewhere its the peak
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return 0
+
+def get_memory(device):
+    memory = {"rss": get_rss()}
+    # never the first to touch cuda, that would make a context just to report on it
+    if device != None and device.type == "cuda" and torch.cuda.is_initialized():
+        memory["vram_allocated"] = torch.cuda.memory_allocated(device)
+        memory["vram_reserved"] = torch.cuda.memory_reserved(device)
+    return memory
+
+class ServerMetrics():
+    # counted by the server as requests go through, only exists when the endpoint is enabled
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.rates = {}
+        self.sent = {}
+        self.departed = {}
+        self.sent_closed = 0
+
+    def on_request(self, type, outcome, seconds):
+        if not type in REQUEST_TYPES:
+            type = "other"
+        with self.lock:
+            self.requests[(type, outcome)] = self.requests.get((type, outcome), 0) + 1
+            if not type in self.durations:
+                self.durations[type] = timing.Metrics()
+        self.durations[type].observe("request", seconds)
+
+    def on_progress(self, worker, progress):
+        if progress.get("unit") == "it/s" and progress.get("rate"):
+            self.rates[worker] = progress["rate"]
+
+    def on_sent(self, client, size):
+        with self.lock:
+            if client in self.departed:
+                self.departed[client] += size
+            else:
+                self.sent[client] = self.sent.get(client, 0) + size
+
+    def on_disconnect(self, client):
+        # counters never go backwards, a series only stops growing and the oldest end up summed together
+        with self.lock:
+            if client in self.sent:
+                self.departed[client] = self.sent.pop(client)
+            while len(self.departed) > DEPARTED_SERIES:
+                oldest = next(iter(self.departed))
+                self.sent_closed += self.departed.pop(oldest)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Exposition():
+    # the prometheus text format, each metric written with its help and type once
+    def __init__(self):
+        self.lines = []
+        self.declared = set()
+
+    def sample(self, name, type, help, value, labels={}, suffix=""):
+        if not name in self.declared:
+            self.declared.add(name)
+            self.lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+        label = ",".join([f'{k}="{escape(v)}"' for k, v in labels.items()])
+        label = "{" + label + "}" if label else ""
+        self.lines += [f"{name}{suffix}{label} {float(value)!r}"]
+
+    def gauge(self, name, help, value, **labels):
+        self.sample(name, "gauge", help, value, labels)
+
+    def counter(self, name, help, value, **labels):
+        self.sample(name, "counter", help, value, labels)
+
+    def histogram(self, name, help, stats, **labels):
+        # timing.Metrics keeps counts per bucket, prometheus wants them cumulative
+        total = 0
+        for bound, count in stats["buckets"].items():
+            total += count
+            self.sample(name, "histogram", help, total, {**labels, "le": bound}, "_bucket")
+        self.sample(name, "histogram", help, stats["sum"], labels, "_sum")
+        self.sample(name, "histogram", help, stats["count"], labels, "_count")
+
+    def hit_rate(self, cache, stats, hits, misses, **labels):
+        hits = sum([stats.get(h, 0) for h in hits])
+        misses = sum([stats.get(m, 0) for m in misses])
+        self.counter("sd_cache_hits_total", "Cache hits", hits, cache=cache, **labels)
+        self.counter("sd_cache_misses_total", "Cache misses", misses, cache=cache, **labels)
+        if hits + misses:
+            self.gauge("sd_cache_hit_ratio", "Cache hits over all lookups", hits / (hits + misses), cache=cache, **labels)
+
+    def get_text(self):
+        return "\n".join(self.lines) + "\n"
+
+def collect(server):
+    out = Exposition()
+    stats = server.metrics
+
+    out.gauge("sd_clients", "Connected clients", len(server.clients))
+    for worker in server.workers:
+        out.gauge("sd_queue_depth", "Requests queued or running on a worker", worker.requests.unfinished_tasks, worker=worker.name)
+        if worker.name in stats.rates:
+            out.gauge("sd_iterations_per_second", "Denoising rate of the last step reported by a worker", stats.rates[worker.name], worker=worker.name)
+
+    with stats.lock:
+        requests = dict(stats.requests)
+        durations = dict(stats.durations)
+        sent = {**stats.departed, **stats.sent}
+        sent_closed = stats.sent_closed
+    for (type, outcome), count in sorted(requests.items()):
+        out.counter("sd_requests_total", "Requests handled by type and outcome", count, type=type, outcome=outcome)
+    for type, metrics in sorted(durations.items()):
+        for _, entry in metrics.get_stats().items():
+            out.histogram("sd_request_duration_seconds", "Time from a request starting on a worker to it finishing", entry, type=type)
+    for client, size in sorted(sent.items()):
+        out.counter("sd_client_sent_bytes_total", "Bytes sent to each client", size, client=client)
+    out.counter("sd_client_sent_bytes_total", "Bytes sent to each client", sent_closed, client="departed")
+    out.counter("sd_sent_bytes_total", "Bytes sent to all clients", sent_closed + sum(sent.values()))
+
+    # the wrappers, process wide parts are only reported once for each process
+    seen = set()
+    for worker in server.workers:
+        try:
+            worker_stats = worker.wrapper.get_stats()
+        except Exception:
+            continue
+        if worker_stats == None:
+            continue
+        name = worker.name
+
+        storage_stats = worker_stats["storage"]
+        for comp, count in storage_stats["loads"].items():
+            out.counter("sd_model_loads_total", "Models loaded from disk", count, worker=name, component=comp)
+        for comp, tiers in storage_stats["evictions"].items():
+            for tier, count in tiers.items():
+                out.counter("sd_model_evictions_total", "Models evicted from a tier to stay within its budget", count, worker=name, component=comp, tier=tier)
+        for tier in ["vram", "ram"]:
+            out.gauge("sd_model_cache_bytes", "Bytes of models cached in a tier", storage_stats[tier]["used"], worker=name, tier=tier)
+        out.hit_rate("prefetch", storage_stats["prefetch"], ["hits"], ["misses"], worker=name)
+
+        memory = worker_stats["memory"]
+        if "vram_allocated" in memory:
+            out.gauge("sd_vram_allocated_bytes", "VRAM allocated by tensors on a worker's device", memory["vram_allocated"], worker=name)
+            out.gauge("sd_vram_reserved_bytes", "VRAM reserved by the allocator on a worker's device", memory["vram_reserved"], worker=name)
+
+        if worker_stats["pid"] in seen:
+            continue
+        seen.add(worker_stats["pid"])
+
+        out.gauge("sd_process_resident_bytes", "Resident memory of a server or worker process", memory["rss"], worker=name)
+        out.hit_rate("results", worker_stats["results"], ["hits", "disk_hits"], ["misses"], worker=name)
+        out.hit_rate("encodings", worker_stats["encodings"], ["hits"], ["misses"], worker=name)
+        for stage, entry in sorted(worker_stats["timing"].items()):
+            out.histogram("sd_stage_seconds", "Time spent in each stage, step part and result delivery", entry, worker=name, stage=stage)
+
+    return out.get_text()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = collect(self.server.inference_server).encode("utf-8")
+        except Exception:
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Exporter():
+    # a plain http listener serving /metrics, everything is gathered when scraped
+    def __init__(self, server, host, port):
+        server.metrics = ServerMetrics()
+        for worker in server.workers:
+            worker.metrics = server.metrics
+
+        self.http = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        self.http.daemon_threads = True
+        self.http.inference_server = server
+        self.thread = threading.Thread(target=self.http.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"SERVER: metrics on http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.http.shutdown()
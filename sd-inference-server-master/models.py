@@ -10,6 +10,7 @@ from clip import CustomCLIP, CustomSDXLCLIP
 from diffusers import AutoencoderKL, UNet2DConditionModel
 from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.models.controlnet import ControlNetModel
+from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
 
 import accelerate
 import accelerate.utils.modeling
@@ -39,6 +40,8 @@ class UNET(UNet2DConditionModel):
         self.additional = None
 
     def __call__(self, *args, **kwargs):
+        feature_cache = kwargs.pop('feature_cache', None)
+
         if self.additional:
             if not 'added_cond_kwargs' in kwargs:
                 kwargs['added_cond_kwargs'] = {}
@@ -49,7 +52,60 @@ class UNET(UNet2DConditionModel):
                     kwargs['cross_attention_kwargs'][k] = v
                 del kwargs['added_cross_kwargs']
 
+        if feature_cache != None:
+            return self.call_cached(feature_cache, *args, **kwargs)
+
         return super().__call__(*args, **kwargs)
+
+    def call_cached(self, cache, sample, timestep, **kwargs):
+        # controlnet residuals go into every block, so those steps always run in full and the features are not kept
+        if kwargs.get('down_block_additional_residuals', None) != None or kwargs.get('mid_block_additional_residual', None) != None:
+            cache.features = None
+            return super().__call__(sample, timestep, **kwargs)
+
+        if not cache.refresh and cache.features != None and cache.features.shape[0] == sample.shape[0]:
+            return self.forward_shallow(cache.features, sample, timestep, **kwargs)
+
+        # a full pass, keeping what goes into the last up block
+        def keep(module, inputs, output):
+            cache.features = output
+        handle = self.up_blocks[-2].register_forward_hook(keep)
+        try:
+            return super().__call__(sample, timestep, **kwargs)
+        finally:
+            handle.remove()
+
+    def forward_shallow(self, features, sample, timestep, encoder_hidden_states, added_cond_kwargs=None, cross_attention_kwargs=None, **kwargs):
+        # only the first down block and last up block, the deep features in between come from the last full pass
+        t_emb = self.get_time_embed(sample=sample, timestep=timestep)
+        emb = self.time_embedding(t_emb, None)
+        aug_emb = self.get_aug_embed(emb=emb, encoder_hidden_states=encoder_hidden_states, added_cond_kwargs=added_cond_kwargs)
+        if aug_emb is not None:
+            emb = emb + aug_emb
+        if self.time_embed_act is not None:
+            emb = self.time_embed_act(emb)
+        encoder_hidden_states = self.process_encoder_hidden_states(encoder_hidden_states=encoder_hidden_states, added_cond_kwargs=added_cond_kwargs)
+
+        sample = self.conv_in(sample)
+
+        first, last = self.down_blocks[0], self.up_blocks[-1]
+        if getattr(first, "has_cross_attention", False):
+            _, res_samples = first(hidden_states=sample, temb=emb, encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs)
+        else:
+            _, res_samples = first(hidden_states=sample, temb=emb)
+        res_samples = ((sample,) + res_samples)[:len(last.resnets)]
+
+        if getattr(last, "has_cross_attention", False):
+            sample = last(hidden_states=features, temb=emb, res_hidden_states_tuple=res_samples, encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs)
+        else:
+            sample = last(hidden_states=features, temb=emb, res_hidden_states_tuple=res_samples)
+
+        if self.conv_norm_out:
+            sample = self.conv_norm_out(sample)
+            sample = self.conv_act(sample)
+        sample = self.conv_out(sample)
+
+        return UNet2DConditionOutput(sample=sample)
         
     @staticmethod
     def from_model(name, state_dict, dtype=None, device="cpu"):
@@ -211,9 +267,14 @@ class CLIP(torch.nn.Module):
         self.to(dtype)
         self.tokenizer = Tokenizer(model_type)
         self.additional = None
-        self.textual_inversions = []
+        self.textual_inversions = {}
 
     def encode(self, input_ids, clip_skip):
+        cond, emb = self.model([input_ids], clip_skip)
+        return cond, emb[0] if emb != None else None
+
+    def encode_batch(self, input_ids, clip_skip):
+        # a list of chunks, the outputs are stacked
         return self.model(input_ids, clip_skip)
     
     def state_dict(self):
@@ -228,6 +289,8 @@ class CLIP(torch.nn.Module):
     def __getattr__(self, name):
         if name == "device":
             return next(self.parameters()).device
+        if name == "dtype":
+            return next(self.parameters()).dtype
         return super().__getattr__(name)
 
     @staticmethod
@@ -283,11 +346,16 @@ class CLIP(torch.nn.Module):
         return config
 
     def set_textual_inversions(self, embeddings):
-        tokenized = []
-        for name, vec in embeddings.items():
-            name = tuple(self.tokenizer(name)["input_ids"][1:-1])
-            tokenized += [(name, vec)]
-        self.textual_inversions = tokenized
+        # a trie over the tokens of each activation, None marks where one ends
+        trie = {}
+        names = list(embeddings.keys())
+        tokenized = self.tokenizer(names)["input_ids"] if names else []
+        for name, tokens in zip(names, tokenized):
+            node = trie
+            for t in tokens[1:-1]:
+                node = node.setdefault(t, {})
+            node[None] = embeddings[name]
+        self.textual_inversions = trie
 
 class Tokenizer():
     def __init__(self, model_type):
@@ -331,6 +399,9 @@ class AdditionalNetworks():
         self.strength = {}
         self.strength_override = {}
 
+        # bumped whenever weights are changed in place, anything cached from the old weights is stale
+        self.version = 0
+
         self.model_type = "UNET" if type(model) == UNET else "CLIP"
 
     def clear(self):
@@ -357,6 +428,7 @@ class AdditionalNetworks():
             if net.net_name in self.attached_static:
                 return
             self.attached_static[net.net_name] = net
+            self.version += 1
             if self.model_type == "UNET":
                 net.merge_unet()
             elif self.model_type == "CLIP":
@@ -396,6 +468,8 @@ class AdditionalNetworks():
     def reset(self):
         for name, net in self.attached_static.items():
             net.reset()
+        if self.attached_static:
+            self.version += 1
         self.attached_static = {}
 
 class ControlNet(ControlNetModel):
@@ -1,5 +1,11 @@
 import lark
 import re
+import math
+import functools
+import itertools
+import threading
+import collections
+import bisect
 import torch
 
 class WeightedTree(lark.Tree):
@@ -31,97 +37,155 @@ filename: /([^<>:]|\\.)+/
 %import common.SIGNED_NUMBER -> NUMBER
 """, tree_class=WeightedTree)
 
-def parse_prompt(prompt, steps, HR=False):
-    if not prompt:
-        return [(steps, [["", 1.0]])]
+# schedule nodes, each switches between its two options at one step
+SCHEDULED = {"scheduled", "strength_schedule", "block_weight_schedule"}
 
-    def extract(tree, step, total, HR=False):
-        def triggered(specifier, step, total, HR):
-            if specifier == "HR":
-                return HR
-            
-            specifier = float(specifier)
-
-            comparison = step
-            if specifier < 1.0:
-                comparison = step/total
-            
-            return specifier < comparison
-        
-        def resolve_strength(node, step, total, HR):
-            strength = node.children[0]
-
-            if type(strength) == lark.Token:
-                if strength.type == "NUMBER":
-                    return float(strength)
-            else:
-                if strength.data in {"strength_schedule", "block_weight_schedule"}:
-                    specifier = strength.children[2].children[0]
-                    active = strength.children[1 if triggered(specifier, step, total, HR) else 0]
-                    return resolve_strength(active, step, total, HR)
-                elif strength.data == "block_weight":
-                    return [resolve_strength(c, step, total, HR) for c in strength.children]
-                else:
-                    print(strength)
-                        
-            return 1.0
-
-        def propagate(node, output, step, total, HR, weight):
-            if type(node) == WeightedTree:
-                node.weight = weight
-                children = node.children
-                if node.data == "emphasis": node.weight *= 1.1
-                if node.data == "deemphasis": node.weight /= 1.1
-                if node.data == "numeric":
-                    node.weight *= resolve_strength(node.children[1], step, total, HR)
-                    children = [node.children[0]]
-                if node.data == "scheduled":
-                    specifier = node.children[2].children[0]
-                    children = [node.children[1 if triggered(specifier, step, total, HR) else 0]]
-                if node.data == "alternate":
-                    children = [children[step%len(children)]]
-                if node.data == "addnet":
-                    local = False
-                    if children[0]:
-                        local = True
-                    children = children[1:]
-
-                    name = str(children[0].children[0]) + ":" + str(children[1].children[0])
-
-                    unet, clip = 1.0, None
-                    if children[2]:
-                        unet = resolve_strength(children[2], step, total, HR)
-                    if children[3]:
-                        clip = resolve_strength(children[3], step, total, HR)
-                    if clip == None:
-                        if type(unet) == list:
-                            clip = 1.0
-                        else:
-                            clip = unet
-
-                    output.append((name, unet, clip, local))
-                    children = []
-
-                for child in children:
-                    propagate(child, output, step, total, HR, node.weight)
-            elif node:
-                if output and type(output[-1]) == list and output[-1][1] == weight:
-                    output[-1][0] += str(node)
-                elif weight != 0.0:
-                    output.append([str(node), weight])
-        output = []
-        propagate(tree, output, step, total, HR, 1.0)
-        return output
+PARSE_CACHE_SIZE = 1024
 
-    tree = prompt_grammar.parse(prompt)
+def triggered(specifier, step, total, HR):
+    if specifier == "HR":
+        return HR
+    
+    specifier = float(specifier)
 
+    comparison = step
+    if specifier < 1.0:
+        comparison = step/total
+    
+    return specifier < comparison
+
+def get_transition(specifier, total, HR):
+    # the first step a specifier is triggered on, None if thats the same for every step
+    if specifier == "HR":
+        return None
+    value = float(specifier)
+    step = math.floor(value * total if value < 1.0 else value) + 1
+    step = min(max(step, 1), total + 1)
+    while step > 1 and triggered(specifier, step - 1, total, HR):
+        step -= 1
+    while step <= total and not triggered(specifier, step, total, HR):
+        step += 1
+    if step <= 1 or step > total:
+        return None
+    return step
+
+def get_boundaries(tree, total, HR):
+    boundaries = set()
+    for node in tree.iter_subtrees():
+        if node.data in SCHEDULED:
+            transition = get_transition(node.children[2].children[0], total, HR)
+            if transition:
+                boundaries.add(transition)
+    return boundaries
+
+def resolve_strength(node, step, total, HR):
+    strength = node.children[0]
+
+    if type(strength) == lark.Token:
+        if strength.type == "NUMBER":
+            return float(strength)
+    else:
+        if strength.data in {"strength_schedule", "block_weight_schedule"}:
+            specifier = strength.children[2].children[0]
+            active = strength.children[1 if triggered(specifier, step, total, HR) else 0]
+            return resolve_strength(active, step, total, HR)
+        elif strength.data == "block_weight":
+            return [resolve_strength(c, step, total, HR) for c in strength.children]
+        else:
+            print(strength)
+                
+    return 1.0
+
+def extract(tree, step, total, HR=False):
+    # the prompt at one step, and whether an alternation was part of it
+    alternating = False
+
+    def propagate(node, output, weight):
+        nonlocal alternating
+        if type(node) == WeightedTree:
+            node.weight = weight
+            children = node.children
+            if node.data == "emphasis": node.weight *= 1.1
+            if node.data == "deemphasis": node.weight /= 1.1
+            if node.data == "numeric":
+                node.weight *= resolve_strength(node.children[1], step, total, HR)
+                children = [node.children[0]]
+            if node.data == "scheduled":
+                specifier = node.children[2].children[0]
+                children = [node.children[1 if triggered(specifier, step, total, HR) else 0]]
+            if node.data == "alternate":
+                alternating = True
+                children = [children[step%len(children)]]
+            if node.data == "addnet":
+                local = False
+                if children[0]:
+                    local = True
+                children = children[1:]
+
+                name = str(children[0].children[0]) + ":" + str(children[1].children[0])
+
+                unet, clip = 1.0, None
+                if children[2]:
+                    unet = resolve_strength(children[2], step, total, HR)
+                if children[3]:
+                    clip = resolve_strength(children[3], step, total, HR)
+                if clip == None:
+                    if type(unet) == list:
+                        clip = 1.0
+                    else:
+                        clip = unet
+
+                output.append((name, unet, clip, local))
+                children = []
+
+            for child in children:
+                propagate(child, output, node.weight)
+        elif node:
+            if output and type(output[-1]) == list and output[-1][1] == weight:
+                output[-1][0] += str(node)
+            elif weight != 0.0:
+                output.append([str(node), weight])
+    output = []
+    propagate(tree, output, 1.0)
+    return output, alternating
+
+def get_schedules(tree, steps, HR=False, every_step=False):
     schedules = []
-    for step in range(steps, 0, -1):
-        scheduled = extract(tree, step, steps, HR)
+    def add(step, scheduled):
         if not schedules or tuple(schedules[-1][1]) != tuple(scheduled):
-            schedules += [(step, scheduled)]
-    schedules = schedules[::-1]
-    return schedules
+            schedules.append((step, scheduled))
+
+    if every_step:
+        for step in range(steps, 0, -1):
+            add(step, extract(tree, step, steps, HR)[0])
+        return schedules[::-1]
+
+    # the prompt only changes where a schedule triggers, between those one step stands for all of them.
+    # unless an alternation is in play, that changes every step
+    high = steps
+    for low in sorted(get_boundaries(tree, steps, HR), reverse=True) + [1]:
+        if high < 1:
+            break
+        scheduled, alternating = extract(tree, high, steps, HR)
+        add(high, scheduled)
+        if alternating:
+            for step in range(high - 1, low - 1, -1):
+                add(step, extract(tree, step, steps, HR)[0])
+        high = low - 1
+    return schedules[::-1]
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_cached(prompt, steps, HR):
+    tree = prompt_grammar.parse(prompt)
+    return get_schedules(tree, steps, HR)
+
+def parse_prompt(prompt, steps, HR=False):
+    if not prompt:
+        return [(steps, [["", 1.0]])]
+
+    # shared between requests, so copied before anyone gets to change it
+    schedules = parse_cached(prompt, steps, HR)
+    return [(step, [list(s) if type(s) == list else s for s in scheduled]) for step, scheduled in schedules]
 
 def tokenize_prompt(clip, parsed):
     tokenizer = clip.tokenizer
@@ -159,18 +223,27 @@ def tokenize_prompt(clip, parsed):
         weighted += [(t, weight) for t in tokens]
     tokenized = weighted
 
-    # add TI embeddings inline with the tokens (our CLIP handles these separately)
+    # add TI embeddings inline with the tokens (our CLIP handles these separately).
+    # walks the trie from each position, the longest activation found wins
+    inlined = []
     i = 0
     while i < len(tokenized):
-        for name, vector in clip.textual_inversions:
-            match = tuple([t for t,_ in tokenized[i:i+len(name)]])
-            if match == name:
-                weight = tokenized[i][1]
-                tokenized = tokenized[:i] + [(v, weight) for v in vector] + tokenized[i+len(name):]
-                i += vector.shape[0]
+        node = clip.textual_inversions
+        embedding, end = None, i
+        for j in range(i, len(tokenized)):
+            node = node.get(tokenized[j][0], None)
+            if node == None:
                 break
+            if None in node:
+                embedding, end = node[None], j + 1
+        if embedding:
+            weight = tokenized[i][1]
+            inlined += [(v, weight) for v in embedding()]
+            i = end
         else:
+            inlined += [tokenized[i]]
             i += 1
+    tokenized = inlined
 
     # split tokens into chunks
     chunks = []
@@ -196,36 +269,143 @@ def tokenize_prompt(clip, parsed):
     
     return chunks
 
-def encode_tokens(clip, chunks, clip_skip=1):
-    tokenizer = clip.tokenizer
-
-    start_token = tokenizer.bos_token_id
-    end_token = tokenizer.eos_token_id
-    padding_token = tokenizer.pad_token_id
-
+DEFAULT_ENCODING_CACHE = 64*1024**2
+
+# chunks per CLIP forward
+ENCODE_BATCH = 16
+
+CLIP_IDS = itertools.count()
+
+class EncodingCache():
+    # CLIP outputs of chunks already encoded, shared between requests. a negative prompt used by every
+    # request is only encoded once. least recently used first out once over the size, kept in RAM
+    def __init__(self, size=DEFAULT_ENCODING_CACHE):
+        self.size = size
+        self.used = 0
+        self.entries = collections.OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get_size(self, value):
+        return sum([t.numel() * t.element_size() for t in value if t != None])
+
+    def invalidate(self, clip_id, version):
+        # the CLIPs weights were changed in place or cast, whatever was encoded before cant be hit again
+        if self.versions.get(clip_id, version) != version:
+            for key in [k for k in self.entries if k[0] == clip_id]:
+                self.used -= self.get_size(self.entries.pop(key))
+        self.versions[clip_id] = version
+
+    def get(self, key):
+        with self.lock:
+            self.invalidate(key[0], key[1])
+            value = self.entries.get(key, None)
+            if value == None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        size = self.get_size(value)
+        if size > self.size:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.used += size
+            while self.used > self.size:
+                _, evicted = self.entries.popitem(last=False)
+                self.used -= self.get_size(evicted)
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "entries": len(self.entries), "used": self.used, "size": self.size}
+
+ENCODING_CACHE = EncodingCache()
+
+def configure_cache(size=DEFAULT_ENCODING_CACHE):
+    global ENCODING_CACHE
+    ENCODING_CACHE = EncodingCache(size)
+
+def get_token_key(token):
+    if type(token) == int:
+        return token
+    # a TI vector
+    return (tuple(token.shape), token.detach().float().cpu().numpy().tobytes())
+
+def get_cache_base(clip, clip_skip):
+    # everything besides the tokens that changes what CLIP outputs
+    if not ENCODING_CACHE.size or clip.additional == None:
+        return None
+    if not "cache_id" in clip.__dict__:
+        clip.cache_id = next(CLIP_IDS)
+    additional = clip.additional
+    dynamic = tuple(sorted([(name, repr(additional.get_strength(name))) for name in additional.attached_dynamic]))
+    # the dtype is part of the version, casting the CLIP drops what it encoded at the old precision
+    return (clip.cache_id, (additional.version, clip.dtype), str(clip.device), dynamic, clip_skip)
+
+def prepare_chunk(tokenizer, chunk):
+    # add special tokens and padding
+    start = [(tokenizer.bos_token_id, 1.0)]
+    end = [(tokenizer.eos_token_id, 1.0)]
+    padding = [(tokenizer.pad_token_id, 1.0)] * (75-len(chunk))
+    chunk = start + chunk + end + padding
+
+    tokens, weights = list(zip(*chunk))
+    return tokens, weights
+
+def encode_chunks(clip, chunks, clip_skip=1):
+    # CLIP outputs for many chunks of tokens. identical chunks are encoded once, cached ones not at all,
+    # the rest together in batches
+    cache = ENCODING_CACHE
+    base = get_cache_base(clip, clip_skip)
+
+    keys = [tuple([get_token_key(t) for t in tokens]) for tokens in chunks]
+    unique = {}
+    for key, tokens in zip(keys, chunks):
+        unique[key] = tokens
+
+    outputs = {}
+    missing = []
+    for key in unique:
+        value = cache.get(base + (key,)) if base else None
+        if value == None:
+            missing += [key]
+            continue
+        encoding, pooled_text_emb = value
+        if pooled_text_emb != None:
+            pooled_text_emb = pooled_text_emb.to(clip.device)
+        outputs[key] = (encoding.to(clip.device), pooled_text_emb)
+
+    for i in range(0, len(missing), ENCODE_BATCH):
+        batch = missing[i:i+ENCODE_BATCH]
+        encodings, pooled_text_embs = clip.encode_batch([unique[key] for key in batch], clip_skip)
+        for j, key in enumerate(batch):
+            encoding = encodings[j:j+1]
+            pooled_text_emb = pooled_text_embs[j] if pooled_text_embs != None else None
+            outputs[key] = (encoding, pooled_text_emb)
+            if base:
+                # copied so the cache doesnt keep the whole batch alive
+                cache.put(base + (key,), (encoding.to("cpu", copy=True), pooled_text_emb.to("cpu", copy=True) if pooled_text_emb != None else None))
+
+    return [outputs[key] for key in keys]
+
+def weight_chunks(clip, chunks, outputs):
     chunk_encodings = []
     chunk_inversions = []
     pooled_text_embs = []
 
-    for chunk in chunks:
-        # add special tokens and padding
-        start = [(start_token, 1.0)]
-        end = [(end_token, 1.0)]
-        padding = [(padding_token, 1.0)] * (75-len(chunk))
-        chunk = start + chunk + end + padding
-
-        tokens, weights = list(zip(*chunk))
-
-        # encode chunk tokens
-        encoding, pooled_text_emb = clip.encode(tokens, clip_skip)
-        
+    for (_, weights), (encoding, pooled_text_emb) in zip(chunks, outputs):
         # each token has been encoded into its own tensor
         # we weight this tensor with the tokens weight
         
         inverted = [i for i in range(len(weights)) if weights[i] < 0]
         weights = torch.tensor([abs(w) for w in weights], device=clip.device)
         weights = weights.reshape(weights.shape + (1,)).expand(encoding.shape)
-        
 
         # keep the mean the same, lets the weighting operation work somewhat
         # dont normalize small means to avoid fp issues
@@ -255,6 +435,29 @@ def encode_tokens(clip, chunks, clip_skip=1):
     
     return encoding, pooled_text_emb, inversions
 
+def encode_tokens(clip, chunks, clip_skip=1):
+    chunks = [prepare_chunk(clip.tokenizer, chunk) for chunk in chunks]
+    outputs = encode_chunks(clip, [tokens for tokens, _ in chunks], clip_skip)
+    return weight_chunks(clip, chunks, outputs)
+
+def encode_schedules(clip, schedules, clip_skip):
+    # every chunk of every segment of every prompt in as few forwards as possible.
+    # prompts only share a forward when their networks are at the same strengths
+    groups = {}
+    for p in schedules:
+        networks = p.get_clip_networks()
+        key = repr(sorted(networks.items()))
+        if not key in groups:
+            groups[key] = (networks, [])
+        groups[key][1].append(p)
+
+    for networks, group in groups.values():
+        clip.additional.set_strength([networks])
+        chunks = [c for p in group for c in p.get_chunks(clip)]
+        outputs = iter(encode_chunks(clip, [tokens for tokens, _ in chunks], clip_skip))
+        for p in group:
+            p.encode(clip, outputs)
+
 def seperate_schedule(schedule):
     prompt_schedule = []
     networks_schedule = []
@@ -276,6 +479,9 @@ class PromptSchedule():
         prompt, self.weight = self.get_weight(prompt)
         self.schedule = parse_prompt(prompt, steps, HR)
         self.schedule, self.network_schedule = seperate_schedule(self.schedule)
+        # segments with the same prompt encode the same, alternations keep coming back to a few of them
+        prompts = [repr(p) for _, p in self.schedule]
+        self.segment_ids = [prompts.index(p) for p in prompts]
         self.encoded = None
         self.pooled_text_embs = None
         self.all_networks = {}
@@ -296,10 +502,24 @@ class PromptSchedule():
         self.tokenized = [(steps, tokenize_prompt(clip, prompt)) for steps, prompt in self.schedule]
         self.chunks = max(len(p) for _, p in self.tokenized)
 
-    def encode(self, clip, clip_skip):
-        clip_networks = [self.parent.get_networks_at_step(0,1)[self.index]]
-        clip.additional.set_strength(clip_networks)
-        self.encoded = [(steps, *encode_tokens(clip, chunks, clip_skip)) for steps, chunks in self.tokenized]
+    def get_clip_networks(self):
+        return self.parent.get_networks_at_step(0,1)[self.index]
+
+    def get_chunks(self, clip):
+        self.prepared = [[prepare_chunk(clip.tokenizer, c) for c in chunks] for _, chunks in self.tokenized]
+        return [c for chunks in self.prepared for c in chunks]
+
+    def encode(self, clip, outputs):
+        # outputs of get_chunks, in the same order
+        self.encoded = []
+        for (steps, _), chunks in zip(self.tokenized, self.prepared):
+            self.encoded += [(steps, *weight_chunks(clip, chunks, [next(outputs) for _ in chunks]))]
+
+    def get_segment_at_step(self, step):
+        for i, (start, _) in enumerate(self.schedule):
+            if start >= step:
+                return self.segment_ids[i]
+        return self.segment_ids[-1]
 
     def get_encoding_at_step(self, step):
         for start, encoding, _, _ in self.encoded:
@@ -370,12 +590,13 @@ class ConditioningSchedule():
         for p in self.positives + self.negatives:
             p.pad_to_length(max_chunks)
 
-    def encode(self, clip, areas):
+    def prepare(self, clip, areas):
         self.areas = areas
         self.model_type = clip.model_type
 
-        for p in self.positives + self.negatives:
-            p.encode(clip, self.clip_skip)
+    def encode(self, clip, areas):
+        self.prepare(clip, areas)
+        encode_schedules(clip, self.positives + self.negatives, self.clip_skip)
 
     def get_all_networks(self):
         networks = self.get_networks_at_step(0)
@@ -485,9 +706,12 @@ class BatchedConditioningSchedules():
         for b in self.batches:
             b.pad_to_length(max_chunks)
         
+        schedules = []
         for i, b in enumerate(self.batches):
             a = areas[i] if i < len(areas) else []
-            b.encode(clip, a)
+            b.prepare(clip, a)
+            schedules += b.positives + b.negatives
+        encode_schedules(clip, schedules, self.clip_skip)
     
     def get_all_networks(self, hr_steps=None):
         current_networks = set()
@@ -558,4 +782,44 @@ class BatchedConditioningSchedules():
         compositions = []
         for b in self.batches:
             compositions += [b.get_composition(dtype, device)]
-        return compositions
\ No newline at end of file
+        return compositions
+
+    def get_boundaries(self):
+        # the steps anything changes at
+        starts = set()
+        for b in self.batches:
+            for p in b.positives + b.negatives:
+                starts.update([s for s, _ in p.schedule] + [s for s, _ in p.network_schedule])
+        return sorted(starts) or [0]
+
+    def get_segments_at_step(self, step):
+        return tuple([p.get_segment_at_step(step) for b in self.batches for p in b.positives + b.negatives])
+
+    def compile(self, dtype, device):
+        return ConditioningTimeline(self, dtype, device)
+
+class ConditioningTimeline():
+    # everything set_step needs for every step, worked out once and kept on the device.
+    # steps up to the same boundary are identical, and identical entries are only kept once
+    def __init__(self, schedule, dtype, device):
+        self.boundaries = schedule.get_boundaries()
+        self.entries = []
+        self.indices = []
+
+        unique = {}
+        for step in self.boundaries + [self.boundaries[-1] + 1]:
+            networks = schedule.get_networks_at_step(step)
+            key = (schedule.get_segments_at_step(step), repr(networks))
+            if not key in unique:
+                unique[key] = len(self.entries)
+                self.entries += [(
+                    schedule.get_conditioning_at_step(step, dtype, device),
+                    schedule.get_additional_conditioning_at_step(step, dtype, device),
+                    schedule.get_additional_attention_kwargs_at_step(step),
+                    networks
+                )]
+            self.indices += [unique[key]]
+
+    def get_index(self, step):
+        # the first boundary at or after the step, past all of them is the extra entry at the end
+        return self.indices[bisect.bisect_left(self.boundaries, step)]
\ No newline at end of file
@@ -0,0 +1,185 @@
+import os
+import re
+import stat
+import time
+import tempfile
+import threading
+import bson
+
+DEFAULT_BUDGET = 256*1024**2
+DEFAULT_DISK_BUDGET = 4*1024**3
+DEFAULT_TTL = 30*60
+
+STORE = None
+
+# only files named like this are ever deleted from the folder
+RESULT_FILE = re.compile(r"^\d+-\d+\.result$")
+
+def get_default_folder():
+    # one per user, spilled results are other clients' images
+    name = "sd-inference-server-results"
+    if hasattr(os, "getuid"):
+        name += f"-{os.getuid()}"
+    return os.path.join(tempfile.gettempdir(), name)
+
+def is_private(folder):
+    # a real folder of ours that nobody else can read, anyone could have made the predictable one first
+    if not hasattr(os, "getuid"):
+        return True
+    info = os.lstat(folder)
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+def make_default_folder():
+    folder = get_default_folder()
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if not is_private(folder):
+        folder = tempfile.mkdtemp(prefix="sd-inference-server-results-")
+    return folder
+
+class ResultStore():
+    # delay_fetch results waiting for their fetch, kept already encoded so a fetch just sends the bytes.
+    # the newest stay in memory up to a budget, older ones are spilled to disk, anything past its ttl is dropped
+    def __init__(self, budget=DEFAULT_BUDGET, ttl=DEFAULT_TTL, folder=None, disk_budget=DEFAULT_DISK_BUDGET):
+        self.budget = budget
+        self.ttl = ttl
+        self.folder = folder or make_default_folder()
+        self.disk_budget = disk_budget
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "spilled": 0, "expired": 0, "evicted": 0}
+        os.makedirs(self.folder, exist_ok=True)
+        self.clean()
+
+    def clean(self):
+        # spilled results left behind by a previous run
+        now = time.time()
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if RESULT_FILE.match(name) and os.lstat(path).st_mtime + self.ttl < now:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get_path(self, id):
+        return os.path.join(self.folder, f"{os.getpid()}-{id}.result")
+
+    def get_usage(self, tier):
+        return sum([e["size"] for e in self.entries.values() if e["tier"] == tier])
+
+    def __contains__(self, id):
+        with self.lock:
+            return id in self.entries
+
+    def remove(self, id):
+        entry = self.entries.pop(id)
+        if entry["tier"] == "disk":
+            try:
+                os.remove(self.get_path(id))
+            except OSError:
+                pass
+        return entry
+
+    def expire(self):
+        now = time.time()
+        for id in [id for id, e in self.entries.items() if e["time"] + self.ttl < now]:
+            self.remove(id)
+            self.stats["expired"] += 1
+
+    def spill(self, id):
+        entry = self.entries[id]
+        path = self.get_path(id)
+        try:
+            with open(path, "wb") as f:
+                f.write(bson.dumps({"images": entry["images"], "metadata": entry["metadata"], "type": entry["type"]}))
+        except Exception:
+            # most likely out of space, nothing left to do but drop it
+            if os.path.exists(path):
+                os.remove(path)
+            self.remove(id)
+            self.stats["evicted"] += 1
+            return
+        entry["tier"] = "disk"
+        entry["images"] = None
+        entry["metadata"] = None
+        self.stats["spilled"] += 1
+
+    def read(self, id):
+        with open(self.get_path(id), "rb") as f:
+            result = bson.loads(f.read())
+        return result["images"], result["metadata"], result["type"]
+
+    def enforce_budget(self):
+        # oldest first, out of memory onto disk then off disk entirely
+        oldest = sorted(self.entries, key=lambda id: self.entries[id]["time"])
+        memory, disk = self.get_usage("memory"), self.get_usage("disk")
+        for id in oldest:
+            if memory <= self.budget:
+                break
+            entry = self.entries[id]
+            if entry["tier"] == "memory":
+                memory -= entry["size"]
+                self.spill(id)
+                if id in self.entries:
+                    disk += entry["size"]
+        for id in oldest:
+            if disk <= self.disk_budget:
+                break
+            entry = self.entries.get(id)
+            if entry and entry["tier"] == "disk":
+                disk -= entry["size"]
+                self.remove(id)
+                self.stats["evicted"] += 1
+
+    def put(self, id, images, metadata, type):
+        with self.lock:
+            self.expire()
+            self.entries[id] = {"time": time.time(), "size": sum([len(i) for i in images]), "tier": "memory",
+                                "images": images, "metadata": metadata, "type": type}
+            self.enforce_budget()
+
+    def get(self, id):
+        # each result is fetched once
+        with self.lock:
+            self.expire()
+            if not id in self.entries:
+                self.stats["misses"] += 1
+                return None
+            entry = self.entries[id]
+            if entry["tier"] == "memory":
+                self.stats["hits"] += 1
+                self.remove(id)
+                return entry["images"], entry["metadata"], entry["type"]
+            try:
+                result = self.read(id)
+            except Exception:
+                result = None
+            self.remove(id)
+            if result == None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            return result
+
+    def get_stats(self):
+        with self.lock:
+            self.expire()
+            served = self.stats["hits"] + self.stats["disk_hits"]
+            requested = served + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "memory": {"used": self.get_usage("memory"), "budget": self.budget},
+                "disk": {"used": self.get_usage("disk"), "budget": self.disk_budget},
+                "ttl": self.ttl,
+                "hit_rate": served / requested if requested else 0
+            }
+
+def configure(budget=DEFAULT_BUDGET, ttl=DEFAULT_TTL, folder=None, disk_budget=DEFAULT_DISK_BUDGET):
+    global STORE
+    STORE = ResultStore(budget, ttl, folder, disk_budget)
+
+def get_store():
+    if STORE == None:
+        configure()
+    return STORE
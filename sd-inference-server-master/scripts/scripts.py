@@ -5,8 +5,10 @@ import threading
 import websockets.sync.client
 import websockets.exceptions
 import secrets
+import base64
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidTag
 import bson
@@ -15,17 +17,42 @@ import PIL.Image
 DEFAULT_PASSWORD = "qDiffusion"
 FRAGMENT_SIZE = 524288
 
+HANDSHAKE = "SDIS/1 "
+HANDSHAKE_FULL, HANDSHAKE_RESUMED, HANDSHAKE_PLAIN = 0, 1, 2
+
+# results of these are streamed, a header then one binary frame per image
+STREAMED = {"txt2img", "img2img", "upscale"}
+STREAM_FRAME = b"\x00\x00\x00\x00"
+
+# password keys are slow to derive, only do it once per password. tickets let a reconnect skip it entirely
+KEYS = {}
+TICKETS = {}
+
+def get_key(password):
+    if not password in KEYS:
+        data = password.encode("utf8")
+        h = hashes.Hash(hashes.SHA256())
+        h.update(data)
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=h.finalize()[:16],
+            iterations=480000,
+        )
+        KEYS[password] = kdf.derive(data)
+    return KEYS[password]
+
 def get_scheme(password):
-    password = password.encode("utf8")
-    h = hashes.Hash(hashes.SHA256())
-    h.update(password)
-    kdf = PBKDF2HMAC(
+    return AESGCM(get_key(password))
+
+def get_session_key(key, client_nonce, server_nonce, info=b"session"):
+    kdf = HKDF(
         algorithm=hashes.SHA256(),
         length=32,
-        salt=h.finalize()[:16],
-        iterations=480000,
+        salt=client_nonce + server_nonce,
+        info=info,
     )
-    return AESGCM(kdf.derive(password))
+    return kdf.derive(key)
 
 def encrypt(scheme, obj):
     data = bson.dumps(obj)
@@ -37,6 +64,10 @@ def encrypt(scheme, obj):
 def decrypt(scheme, data):
     if scheme:
         data = scheme.decrypt(data[:16], data[16:], b"")
+    if data.startswith(STREAM_FRAME):
+        id = int.from_bytes(data[4:12], "little", signed=True)
+        index = int.from_bytes(data[12:16], "little")
+        return {"type": "result_image", "id": id, "data": {"index": index, "image": data[16:]}}
     obj = bson.loads(data)
     return obj
 
@@ -58,6 +89,10 @@ class Connection():
         self.thread = threading.Thread(target=self.run, daemon=True)
 
         self.scheme = None
+        self.key = None
+        self.streams = {}
+        # only a server without a password may answer in plain, otherwise its someone in between downgrading us
+        self.plain = not password
         if not password:
             password = "qDiffusion"
         self.password = password
@@ -80,11 +115,46 @@ class Connection():
         if self.stopping:
             return
         if self.client:
+            try:
+                self.handshake()
+            except Exception as e:
+                self.on_response({"type": "remote_error", "data": {"message": f"Handshake failed: {e}"}})
+                self.client.close()
+                self.client = None
+                return
             self.on_response({"type": "status", "data": {"message": "Connected"}})
             self.requests.put({"type":"options"})
 
+    def handshake(self):
+        client_nonce = secrets.token_bytes(16)
+        secret, ticket = TICKETS.get(self.endpoint, (None, b""))
+        self.client.send(HANDSHAKE + base64.b64encode(client_nonce + ticket).decode("ascii"))
+
+        # hello and owner are sent on connecting, before the reply and under the password key
+        early = []
+        reply = self.client.recv()
+        while type(reply) != str:
+            early += [reply]
+            reply = self.client.recv()
+        if not reply.startswith(HANDSHAKE):
+            raise Exception("unexpected reply")
+        reply = base64.b64decode(reply[len(HANDSHAKE):])
+        server_nonce, status = reply[:16], reply[16]
+
+        if status == HANDSHAKE_PLAIN:
+            if not self.plain:
+                raise Exception("server refused encryption")
+            self.key, self.scheme = None, None
+        else:
+            key = secret if status == HANDSHAKE_RESUMED else get_key(self.password)
+            self.key = get_session_key(key, client_nonce, server_nonce)
+            self.scheme = AESGCM(self.key)
+
+        legacy = None if status == HANDSHAKE_PLAIN else get_scheme(self.password)
+        for data in early:
+            self.on_response(decrypt(legacy, data))
+
     def run(self):
-        self.scheme = get_scheme(self.password)
         self.connect()
         while self.client and not self.stopping:
             try:
@@ -92,6 +162,16 @@ class Connection():
                     try:
                         data = self.client.recv(0)
                         response = decrypt(self.scheme, data)
+                        if response["type"] == "session":
+                            TICKETS[self.endpoint] = (get_session_key(self.key, b"", b"", b"resume"), response["data"]["ticket"])
+                            continue
+                        if response["type"] == "result" and response["data"].get("stream"):
+                            response["data"]["images"] = [None] * response["data"]["count"]
+                            self.streams[response["id"]] = response
+                            continue
+                        if response["type"] == "result_image":
+                            self.on_stream(response)
+                            continue
                         self.on_response(response)
                     except TimeoutError:
                         break
@@ -123,8 +203,23 @@ class Connection():
         self.stopping = True
 
     def on_request(self, request):
+        if request.get("type") in STREAMED:
+            request["data"]["stream"] = True
         self.requests.put(request)
 
+    def on_stream(self, frame):
+        # put the result back together, its passed on once the last image arrives
+        result = self.streams.get(frame["id"])
+        if not result:
+            return
+        images = result["data"]["images"]
+        images[frame["data"]["index"]] = frame["data"]["image"]
+        if all([i != None for i in images]):
+            del self.streams[frame["id"]]
+            del result["data"]["count"]
+            del result["data"]["stream"]
+            self.on_response(result)
+
     def on_response(self, response):
         self.responses.put(response)
 
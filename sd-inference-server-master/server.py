@@ -6,6 +6,8 @@ import torch
 import sys
 import datetime
 import argparse
+import heapq
+import itertools
 
 import threading
 import queue
@@ -17,11 +19,20 @@ import time
 import storage
 import wrapper
 import utils
+import batching
 import download_manager
+import shared
+import worker
+import encoder
+import results
+import prompts
+import metrics
 
 import secrets
+import base64
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidTag
 
@@ -29,8 +40,28 @@ import random
 
 DEFAULT_PASSWORD = "qDiffusion"
 FRAGMENT_SIZE = 1048576
+KEEPALIVE_INTERVAL = 2
+
+# clients open with a handshake to get a session key, clients that dont use the password key throughout.
+# its a text frame, legacy clients only ever send binary ones
+HANDSHAKE = "SDIS/1 "
+HANDSHAKE_FULL, HANDSHAKE_RESUMED, HANDSHAKE_PLAIN = 0, 1, 2
+TICKET_LIFETIME = 24*60*60
+
+# streamed result images go out as binary frames, a bson document never starts with a zero length
+STREAM_FRAME = b"\x00\x00\x00\x00"
 UPLOAD_IDS = {}
 
+# requests that can run on any worker in a pool, everything else keeps to the primary worker
+ROUTED = {"txt2img", "img2img", "upscale", "annotate", "segmentation"}
+
+# requests whose checkpoint is read ahead while the request before them runs
+PREFETCHED = {"txt2img", "img2img"}
+
+# lower runs first, anything not listed waits behind these
+REQUEST_PRIORITY = {"stop": -1, "ping": 0, "options": 0, "metadata": 0, "cache_stats": 0, "metrics": 0, "annotate": 0}
+DEFAULT_PRIORITY = 1
+
 def log_traceback(label):
     exc_type, exc_value, exc_tb = sys.exc_info()
     tb = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
@@ -39,7 +70,25 @@ def log_traceback(label):
     print(label, tb)
     return tb
 
-def get_scheme(password):
+def get_models(request):
+    data = request.get("data") or {}
+    model = data.get("model")
+    models = {}
+    for comp in ["UNET", "CLIP", "VAE"]:
+        name = data.get(comp.lower()) or model
+        if type(name) == str:
+            models[comp] = name
+    return models
+
+def get_location(e):
+    s = traceback.extract_tb(e.__traceback__).format()
+    s = [e for e in s if not "venv" in e][-1]
+    s = s.split(", ")
+    file = s[0].split(os.path.sep)[-1][:-1]
+    line = s[1].split(" ")[1]
+    return f" ({file}:{line})"
+
+def get_key(password):
     password = password.encode("utf8")
     h = hashes.Hash(hashes.SHA256())
     h.update(password)
@@ -49,7 +98,19 @@ def get_scheme(password):
         salt=h.finalize()[:16],
         iterations=480000,
     )
-    return AESGCM(kdf.derive(password))
+    return kdf.derive(password)
+
+def get_scheme(password):
+    return AESGCM(get_key(password))
+
+def get_session_key(key, client_nonce, server_nonce, info=b"session"):
+    kdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=client_nonce + server_nonce,
+        info=info,
+    )
+    return kdf.derive(key)
 
 def encrypt(scheme, data):
     if scheme:
@@ -62,6 +123,17 @@ def decrypt(scheme, data):
         data = scheme.decrypt(data[:16], data[16:], b"")
     return data
 
+def is_frame_id(id):
+    # streamed images carry their request id as 8 bytes, other ids only get whole results
+    return type(id) == int and -2**63 <= id < 2**63
+
+def get_frame(id, index, data):
+    return STREAM_FRAME + id.to_bytes(8, "little", signed=True) + index.to_bytes(4, "little") + data
+
+def get_fragments(data):
+    view = memoryview(data)
+    return [view[i:min(i+FRAGMENT_SIZE,len(data))] for i in range(0, len(data), FRAGMENT_SIZE)]
+
 def get_id():
     return random.SystemRandom().randint(1, 2**31 - 1)
 
@@ -222,41 +294,158 @@ def do_download(request, folder, id, callback):
     thread = threading.Thread(target=execute_download)
     thread.start()
 
+class RequestQueue(queue.Queue):
+    # cheap requests jump ahead of other clients long running ones, otherwise requests are first in first out
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        if item == None:
+            priority = REQUEST_PRIORITY["stop"]
+        else:
+            priority = REQUEST_PRIORITY.get(item[2]["type"], DEFAULT_PRIORITY)
+            # never ahead of the clients own earlier requests, an options after a manage has to see the change
+            for entry in self.queue:
+                if entry[-1] != None and entry[-1][0] == item[0]:
+                    priority = max(priority, entry[0])
+        heapq.heappush(self.queue, (priority, next(self.counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+    def peek(self, accept):
+        # the next request accepted by accept that would run, left in the queue
+        with self.mutex:
+            for entry in sorted(self.queue, key=lambda e: e[:2]):
+                if entry[-1] != None and accept(entry[-1]):
+                    return entry[-1]
+        return None
+
+    def position(self, item):
+        # how many requests run before this one, including any running now
+        with self.mutex:
+            running = self.unfinished_tasks - len(self.queue)
+            for entry in self.queue:
+                if entry[-1] is item:
+                    return running + sum([1 for e in self.queue if e[:2] < entry[:2]])
+        return 0
+
+    def take(self, accept, full, timeout=0):
+        # remove queued requests accepted by accept, waiting up to timeout seconds for more unless full.
+        # a request isnt taken past one from the same client that wasnt
+        taken = []
+        deadline = time.monotonic() + timeout
+        with self.not_empty:
+            while True:
+                blocked = set()
+                for entry in sorted(self.queue, key=lambda e: e[:2]):
+                    if entry[-1] == None:
+                        continue
+                    try:
+                        accepted = not entry[-1][0] in blocked and accept(entry[-1])
+                    except Exception:
+                        accepted = False
+                    if not accepted:
+                        blocked.add(entry[-1][0])
+                        continue
+                    self.queue.remove(entry)
+                    taken += [entry[-1]]
+                heapq.heapify(self.queue)
+                remaining = deadline - time.monotonic()
+                if full() or remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+        return taken
+
 class Inference(threading.Thread):
-    def __init__(self, wrapper, read_only, public, callback):
+    def __init__(self, wrapper, read_only, public, callback, max_batch=1, batch_window=0):
         super().__init__(daemon=True)
         
         self.wrapper = wrapper
         wrapper.callback = self.got_response
+        # remote wrappers flush their own encoders before returning
+        self.encoder = getattr(wrapper, "encoder", None)
 
         self.callback = callback
-        self.requests = queue.Queue()
+        self.requests = RequestQueue()
+        self.batcher = batching.Batcher(self.requests, max_batch, batch_window)
         self.current = None
+        self.models = {}
 
         self.read_only = read_only
         self.public = public
         self.owner = None
 
-        self.stay_alive = True
+        self.name = None
+        self.assigned = {}
+        self.metrics = None
 
     def got_response(self, response, id=None):
         if id == None:
             id = self.current
+        if self.metrics and response["type"] == "progress":
+            self.metrics.on_progress(self.name, response["data"])
+        if type(id) == list:
+            # merged requests share everything the wrapper doesnt split between them
+            return any([self.callback(i, response.copy()) for i in id])
         return self.callback(id, response)
 
+    def stop(self):
+        self.requests.put(None)
+
+    def prefetch(self):
+        # start reading the checkpoint of the next queued request, keeping what the current one is about to use
+        item = self.requests.peek(lambda item: item[2]["type"] in PREFETCHED)
+        if item == None:
+            return
+        models = {comp: convert_path(name) for comp, name in get_models(item[2]).items()}
+        self.wrapper.storage.prefetch(models, self.models)
+
     def run(self):
-        while self.stay_alive:
+        while True:
+            item = self.requests.get()
+            if item == None:
+                self.requests.task_done()
+                break
+            batch = [item]
+            start = time.perf_counter()
+            outcome = "success"
             try:
-                client, self.current, request = self.requests.get(False)
+                client, self.current, request = item
                 convert_all_paths(request)
+                if type(request.get("data")) == dict:
+                    # only ever set by the batching scheduler, a client could send its results to other requests
+                    request["data"].pop("batch_groups", None)
+                self.wrapper.set_request(self.current)
 
                 read_only = self.read_only and client != self.owner
                 if read_only and request["type"] in {"convert", "manage", "download", "chunk"}:
                     raise Exception("Read-only")
 
+                if request["type"] == "txt2img":
+                    batch = self.batcher.collect(item)
+                    if len(batch) > 1:
+                        # before anything can fail, so every merged request hears how it went
+                        self.current = [id for _, id, _ in batch]
+                        self.wrapper.set_request(self.current)
+
+                if request["type"] in PREFETCHED:
+                    self.models = get_models(request)
+                    self.prefetch()
+
                 if request["type"] == "txt2img":
                     self.wrapper.reset()
-                    self.wrapper.set(**request["data"])
+                    if len(batch) > 1:
+                        for _, _, r in batch[1:]:
+                            convert_all_paths(r)
+                        data, groups = batching.merge_requests(batch)
+                        self.wrapper.set(batch_groups=groups, **data)
+                    else:
+                        self.wrapper.set(**request["data"])
                     self.wrapper.txt2img()
                 elif request["type"] == "img2img":
                     self.wrapper.reset()
@@ -290,17 +479,18 @@ class Inference(threading.Thread):
                 elif request["type"] == "metadata":
                     self.wrapper.set(**request["data"])
                     self.wrapper.metadata()
+                elif request["type"] == "cache_stats":
+                    self.wrapper.cache_stats()
+                elif request["type"] == "metrics":
+                    self.wrapper.metrics()
                 elif request["type"] == "download":
                     do_download(request["data"], self.wrapper.storage.path, self.current, self.got_response)
                 elif request["type"] == "chunk":
                     self.upload(**request["data"])
                 elif request["type"] == "ping":
                     self.got_response({"type":"pong"})
-                self.requests.task_done()
-            except queue.Empty:
-                time.sleep(0.01)
             except Exception as e:
-                self.requests.task_done()
+                outcome = {"Read-only": "read_only", "Aborted": "aborted"}.get(str(e), "error")
                 if str(e) == "Read-only":
                     self.got_response({"type":"error", "data":{"message": "Server is read-only"}})
                 elif str(e) == "Aborted":
@@ -309,17 +499,27 @@ class Inference(threading.Thread):
                     additional = ""
                     trace = ""
                     try:
-                        trace = log_traceback("SERVER")
-                        s = traceback.extract_tb(e.__traceback__).format()
-                        s = [e for e in s if not "venv" in e][-1]
-                        s = s.split(", ")
-                        file = s[0].split(os.path.sep)[-1][:-1]
-                        line = s[1].split(" ")[1]
-                        additional = f" ({file}:{line})"
+                        if type(e) == worker.WorkerError:
+                            # already logged by the worker process
+                            trace, additional = e.trace, e.location
+                        else:
+                            trace = log_traceback("SERVER")
+                            additional = get_location(e)
                     except Exception as a:
                         trace = log_traceback("LOGGING")
                         additional = " THEN " + str(a)
                     self.got_response({"type":"error", "data":{"message":str(e) + additional, "trace": trace}})
+            if self.encoder:
+                # nothing from this request may still be waiting to go out once the next one is current
+                self.encoder.flush()
+            self.requests.task_done()
+            if self.metrics:
+                elapsed = time.perf_counter() - start
+                for _, _, r in batch:
+                    self.metrics.on_request(r["type"], outcome, elapsed)
+
+            for _ in batch[1:]:
+                self.requests.task_done()
             
             if self.public:
                 self.wrapper.storage.clear_vram()
@@ -359,36 +559,102 @@ class Inference(threading.Thread):
         thread = threading.Thread(target=do_fetch, args=([]), daemon=True)
         thread.start()
 
+class Router():
+    # sends each request to the worker whose device already holds its models, otherwise the least loaded one
+    def __init__(self, workers):
+        self.workers = workers
+        self.primary = workers[0]
+
+    def get_affinity(self, worker, request):
+        storage = worker.wrapper.storage
+        affinity = 0
+        for comp, name in get_models(request).items():
+            residency = storage.get_residency(comp, name)
+            if residency != None:
+                affinity += 1 if residency == "cpu" else 2
+            elif worker.assigned.get(comp) == name:
+                affinity += 1
+
+        hint = (request.get("data") or {}).get("device_name", None)
+        if hint and hint == worker.name:
+            affinity += 10
+        return affinity
+
+    def route(self, request):
+        if len(self.workers) == 1 or not request["type"] in ROUTED:
+            return self.primary
+
+        worker = max(self.workers, key=lambda w: (self.get_affinity(w, request), -w.requests.unfinished_tasks))
+        worker.assigned.update(get_models(request))
+        return worker
+
+    def release(self, request):
+        # manage only runs on the primary, the others let go of the files it is about to change
+        data = request.get("data") or {}
+        for worker in self.workers[1:]:
+            storage = worker.wrapper.storage
+            for file in [data.get("file"), data.get("old_file")]:
+                if type(file) == str and file:
+                    storage.release(os.path.join(storage.path, convert_path(file)))
+
+    def find_temporary(self, id):
+        for worker in self.workers:
+            if id in worker.wrapper.temporary:
+                return worker
+        return self.primary
+
+class Session():
+    # the encryption of requests on one connection, the password key unless the client's first frame is a handshake
+    def __init__(self, scheme):
+        self.scheme = scheme
+        self.resumed = None
+        self.started = False
+
 class Server():
-    def __init__(self, wrapper, host, port, password=DEFAULT_PASSWORD, owner=False, read_only=False, monitor=False, public=False):
+    def __init__(self, wrapper, host, port, password=DEFAULT_PASSWORD, owner=False, read_only=False, monitor=False, public=False, max_batch=1, batch_window=0):
         self.stopping = False
 
         self.requests = {}
         self.clients = {}
+        self.sending = set()
         self.reconnected = {}
 
+        # the password key is slow to derive, its only done once here. connections get their own session keys from it
+        self.key = None
         self.scheme = None
         if password != None:
-            self.scheme = get_scheme(password)
+            self.key = get_key(password)
+            self.scheme = AESGCM(self.key)
+        self.tickets = AESGCM(secrets.token_bytes(32))
 
         self.monitor = monitor
         self.read_only = read_only
         self.owner = None if owner else "disabled"
         self.public = public
 
-        self.inference = Inference(wrapper, read_only, public, callback=self.on_response)
+        wrappers = wrapper if type(wrapper) == list else [wrapper]
+        self.workers = [Inference(w, read_only, public, callback=self.on_response, max_batch=max_batch, batch_window=batch_window) for w in wrappers]
+        for worker, w in zip(self.workers, wrappers):
+            worker.name = w.get_device_name()
+        self.inference = self.workers[0]
+        self.router = Router(self.workers)
+        self.metrics = None
+        # streamed results being gathered for the owner, by request id
+        self.monitored = {}
         self.server = websockets.sync.server.serve(self.handle_connection, host=host, port=int(port), max_size=None)
         self.serve = threading.Thread(target=self.serve_forever, daemon=True)
 
     def start(self):
         print("SERVER: starting")
-        self.inference.start()
+        for worker in self.workers:
+            worker.start()
         self.serve.start()
 
     def stop(self):
         print("SERVER: stopping")
         self.stopping = True
-        self.inference.stay_alive = False
+        for worker in self.workers:
+            worker.stop()
         print("SERVER: shutdown")
         self.server.shutdown()
         print("SERVER: join")
@@ -399,7 +665,8 @@ class Server():
         self.serve.join(timeout)
         if self.serve.is_alive():
             return False # timeout
-        self.inference.join()
+        for worker in self.workers:
+            worker.join()
         return True
 
     def serve_forever(self):
@@ -410,92 +677,125 @@ class Server():
         connection.socket.close()
         raise websockets.exceptions.ConnectionClosedError(None, None)
 
+    def send_responses(self, connection, responses, session, client_id=None):
+        # runs alongside handle_connection, blocking on the outbound queue so responses go out immediately
+        try:
+            scheme = session.scheme
+            while True:
+                item = responses.get()
+                if item == None:
+                    break
+                id, response = item[:2]
+                if response["type"] == "handshake":
+                    # whatever was queued before went out under the password key, everything after uses the session key
+                    connection.send(response["data"]["reply"])
+                    scheme = response["data"]["scheme"]
+                    continue
+                if response["type"] == "result_image":
+                    data = encrypt(scheme, get_frame(id, response["data"]["index"], response["data"]["image"]))
+                else:
+                    response["id"] = id
+                    data = encrypt(scheme, bson.dumps(response))
+                connection.send(get_fragments(data))
+                if self.metrics:
+                    self.metrics.on_sent(client_id, len(data))
+                del data
+                if len(item) > 2:
+                    # the inference thread is waiting to send the next image
+                    item[2].set()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception:
+            log_traceback("CLIENT")
+            connection.close()
+
     def handle_connection(self, connection: websockets.sync.server.ServerConnection):
         new = True
 
         client_id = get_id()
 
-        self.clients[client_id] = queue.Queue()
-        self.clients[client_id].put((-1, {"type":"hello", "data":{"id":client_id}}))
+        responses = queue.Queue()
+        self.clients[client_id] = responses
+        responses.put((-1, {"type":"hello", "data":{"id":client_id}}))
 
         if self.owner == None:
             self.owner = client_id
-            self.inference.owner = self.owner
-            self.clients[client_id].put((-1, {"type":"owner"}))
+            for worker in self.workers:
+                worker.owner = self.owner
+            responses.put((-1, {"type":"owner"}))
+
+        session = Session(self.scheme)
+        sender = threading.Thread(target=self.send_responses, args=(connection, responses, session, client_id), daemon=True)
+        self.sending.add(client_id)
+        sender.start()
 
         lost = False
-        waiting = 0
         try:
             while not self.stopping:
-                if not self.clients[client_id].empty():
-                    id, response = self.clients[client_id].get()
-                    response["id"] = id
-                    data = encrypt(self.scheme, bson.dumps(response))
-                    data = [data[i:min(i+FRAGMENT_SIZE,len(data))] for i in range(0, len(data), FRAGMENT_SIZE)]
-                    connection.send(data)
-                else:
-                    data = None
+                try:
+                    data = connection.recv(timeout=KEEPALIVE_INTERVAL)
+                except TimeoutError:
+                    connection.ping()
+                    continue
+                error = None
+                request = None
+                started, session.started = session.started, True
+                if type(data) == str and data.startswith(HANDSHAKE) and not started:
+                    if not self.handshake(session, data, client_id, responses):
+                        responses.put((-1, {"type":"error", "data":{"message": "Invalid handshake"}}))
+                    continue
+                if type(data) in {bytes, bytearray}:
+                    data = bytes(data)
                     try:
-                        data = connection.recv(timeout=0)
-                        waiting = 0
-                    except TimeoutError:
-                        pass
-                    if not data:
-                        time.sleep(0.01)
-                        waiting += 10
-                        if waiting >= 2000:
-                            waiting = 0
-                            pong = connection.ping()
-                            #if not pong.wait(10):
-                            #    self.terminate_connection(connection)
-
-                        continue
-                    error = None
-                    request = None
-                    if type(data) in {bytes, bytearray}:
+                        data = decrypt(session.scheme, data)
                         try:
-                            data = decrypt(self.scheme, bytes(data))
-                            try:
-                                request = bson.loads(data)
-                            except:
-                                error = "Malformed request"
+                            request = bson.loads(data)
                         except:
-                            error = "Incorrect password"
-                    else:
-                        error = "Invalid request"
-                    if request:
-                        if request["type"] == "options" and new:
-                            print(f"SERVER: client connected")
-                            new = False
-                        if request["type"] == "cancel":
-                            id = request["data"]["id"]
-                            if id in self.requests and self.requests[id] == client_id:
-                                del self.requests[id]
-                                self.send_response(client_id, id, {'type': 'aborted', 'data': {}})
-                        if request["type"] == "reconnect":
-                            old_client_id = request["data"]["id"]
-                            if old_client_id in self.clients:
-                                while not self.clients[old_client_id].empty():
-                                    self.clients[client_id].put(self.clients[old_client_id].get())
-                            self.reconnected[old_client_id] = client_id
-                            for id in list(self.requests.keys()):
-                                if self.requests[id] == old_client_id:
-                                    self.requests[id] = client_id
-                            
-                        request_id = get_id()
-                        if "id" in request:
-                            request_id = request["id"]
-                        self.requests[request_id] = client_id
-
-                        if request["type"] == "fetch":
-                            self.inference.fetch(request["data"]["id"], request_id, self.clients[client_id])
-                            continue
-
-                        remaining = self.inference.requests.unfinished_tasks
-                        self.inference.requests.put((client_id, request_id, request))
-                        self.clients[client_id].put((-1, {"type":"ack", "data":{"id": request_id, "queue": remaining}}))
-                    else:
-                        self.clients[client_id].put((-1, {"type":"error", "data":{"message": error}}))
+                            error = "Malformed request"
+                    except:
+                        error = "Incorrect password"
+                else:
+                    error = "Invalid request"
+                if request and session.resumed:
+                    # the client proved it holds the ticket's secret, it takes over from its previous connection
+                    self.reconnect(session.resumed, client_id, responses)
+                    session.resumed = None
+                if request:
+                    if request["type"] == "options" and new:
+                        print(f"SERVER: client connected")
+                        new = False
+                    if request["type"] == "cancel":
+                        id = request["data"]["id"]
+                        if id in self.requests and self.requests[id] == client_id:
+                            del self.requests[id]
+                            self.send_response(client_id, id, {'type': 'aborted', 'data': {}})
+                    if request["type"] == "reconnect":
+                        self.reconnect(request["data"]["id"], client_id, responses)
+
+                    request_id = get_id()
+                    if "id" in request:
+                        request_id = request["id"]
+                    self.requests[request_id] = client_id
+                    if not is_frame_id(request_id) and type(request.get("data")) == dict:
+                        request["data"].pop("stream", None)
+
+                    if request["type"] == "fetch":
+                        worker = self.router.find_temporary(request["data"]["id"])
+                        worker.fetch(request["data"]["id"], request_id, responses)
+                        continue
+
+                    worker = self.router.route(request)
+                    if request["type"] == "manage" and not (self.read_only and client_id != self.owner):
+                        self.router.release(request)
+                    item = (client_id, request_id, request)
+                    worker.requests.put(item)
+                    remaining = worker.requests.position(item)
+                    prefetch = worker.wrapper.storage.prefetch_stats.copy()
+                    responses.put((-1, {"type":"ack", "data":{"id": request_id, "queue": remaining, "prefetch": prefetch}}))
+                    if remaining and request["type"] in PREFETCHED:
+                        worker.prefetch()
+                else:
+                    responses.put((-1, {"type":"error", "data":{"message": error}}))
         except websockets.exceptions.ConnectionClosedOK:
             pass
         except websockets.exceptions.ConnectionClosedError as e:
@@ -504,6 +804,10 @@ class Server():
         except Exception:
             log_traceback("CLIENT")
 
+        responses.put(None)
+        sender.join()
+        self.sending.discard(client_id)
+
         if not new:
             if lost:
                 print(f"SERVER: client lost, waiting...")
@@ -517,14 +821,120 @@ class Server():
 
         if client_id in self.clients:
             del self.clients[client_id]
+        if self.metrics:
+            self.metrics.on_disconnect(client_id)
+
+    def handshake(self, session, data, client_id, responses):
+        # the client sends a nonce and maybe a ticket from an earlier session, resuming it skips the password key
+        try:
+            data = base64.b64decode(data[len(HANDSHAKE):], validate=True)
+        except Exception:
+            return False
+        client_nonce, ticket = data[:16], data[16:]
+        if len(client_nonce) != 16:
+            return False
+        server_nonce = secrets.token_bytes(16)
+
+        status, key, resumed = HANDSHAKE_FULL, self.key, None
+        opened = self.open_ticket(ticket) if ticket else None
+        if opened:
+            status = HANDSHAKE_RESUMED
+            key, resumed = opened
+        if self.key == None:
+            status = HANDSHAKE_PLAIN
+
+        scheme = None
+        if status != HANDSHAKE_PLAIN:
+            key = get_session_key(key, client_nonce, server_nonce)
+            scheme = AESGCM(key)
+        reply = HANDSHAKE + base64.b64encode(server_nonce + bytes([status])).decode("ascii")
+        responses.put((-1, {"type":"handshake", "data":{"reply": reply, "scheme": scheme}}))
+        session.scheme = scheme
+        session.resumed = resumed
+
+        if scheme:
+            secret = get_session_key(key, b"", b"", b"resume")
+            responses.put((-1, {"type":"session", "data":{"ticket": self.make_ticket(secret, client_id)}}))
+        return True
+
+    def make_ticket(self, secret, client_id):
+        expiry = int(time.time()) + TICKET_LIFETIME
+        return encrypt(self.tickets, secret + expiry.to_bytes(8, "little") + client_id.to_bytes(8, "little"))
+
+    def open_ticket(self, ticket):
+        try:
+            data = decrypt(self.tickets, ticket)
+        except Exception:
+            return None
+        secret, expiry, client_id = data[:32], int.from_bytes(data[32:40], "little"), int.from_bytes(data[40:48], "little")
+        if expiry < time.time():
+            return None
+        return secret, client_id
+
+    def reconnect(self, old_client_id, client_id, responses):
+        if old_client_id in self.clients:
+            self.transfer_responses(self.clients[old_client_id], responses)
+        self.reconnected[old_client_id] = client_id
+        for id in list(self.requests.keys()):
+            if self.requests[id] == old_client_id:
+                self.requests[id] = client_id
+
+    def transfer_responses(self, old, new):
+        # move pending responses over to the reconnected client, the stop marker stays behind for the old sender
+        stopped = False
+        while not old.empty():
+            item = old.get()
+            if item == None:
+                stopped = True
+            elif item[1]["type"] != "handshake":
+                new.put(item)
+        if stopped:
+            old.put(None)
+
+    def is_monitored(self, client):
+        return client != self.owner and self.monitor and self.owner in self.clients
+
+    def send_monitor(self, id, response):
+        response = response.copy()
+        response["monitor"] = True
+        self.clients[self.owner].put((id, response))
+
+    def mirror_stream(self, id, response):
+        # monitoring clients dont know about streams, the owner gets the whole result once every image arrived
+        result = self.monitored.get(id, None)
+        if result == None:
+            return
+        result["images"] += [response["data"]["image"]]
+        if len(result["images"]) == result["count"]:
+            del self.monitored[id]
+            if self.owner in self.clients:
+                self.send_monitor(id, {"type": "result", "data": {"images": result["images"], "metadata": result["metadata"], "type": result["type"]}})
 
     def send_response(self, client, id, response):
+        if response["type"] == "result_image":
+            self.mirror_stream(id, response)
+            # images are only encoded as fast as they are sent, so a result never sits in memory whole
+            if client in self.clients:
+                sent = threading.Event()
+                self.clients[client].put((id, response, sent))
+                while not sent.wait(0.1):
+                    if not client in self.sending:
+                        # lost, the image waits in the queue in case the client reconnects
+                        break
+            return
+        if response["type"] == "result" and response["data"].get("stream"):
+            if self.is_monitored(client):
+                self.monitored[id] = {**response["data"], "images": []}
+            if client in self.clients:
+                self.clients[client].put((id, response))
+            return
+        if response["type"] in {"aborted", "error"}:
+            # a stream that ended early never completes
+            self.monitored.pop(id, None)
         if client in self.clients:
             self.clients[client].put((id, response))
-        if client != self.owner and self.monitor and self.owner in self.clients:
-            response = response.copy()
-            response["monitor"] = True
-            self.clients[self.owner].put((id, response))
+        if self.is_monitored(client):
+            self.send_monitor(id, response)
 
     def on_response(self, id, response):
         if self.stopping:
@@ -541,23 +951,71 @@ if __name__ == "__main__":
     parser.add_argument('--bind', type=str, help='address (ip:port) to listen on', default="127.0.0.1:28888")
     parser.add_argument('--password', type=str, help='password to derive encryption key from', default=DEFAULT_PASSWORD)
     parser.add_argument('--models', type=str, help='models folder', default="../../models")
-    parser.add_argument('--cache', type=int, help='number of models allowed to be cached in RAM', default=0)
+    parser.add_argument('--vram-budget', type=float, help='GB of models allowed to stay cached on each device, 0 keeps only the models in use', default=0)
+    parser.add_argument('--ram-budget', type=float, help='GB of models allowed to stay cached in RAM', default=8)
     parser.add_argument('-r', '--read-only', help='disable filesystem changes', action='store_true')
     parser.add_argument('-o', '--owner', help='first client is the owner, bypassing read-only', action='store_true')
     parser.add_argument('-m', '--monitor', help='send all generations to the owner', action='store_true')
     parser.add_argument('-p', '--public', help='configure for multiple users (disables a few actions)', action='store_true')
+    parser.add_argument('--devices', type=str, help='comma separated devices to run one worker each on (e.g. 0,1,2,3 or cpu,cpu)', default=None)
+    parser.add_argument('--max-batch', type=int, help='maximum images when merging compatible txt2img requests into one batch (1 disables)', default=1)
+    parser.add_argument('--batch-window', type=float, help='milliseconds to wait for compatible txt2img requests to merge', default=0)
+    parser.add_argument('--processes', help='run each worker in its own process, sharing model weights between them', action='store_true')
+    parser.add_argument('--shared-store', type=str, help='folder to keep converted models in, ready to load (default with --processes is in shared memory)', default=None)
+    parser.add_argument('--shared-store-size', type=float, help='GB the shared store may use before evicting, 0 for unbounded', default=16)
+    parser.add_argument('--encoders', type=int, help='threads encoding result and preview images, 0 encodes on the inference thread', default=encoder.DEFAULT_WORKERS)
+    parser.add_argument('--png-compression', type=int, help='PNG compression level 0-9, lower is faster and larger', default=encoder.DEFAULT_COMPRESSION)
+    parser.add_argument('--results-budget', type=float, help='MB of delay_fetch results kept in memory before spilling to disk', default=results.DEFAULT_BUDGET/1024**2)
+    parser.add_argument('--results-disk-budget', type=float, help='GB of delay_fetch results kept on disk before dropping the oldest', default=results.DEFAULT_DISK_BUDGET/1024**3)
+    parser.add_argument('--results-ttl', type=float, help='seconds a delay_fetch result waits for its fetch', default=results.DEFAULT_TTL)
+    parser.add_argument('--results-folder', type=str, help='folder spilled delay_fetch results are kept in', default=None)
+    parser.add_argument('--encoding-cache', type=float, help='MB of CLIP encodings kept to reuse for identical prompts, 0 disables', default=prompts.DEFAULT_ENCODING_CACHE/1024**2)
+    parser.add_argument('--watch-models', help='watch the model folders with inotify and only rescan them after a change (linux)', action='store_true')
+    parser.add_argument('--metrics-port', type=int, help='port to serve Prometheus metrics on at /metrics, 0 disables', default=0)
+    parser.add_argument('--pin-prefetch', help='prefetch models into pinned memory, faster to copy to the GPU but not pageable', action='store_true')
 
     args = parser.parse_args()
 
     ip, port = args.bind.rsplit(":",1)
 
-    model_storage = storage.ModelStorage(args.models, torch.float16, torch.float32, args.cache)
-    params = wrapper.GenerationParameters(model_storage, torch.device("cuda"))
+    devices = [torch.device("cuda")]
+    if args.devices:
+        devices = [torch.device("cpu") if d.strip().lower() == "cpu" else torch.device("cuda", int(d)) for d in args.devices.split(",")]
+
+    encoder.configure(args.encoders, args.png_compression)
+    results_budget = int(args.results_budget * 1024**2)
+    results_disk_budget = int(args.results_disk_budget * 1024**3)
+    results.configure(results_budget, args.results_ttl, args.results_folder, results_disk_budget)
+    encoding_cache = int(args.encoding_cache * 1024**2)
+    prompts.configure_cache(encoding_cache)
+
+    params = []
+    shared_store = args.shared_store
+    if args.processes and not shared_store:
+        shared_store = shared.get_default_folder()
+    shared_size = int(args.shared_store_size * 1024**3)
+    vram_budget = int(args.vram_budget * 1024**3)
+    ram_budget = int(args.ram_budget * 1024**3)
 
-    if args.public:
-        params.switch_public()
+    for device in devices:
+        if args.processes:
+            params += [worker.RemoteWrapper(device, args.models, ram_budget, vram_budget, shared_store, shared_size, bool(args.devices), args.public, args.pin_prefetch, args.encoders, args.png_compression,
+                                             results_budget, args.results_ttl, args.results_folder, results_disk_budget, args.watch_models, encoding_cache)]
+            continue
+        model_storage = storage.ModelStorage(args.models, torch.float16, torch.float32, ram_budget, shared_store, shared_size, vram_budget)
+        model_storage.pin_prefetch = args.pin_prefetch
+        if args.watch_models:
+            model_storage.watch_models()
+        worker_params = wrapper.GenerationParameters(model_storage, device)
+        if args.devices:
+            worker_params.pin_device()
+        if args.public:
+            worker_params.switch_public()
+        params += [worker_params]
 
-    server = Server(params, ip, port, args.password, args.owner, args.read_only, args.monitor, args.public)
+    server = Server(params, ip, port, args.password, args.owner, args.read_only, args.monitor, args.public, args.max_batch, args.batch_window)
+    if args.metrics_port:
+        metrics.Exporter(server, ip, args.metrics_port)
     server.start()
     
     try:
@@ -0,0 +1,124 @@
+import os
+import hashlib
+import tempfile
+import torch
+import safetensors.torch
+
+import utils
+
+# converted checkpoint components, the only models big enough to be worth sharing between worker processes
+COMPONENTS = {"UNET", "CLIP", "VAE"}
+
+def get_default_folder():
+    # tmpfs when available, so the store is plain shared memory
+    root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(root, "sd-inference-server")
+
+class SharedStore():
+    # converted components ready to be mapped, shared between worker processes and kept between runs when on disk.
+    # bounded by size, the least recently used entries are evicted first
+    def __init__(self, folder, max_size=0):
+        self.folder = folder
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_key(self, file):
+        stat = os.stat(file)
+        key = f"{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get_path(self, file, comp, dtype):
+        dtype = str(dtype).rsplit(".", 1)[-1]
+        return os.path.join(self.folder, f"{self.get_key(file)}.{comp}.{dtype}.safetensors")
+
+    def get_entries(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".safetensors"):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries += [(stat.st_mtime, stat.st_size, path)]
+        return sorted(entries)
+
+    def get_stats(self):
+        entries = self.get_entries()
+        size = sum([size for _, size, _ in entries])
+        return {**self.stats, "entries": len(entries), "size": size, "max_size": self.max_size}
+
+    def find(self, file, comp, dtype):
+        path = self.get_path(file, comp, dtype)
+        if not os.path.exists(path):
+            return None
+        state_dict, metadata = utils.map_safetensors(path)
+        metadata["dtype"] = dtype
+        state_dict["metadata"] = metadata
+        return state_dict
+
+    def get(self, file, comp, dtype):
+        state_dict = self.find(file, comp, dtype)
+        if state_dict == None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        try:
+            # mtime is the recency used for eviction
+            os.utime(self.get_path(file, comp, dtype))
+        except OSError:
+            pass
+        return state_dict
+
+    def evict(self, needed):
+        entries = self.get_entries()
+        size = sum([size for _, size, _ in entries])
+        for _, entry_size, path in entries:
+            if size + needed <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.stats["evictions"] += 1
+
+    def put(self, file, comp, dtype, state_dict):
+        path = self.get_path(file, comp, dtype)
+        if os.path.exists(path):
+            return True
+
+        tensors = {}
+        seen = set()
+        for k, v in state_dict.items():
+            if type(v) != torch.Tensor:
+                continue
+            v = v.contiguous()
+            ptr = v.untyped_storage().data_ptr()
+            if ptr in seen:
+                # safetensors refuses tensors that share memory
+                v = v.clone()
+            seen.add(ptr)
+            tensors[k] = v
+
+        metadata = {k:v for k, v in state_dict.get("metadata", {}).items() if type(v) == str}
+
+        if self.max_size:
+            needed = sum([t.nbytes for t in tensors.values()])
+            if needed > self.max_size:
+                return False
+            self.evict(needed)
+
+        # written under a temporary name so other processes never map a partial file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            safetensors.torch.save_file(tensors, tmp, metadata)
+            os.replace(tmp, path)
+        except Exception:
+            # most likely out of space, the component is still used, just not stored
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
@@ -4,6 +4,8 @@ import glob
 import safetensors.torch
 import gc
 import json
+import threading
+import functools
 
 import models
 import convert
@@ -12,6 +14,8 @@ import annotator
 import controlnet
 import segmentation
 import utils
+import shared
+import index
 
 MODEL_FOLDERS = {
     "SD": ["SD", "Stable-diffusion", "VAE"],
@@ -22,6 +26,17 @@ MODEL_FOLDERS = {
     "Detailer": ["Detailer"],
 }
 
+# components only used one at a time, the latest is the one in use. the others can have any number in use by a request
+SINGLE = {"UNET", "CLIP", "VAE", "SR", "Detailer"}
+
+# rough seconds to reload a GB of each component from disk, and a fixed cost per load (reading, converting, building)
+DISK_RELOAD_COST = {"UNET": 2.0, "CLIP": 2.0, "VAE": 2.0, "SR": 1.0, "LoRA": 1.0, "CN": 1.0, "AN": 1.0, "Detailer": 1.0}
+DISK_RELOAD_OVERHEAD = {"UNET": 1.0, "CLIP": 0.5, "VAE": 0.5, "SR": 0.2, "LoRA": 0.1, "CN": 0.5, "AN": 1.0, "Detailer": 0.2}
+# and from RAM, a copy to the device
+RAM_RELOAD_COST = 0.2
+
+DEFAULT_RAM_BUDGET = 8 * 1024**3
+
 MODEL_TYPE_NAMES = {
     "unknown": "Unknown",
     "lora": "LoRA",
@@ -41,26 +56,51 @@ MODEL_TYPE_IDENTIFIERS = {
 }
 
 class ModelStorage():
-    def __init__(self, path, dtype, vae_dtype=None, cache=0):
+    def __init__(self, path, dtype, vae_dtype=None, ram_budget=DEFAULT_RAM_BUDGET, shared_folder=None, shared_size=0, vram_budget=0):
         self.dtype = dtype
         self.vae_dtype = vae_dtype or dtype
 
+        # converted components are kept in a store shared with other worker processes and later runs, that store is the RAM tier
+        self.shared = shared.SharedStore(shared_folder, shared_size) if shared_folder else None
+
         self.path = None
+        self.index = None
+        self.watcher = None
         self.set_folder(path)
 
         self.classes = {"UNET": models.UNET, "CLIP": models.CLIP, "VAE": models.VAE, "SR": upscalers.SR, "LoRA": models.LoRA, "CN": models.ControlNet, "AN": torch.nn.Module, "Detailer": models.Detailer}
-        self.vram_limits = {"UNET": 0, "CLIP": 0, "VAE": 0, "SR": 0}
-        self.ram_limits = {"UNET": cache, "CLIP": cache, "VAE": cache, "SR": cache, "LoRA": cache, "CN": cache, "AN": cache, "Detailer": cache}
+
+        # bytes of parameters allowed to stay cached on the device and in RAM, models in use are always kept
+        self.vram_budget = vram_budget
+        self.ram_budget = ram_budget
 
         self.files = {k:{} for k in self.classes}
         self.loaded = {k:{} for k in self.classes}
-        self.order = {k:[] for k in self.classes}
+        self.sizes = {k:{} for k in self.classes}
         self.file_cache = {}
+        self.streams = {}
+
+        # logical clock of the last use of each model, and the request it was last used by
+        self.clock = 0
+        self.used = {k:{} for k in self.classes}
+        self.request = 0
+        self.requested = {k:{} for k in self.classes}
+        self.evictions = {k:{"vram": 0, "ram": 0} for k in self.classes}
+        self.loads = {k: 0 for k in self.classes}
 
         self.uncap_ram = False
 
+        self.prefetched = {}
+        self.prefetch_pending = set()
+        self.prefetch_thread = None
+        self.prefetch_lock = threading.Lock()
+        self.prefetch_stats = {"hits": 0, "misses": 0}
+        self.pin_prefetch = False
+
+        # TIs by activation, their vectors are only read once a prompt uses them
         self.embeddings_files = {}
         self.embeddings = {}
+        self.embedding_vectors = {}
 
         self.model_types = {}
 
@@ -69,7 +109,19 @@ class ModelStorage():
     def set_folder(self, path):
         if path != self.path:
             self.clear_file_cache()
+            self.index = index.ModelIndex(path)
         self.path = path
+        if self.watcher:
+            self.watch_models()
+
+    def watch_models(self):
+        # rescan only after the model folders change
+        folders = [(self.path, False)]
+        for type in MODEL_FOLDERS:
+            folders += [(os.path.abspath(os.path.join(self.path, f)), True) for f in MODEL_FOLDERS[type]]
+        if self.watcher:
+            self.watcher.close()
+        self.watcher = index.get_watcher(folders)
 
     def get_folder(self, type):
         folders = [os.path.join(self.path, f) for f in MODEL_FOLDERS[type]]
@@ -93,7 +145,7 @@ class ModelStorage():
                     tmp += glob.glob(os.path.join(path, e))
             
             for file in tmp:
-                rel = os.path.relpath(file, path)
+                rel = file[len(path)+1:]
                 if rel.startswith("_") or os.path.sep + "_" in rel:
                    continue
                 files += [file]
@@ -116,14 +168,19 @@ class ModelStorage():
                 if not m in self.loaded[c]:
                     continue
                 if str(self.loaded[c][m].device) != "cpu":
-                    if c in self.ram_limits:
-                        self.enforce_limit(c, m, "cpu")
+                    if self.is_shared(c):
+                        #print("CLEAR", c, m, "TO SHARED")
+                        del self.loaded[c][m]
+                        continue
                     #print("CLEAR", c, m, "TO RAM")
                     self.unload(self.loaded[c][m])
+        self.synchronize()
+        self.enforce_budget()
         self.do_gc()
 
     def reset(self):
-        self.embeddings = {}
+        self.prefetched = {}
+        self.embedding_vectors = {}
         for c in self.loaded:
             for m in list(self.loaded[c].keys()):
                 del self.loaded[c][m]
@@ -131,72 +188,147 @@ class ModelStorage():
         self.do_gc()
         self.find_all()
 
-    def set_ram_limit(self, count):
-        for comp in {"UNET", "CLIP", "VAE"}:
-            self.ram_limits[comp] = count
-
-    def enforce_limit(self, comp, current, device):
-        allowed_vram = self.vram_limits.get(comp, 0)
-        allowed_ram = self.ram_limits.get(comp, 0)
-
-        found_vram = 0
-        found_ram = 0
-
-        if str(device) == "cpu":
-            found_ram += 1
-        else:
-            found_vram += 1
-        
-        for m in self.order[comp]:
-            if not m in self.loaded[comp]:
-                continue
-            
-            in_ram = str(self.loaded[comp][m].device) == "cpu"
-            if m == current:
-                continue
-
-            if found_vram >= allowed_vram and not in_ram:
-                if found_ram < allowed_ram:
-                    #print("ENFORCE", comp, m, "TO RAM")
-                    self.loaded[comp][m] = self.loaded[comp][m].to("cpu")
-                    found_ram += 1
-                else:
-                    #print("ENFORCE", comp, m, "TO DISK")
-                    del self.loaded[comp][m]
-                self.do_gc()
-                continue
+    def begin_request(self):
+        # models used by an earlier request are no longer in use
+        self.request += 1
 
-            if found_ram >= allowed_ram and in_ram and not self.uncap_ram:
-                #print("ENFORCE", comp, m, "TO DISK")
-                del self.loaded[comp][m]
-                self.do_gc()
-                continue
-            
-            if in_ram:
-                found_ram += 1
-            else:
-                found_vram += 1
+    def touch(self, comp, name):
+        self.clock += 1
+        self.used[comp][name] = self.clock
+        self.requested[comp][name] = self.request
 
-    def enforce_network_limit(self, used, comp):
-        # networks cant have a hard limit since you can use an arbitrary number of them
-        # so they are "decayed" from gpu -> cpu -> disk as they are left unused
+    def keep(self, comp, used):
+        # mark the models this request uses, everything else is left to the budgets
         for m in list(self.loaded[comp].keys()):
-            if str(self.loaded[comp][m].device) == "cpu":
-                continue
             if any([os.path.sep+u+"." in m or m == u for u in used]):
-                continue
-            #print("NET ENFORCE", m, "TO DISK")
-            del self.loaded[comp][m]
+                self.touch(comp, m)
+        self.enforce_budget()
+
+    def get_size(self, model):
+        if not hasattr(model, "parameters"):
+            return 0
+        size = sum([p.nbytes for p in model.parameters()])
+        if hasattr(model, "buffers"):
+            size += sum([b.nbytes for b in model.buffers()])
+        return size
+
+    def get_pinned_size(self, model):
+        # pinned copies a model on the device keeps to swap back faster, held in RAM on top of the model
+        if self.get_tier(model.device) == "ram":
+            return 0
+        return sum([t.pinned.nbytes for t in self.get_tensors(model) if hasattr(t, "pinned")])
+
+    def get_prefetched_size(self):
+        with self.prefetch_lock:
+            state_dicts = list(self.prefetched.values())
+        return sum([self.get_state_dict_size(s) for s in state_dicts])
+
+    def get_state_dict_size(self, state_dict):
+        return sum([t.nbytes for t in state_dict.values() if type(t) == torch.Tensor])
+
+    def get_usage(self, tier):
+        usage = self.get_prefetched_size() if tier == "ram" else 0
+        for c in self.loaded:
+            for m, model in list(self.loaded[c].items()):
+                if self.get_tier(model.device) == tier:
+                    usage += self.sizes[c].get(m, 0)
+                elif tier == "ram":
+                    usage += self.get_pinned_size(model)
+        return usage
+
+    def get_tier(self, device):
+        return "ram" if str(device) == "cpu" else "vram"
+
+    def in_use(self, comp, name):
+        if comp in SINGLE:
+            # the current model stays until another replaces it
+            return max(self.used[comp], key=self.used[comp].get) == name
+        return self.requested[comp].get(name, None) == self.request
+
+    def get_reload_cost(self, comp, name, tier):
+        size = self.sizes[comp].get(name, 0) / 1024**3
+        if tier == "vram" and (self.is_shared(comp) or self.sizes[comp].get(name, 0) <= self.ram_budget):
+            return size * RAM_RELOAD_COST
+        return size * DISK_RELOAD_COST[comp] + DISK_RELOAD_OVERHEAD[comp]
+
+    def get_value(self, comp, name, tier):
+        # what keeping a model is worth per byte it holds: the cost of reloading it, falling off the longer it goes unused
+        size = max(self.sizes[comp].get(name, 0), 1)
+        age = self.clock - self.used[comp].get(name, 0)
+        return self.get_reload_cost(comp, name, tier) / (size * (1 + age))
+
+    def evict(self, tier, budget, needed=0):
+        if tier == "ram" and self.uncap_ram:
+            # merges only exist in RAM
+            return 0
+
+        entries = []
+        for c in self.loaded:
+            for m, model in self.loaded[c].items():
+                if self.get_tier(model.device) == tier and not self.in_use(c, m):
+                    entries += [(self.get_value(c, m, tier), c, m)]
+
+        evicted = 0
+        usage = self.get_usage(tier)
+        if tier == "ram" and usage + needed > budget:
+            # prefetched checkpoints are only a guess at what comes next, they go first
+            with self.prefetch_lock:
+                if self.prefetched:
+                    usage -= sum([self.get_state_dict_size(s) for s in self.prefetched.values()])
+                    self.prefetched = {}
+                    evicted += 1
+        if tier == "ram" and usage + needed > budget:
+            # pinned copies only make swaps faster, they go before any model. models not in use first
+            pinned = [(self.in_use(c, m), c, m) for c in self.loaded for m, model in self.loaded[c].items() if self.get_pinned_size(model)]
+            for _, c, m in sorted(pinned):
+                if usage + needed <= budget:
+                    break
+                usage -= self.get_pinned_size(self.loaded[c][m])
+                self.release_pinned(self.loaded[c][m])
+                evicted += 1
+        for _, c, m in sorted(entries):
+            if usage + needed <= budget:
+                break
+            evicted += 1
+            usage -= self.sizes[c].get(m, 0)
+            self.evictions[c][tier] += 1
+            if tier == "vram" and not self.is_shared(c) and self.sizes[c].get(m, 0) <= self.ram_budget:
+                #print("EVICT", c, m, "TO RAM")
+                self.unload(self.loaded[c][m])
+            else:
+                #print("EVICT", c, m, "TO DISK")
+                del self.loaded[c][m]
+        return evicted
+
+    def make_room(self, device, needed):
+        tier = self.get_tier(device)
+        if self.evict(tier, self.vram_budget if tier == "vram" else self.ram_budget, needed):
+            self.synchronize()
             self.do_gc()
 
-    def enforce_controlnet_limit(self, used):
-        for m in list(self.loaded["CN"].keys()):
-            if str(self.loaded["CN"][m].device) == "cpu":
-                continue
-            if not m in used:
-                #print("CN ENFORCE", m, "TO DISK")
-                del self.loaded["CN"][m]
-                self.do_gc()
+    def enforce_budget(self):
+        # the device first, what it evicts can land in RAM
+        evicted = self.evict("vram", self.vram_budget)
+        evicted += self.evict("ram", self.ram_budget)
+        if evicted:
+            self.synchronize()
+            self.do_gc()
+
+    def get_cache_stats(self):
+        residency = {}
+        for c in self.loaded:
+            residency[c] = {m: {"device": str(model.device), "size": self.sizes[c].get(m, 0)} for m, model in list(self.loaded[c].items())}
+        stats = {
+            "vram": {"used": self.get_usage("vram"), "budget": self.vram_budget},
+            "ram": {"used": self.get_usage("ram"), "budget": self.ram_budget},
+            "residency": residency,
+            "evictions": {c: e.copy() for c, e in self.evictions.items()},
+            "loads": self.loads.copy(),
+            "prefetch": self.prefetch_stats.copy(),
+        }
+        if self.shared:
+            stats["shared"] = self.shared.get_stats()
+        return stats
 
     def clear_modified(self):
         # static network mode will merge models into the UNET/CLIP
@@ -207,31 +339,80 @@ class ModelStorage():
             self.loaded[comp] = {}
         self.clear_file_cache()
 
-    def clear_annotators(self, allowed=[]):
-        for m in list(self.loaded["AN"].keys()):
-            if str(self.loaded["AN"][m].device) == "cpu":
-                continue
-            if not m in allowed:
-                #print("AN ENFORCE", m, "TO DISK")
-                del self.loaded["AN"][m]
-                self.do_gc()
+    def get_stream(self, device):
+        device = torch.device(device)
+        if device.type != "cuda":
+            return None
+        if not str(device) in self.streams:
+            self.streams[str(device)] = torch.cuda.Stream(device)
+        return self.streams[str(device)]
+
+    def get_tensors(self, model):
+        if not hasattr(model, "parameters") or not hasattr(model, "buffers"):
+            return []
+        return list(model.parameters()) + list(model.buffers())
+
+    def synchronize(self):
+        for stream in self.streams.values():
+            stream.synchronize()
 
     def load(self, model, device, dtype=None):
+        stream = self.get_stream(device)
+        if stream == None:
+            if dtype:
+                model.to(device, dtype)
+            else:
+                model.to(device)
+            return
+
+        # copied on their own stream so the copies overlap whatever is still running,
+        # only the work queued after this waits for them
+        current = torch.cuda.current_stream(device)
+        tensors = []
+        with torch.cuda.stream(stream):
+            for t in self.get_tensors(model):
+                t.data = t.data.to(device, dtype=dtype if t.is_floating_point() else None, non_blocking=True)
+                tensors += [t.data]
+        current.wait_stream(stream)
+        for t in tensors:
+            t.record_stream(current)
+        # anything else the model keeps on its device
         if dtype:
             model.to(device, dtype)
         else:
             model.to(device)
-        self.do_gc()
 
     def unload(self, model):
+        tensors = [t for t in self.get_tensors(model) if t.device.type == "cuda"]
+        if not tensors:
+            model.to("cpu")
+            return
+
+        # weights go back into pinned buffers kept from the last time, anything queued that reads them runs first.
+        # the copies finish in the background, synchronize before reading them on the CPU
+        device = tensors[0].device
+        stream = self.get_stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for t in tensors:
+                if not hasattr(t, "pinned") or t.pinned.shape != t.shape or t.pinned.dtype != t.dtype:
+                    t.pinned = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+                t.pinned.copy_(t.data, non_blocking=True)
+                t.data.record_stream(stream)
+                t.data = t.pinned
         model.to("cpu")
-        self.do_gc()
+
+    def release_pinned(self, model):
+        # pinned copies stay across loads so the next unload reuses them, only a short RAM budget drops them
+        for t in self.get_tensors(model):
+            if hasattr(t, "pinned"):
+                del t.pinned
 
     def add(self, comp, name, model):
         self.loaded[comp][name] = model
-        if name in self.order[comp]:
-            self.order[comp].remove(name)
-        self.order[comp].insert(0, name)
+        self.sizes[comp][name] = self.get_size(model)
+        self.loads[comp] = self.loads.get(comp, 0) + 1
+        self.touch(comp, name)
 
     def remove(self, comp, name):
         if name in self.loaded[comp]:
@@ -241,6 +422,18 @@ class ModelStorage():
             
         self.do_gc()
 
+    def release(self, file):
+        # models loaded straight to the CPU still map their checkpoint, let go of them before it changes on disk
+        file = os.path.abspath(file)
+        for comp in shared.COMPONENTS:
+            for name in list(self.loaded[comp].keys()):
+                if os.path.abspath(self.files[comp].get(name, "")) != file:
+                    continue
+                if str(self.loaded[comp][name].device) == "cpu":
+                    self.remove(comp, name)
+        self.prefetched = {}
+        self.clear_file_cache()
+
     def reset_merge(self, comps):
         self.uncap_ram = False
         for comp in comps:
@@ -253,13 +446,41 @@ class ModelStorage():
         if comp in {"VAE"}:
             dtype = self.vae_dtype
 
-        if comp in self.vram_limits:
-            self.enforce_limit(comp, name, device)
+        self.touch(comp, name)
+        moving = self.get_tier(model.device) != self.get_tier(device)
+        if moving:
+            # coming back to RAM it lands in its pinned copy, those bytes are already counted
+            needed = self.sizes[comp].get(name, 0)
+            if str(device) == "cpu":
+                needed = max(needed - self.get_pinned_size(model), 0)
+            self.make_room(device, needed)
+
+        if str(device) == "cpu":
+            self.unload(model)
+            self.synchronize()
+            model = model.to(device, dtype)
+        else:
+            self.load(model, device, dtype)
+        self.sizes[comp][name] = self.get_size(model)
 
-        model = model.to(device, dtype)
+        if moving:
+            # once the model has left RAM, whatever was evicted into it can settle
+            self.enforce_budget()
 
         return model
 
+    def get_dtype(self, comp):
+        return self.vae_dtype if comp == "VAE" else self.dtype
+
+    def is_shared(self, comp):
+        return self.shared != None and comp in shared.COMPONENTS
+
+    def get_residency(self, comp, name):
+        model = self.loaded[comp].get(name, None)
+        if model == None:
+            return None
+        return str(model.device)
+
     def get_name(self, file):
         return os.path.relpath(file, self.path)
     
@@ -300,6 +521,36 @@ class ModelStorage():
     
         return MODEL_TYPE_NAMES.get(algo, None)
     
+    def get_ti_vectors(self, ti, name):
+        if "string_to_param" in ti:
+            vectors = ti["string_to_param"]["*"]
+        elif 'emb_params' in ti:
+            vectors = ti['emb_params']
+        elif len(ti) == 1:
+            vectors = ti[list(ti.keys())[0]]
+        elif 'clip_g' in ti and 'clip_l' in ti:
+            vectors = torch.cat([ti["clip_g"], ti["clip_l"]], dim=1)
+        else:
+            raise Exception(f"Unknown TI format in {name}")
+        return vectors
+
+    def get_ti_shape(self, file):
+        # safetensors give shapes without reading the tensors, anything else has to be loaded
+        try:
+            if file.endswith(".safetensors"):
+                with safetensors.safe_open(file, framework="pt", device="cpu") as f:
+                    shapes = {k: f.get_slice(k).get_shape() for k in f.keys()}
+                if 'emb_params' in shapes:
+                    return shapes['emb_params']
+                elif len(shapes) == 1:
+                    return list(shapes.values())[0]
+                elif 'clip_g' in shapes and 'clip_l' in shapes:
+                    return [shapes["clip_g"][0], shapes["clip_g"][1] + shapes["clip_l"][1]]
+                return None
+            return list(self.get_ti_vectors(self.load_file(file, "TI")["TI"], file).shape)
+        except:
+            return None
+
     def get_metadata(self, name):
         file = None
         for comp in self.files:
@@ -310,6 +561,9 @@ class ModelStorage():
         if not file:
             raise ValueError(f"unknown model: {name}")
 
+        return self.index.get(file, "metadata", self.read_metadata)
+
+    def read_metadata(self, file):
         metadata = {}
         try:
             with safetensors.safe_open(file, framework="pt", device="cpu") as f:
@@ -320,7 +574,14 @@ class ModelStorage():
         return metadata
 
     def find_all(self):
+        if self.watcher and not self.watcher.check():
+            return
+
+        self.index.begin_scan()
         self.files = {k:{} for k in self.classes}
+        self.embeddings_files = {}
+        self.embeddings = {}
+        self.model_types = {}
 
         standalone = {k:{} for k in ["UNET", "CLIP", "VAE"]}
         for file in self.get_models("SD", ["*.safetensors", "*.ckpt", "*.pt"]):
@@ -352,29 +613,16 @@ class ModelStorage():
             if activation in self.embeddings:
                 continue
 
-            self.embeddings_files[name] = file
-
-            ti = self.load_file(file, "TI")["TI"]
+            if self.index.get(file, "TI", self.get_ti_shape) == None:
+                continue
 
-            if "string_to_param" in ti:
-                vectors = ti["string_to_param"]["*"]
-            elif 'emb_params' in ti:
-                vectors = ti['emb_params']
-            elif len(ti) == 1:
-                vectors = ti[list(ti.keys())[0]]
-            elif 'clip_g' in ti and 'clip_l' in ti:
-                vectors = torch.cat([ti["clip_g"], ti["clip_l"]], dim=1)
-            else:
-                raise Exception(f"Unknown TI format in {name}")
-            
-            vectors.requires_grad = False
-            self.embeddings[activation] = vectors
+            self.embeddings_files[name] = file
+            self.embeddings[activation] = file
 
         for file in self.get_models("LoRA", ["*.safetensors", "*.pt"]):
             name = self.get_name(file)
             self.files["LoRA"][name] = file
-            if not name in self.model_types:
-                self.model_types[name] = self.get_lycoris_type(file)
+            self.model_types[name] = self.index.get(file, "LoRA", self.get_lycoris_type)
 
         for file in self.get_models("CN", ["*.safetensors", "*.pth"], False):
             name = self.get_name(file)
@@ -384,34 +632,148 @@ class ModelStorage():
             name = self.get_name(file)
             self.files["Detailer"][name] = file
 
+        self.index.prune()
+        self.index.save()
+
+    def is_known(self, name, comp):
+        # with several workers only one sees options and manage, a model added since is found by looking again
+        if not name in self.files[comp]:
+            self.find_all()
+        return name in self.files[comp]
+
     def get_component(self, name, comp, device):
         if name in self.loaded[comp]:
             return self.move(self.loaded[comp][name], name, comp, device)
         
-        if not name in self.files[comp]:
+        if not self.is_known(name, comp):
             raise ValueError(f"unknown {comp}: {name}")
         
         file = self.files[comp][name]
-        
-        if not file in self.file_cache:
-            self.file_cache[file] = self.load_file(file, comp)
-
-        if comp in self.file_cache[file]:
-            dtype = self.vae_dtype if comp == "VAE" else self.dtype
-            model = self.classes[comp].from_model(name, self.file_cache[file][comp], dtype)
+        state_dicts = self.get_prefetched(comp, name)
+        if state_dicts == None:
+            state_dicts = self.get_file(file, comp)
+
+        if comp in state_dicts:
+            state_dict = state_dicts[comp]
+            if comp in shared.COMPONENTS:
+                # checkpoints are mapped, make room then materialize each tensor once in its final dtype and device.
+                # tensors already right for the CPU stay mapped
+                needed = sum([v.numel() * torch.finfo(self.get_dtype(comp)).bits // 8 for v in state_dict.values() if type(v) == torch.Tensor])
+                self.touch(comp, name)
+                self.make_room(device, needed)
+                utils.cast_state_dict(state_dict, self.get_dtype(comp), device, move=True)
+            model = self.classes[comp].from_model(name, state_dict, self.get_dtype(comp))
         else:
             raise ValueError(f"model doesnt contain a {comp}: {name}")
         
         self.add(comp, name, model)
         return self.move(model, name, comp, device)
 
-    def get_state_dict(self, file, comp):
+    def prefetch(self, models, keep={}):
+        # read the next request's checkpoint into RAM on a background thread, so switching to it is only a copy to the device.
+        # only models needed now or next are kept, anything prefetched for other requests is dropped
+        with self.prefetch_lock:
+            if self.prefetch_thread and self.prefetch_thread.is_alive():
+                return
+
+            wanted = set()
+            for comp, name in models.items():
+                if comp in shared.COMPONENTS and name in self.files[comp] and not name in self.loaded[comp]:
+                    wanted.add((comp, name))
+
+            kept = wanted | set(keep.items())
+            for key in list(self.prefetched.keys()):
+                if not key in kept:
+                    del self.prefetched[key]
+            wanted -= set(self.prefetched.keys())
+
+            if not wanted:
+                return
+            self.prefetch_pending = wanted
+            self.prefetch_thread = threading.Thread(target=self.do_prefetch, args=(wanted,), daemon=True)
+            self.prefetch_thread.start()
+
+    def do_prefetch(self, wanted):
+        files = {}
+        for comp, name in wanted:
+            file = self.files[comp][name]
+            if not file in files:
+                files[file] = []
+            files[file] += [(comp, name)]
+
+        for file, entries in files.items():
+            try:
+                state_dicts = {}
+                for comp, name in entries:
+                    if self.is_shared(comp):
+                        state_dicts.update(self.get_shared_file(file, comp))
+                    elif not comp in state_dicts:
+                        state_dicts.update(self.load_file(file, comp))
+                    if not comp in state_dicts:
+                        continue
+
+                    state_dict = state_dicts[comp]
+                    utils.cast_state_dict(state_dict, self.get_dtype(comp), "cpu", move=True)
+                    if self.get_usage("ram") + self.get_state_dict_size(state_dict) > self.ram_budget:
+                        # it would push out the models already cached, the request can read it itself
+                        print(f"PREFETCH SKIPPED {file.rsplit(os.path.sep, 1)[-1]}: over the RAM budget")
+                        continue
+                    for k in state_dict:
+                        if type(state_dict[k]) != torch.Tensor:
+                            continue
+                        if self.pin_prefetch:
+                            state_dict[k] = state_dict[k].pin_memory()
+                        else:
+                            utils.touch_tensor(state_dict[k])
+
+                    with self.prefetch_lock:
+                        self.prefetched[(comp, name)] = state_dict
+            except Exception as e:
+                print(f"PREFETCH FAILED {file.rsplit(os.path.sep, 1)[-1]}: {e}")
+
+    def get_prefetched(self, comp, name):
+        if not comp in shared.COMPONENTS:
+            return None
+        thread = self.prefetch_thread
+        if thread and (comp, name) in self.prefetch_pending:
+            thread.join()
+        with self.prefetch_lock:
+            state_dict = self.prefetched.pop((comp, name), None)
+        if state_dict == None:
+            self.prefetch_stats["misses"] += 1
+            return None
+        self.prefetch_stats["hits"] += 1
+        return {comp: state_dict}
+
+    def get_file(self, file, comp):
+        if self.is_shared(comp):
+            return self.get_shared_file(file, comp)
         if not file in self.file_cache:
             self.file_cache[file] = self.load_file(file, comp)
-        return self.file_cache[file][comp]
+        return self.file_cache[file]
+
+    def get_shared_file(self, file, comp):
+        # mapped fresh each time, from_model consumes the state dict it is given
+        state_dict = self.shared.get(file, comp, self.get_dtype(comp))
+        if state_dict != None:
+            return {comp: state_dict}
+
+        # convert once, stored already cast so every process with the same precision maps the same pages
+        state_dicts = self.load_file(file, comp)
+        for c in state_dicts:
+            utils.cast_state_dict(state_dicts[c], self.get_dtype(c))
+            if self.shared.put(file, c, self.get_dtype(c), state_dicts[c]):
+                state_dicts[c] = self.shared.find(file, c, self.get_dtype(c))
+
+        stats = self.shared.get_stats()
+        print(f"SHARED STORE: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, {stats['size']/1024**3:.1f}GB used")
+        return state_dicts
+
+    def get_state_dict(self, file, comp):
+        return self.get_file(file, comp)[comp]
     
     def get_filename(self, name, comp):
-        if not name in self.files[comp]:
+        if not self.is_known(name, comp):
             raise ValueError(f"unknown {comp}: {name}")
         return self.files[comp][name]
 
@@ -440,10 +802,23 @@ class ModelStorage():
     def get_upscaler(self, name, device):
         return self.get_component(name, "SR", device)
 
+    def get_embedding(self, activation, device):
+        file = self.embeddings[activation]
+        stamp = self.index.get_stamp(file)
+        if not file in self.embedding_vectors or self.embedding_vectors[file][0] != stamp:
+            vectors = self.get_ti_vectors(self.load_file(file, "TI")["TI"], file)
+            vectors.requires_grad = False
+            self.embedding_vectors[file] = (stamp, vectors)
+        stamp, vectors = self.embedding_vectors[file]
+        if vectors.device != device:
+            vectors = vectors.to(device)
+            self.embedding_vectors[file] = (stamp, vectors)
+        return vectors
+
     def get_embeddings(self, device):
-        for k in self.embeddings:
-            self.embeddings[k] = self.embeddings[k].to(device)
-        return self.embeddings
+        # loaders by activation, so only the TIs a prompt mentions are read
+        device = torch.device(device)
+        return {k: functools.partial(self.get_embedding, k, device) for k in self.embeddings}
 
     def get_lora(self, name, device):
         for lora in self.files["LoRA"]:
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Tests for merging queued txt2img requests into one batch
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import torch
+
+import batching
+import server
+import utils
+import wrapper
+
+def make_request(seed, batch_size, prompt="a photo of a cat"):
+    return {"type": "txt2img", "data": {"model": "SD/model.safetensors", "prompt": [[[prompt], [""]]] * batch_size, "seed": seed, "batch_size": batch_size, "steps": 20}}
+
+def get_noise(seeds, subseeds):
+    noise = utils.NoiseSchedule(seeds, subseeds, 8, 8, torch.device("cpu"), torch.float32)
+    return torch.stack([noise[i] for i in range(3)])
+
+def expand_seeds(data):
+    """Seeds and subseeds as GenerationParameters would expand them for this data"""
+    params = wrapper.GenerationParameters(None, torch.device("cpu"))
+    params.set(**data)
+    return params.get_seeds(params.get_batch_size())
+
+def test_merged_seeds_match_separate():
+    """Each request keeps the seeds it would have been given on its own"""
+    requests = [make_request(5, 2), make_request([7], 1), make_request([11, 3], 3)]
+    data, groups = batching.merge_requests([(None, i, r) for i, r in enumerate(requests)])
+
+    merged, _ = expand_seeds(data)
+    start = 0
+    for (id, size), request in zip(groups, requests):
+        separate, _ = expand_seeds(request["data"])
+        assert merged[start:start + size] == separate
+        start += size
+    assert start == len(merged) == data["batch_size"]
+
+def test_random_seeds_resolved_before_merging():
+    """A -1 seed is picked once, the merged batch doesnt pick it again"""
+    data, _ = batching.merge_requests([(None, 0, make_request(-1, 2)), (None, 1, make_request(3, 1))])
+    assert not -1 in data["seed"]
+    assert data["seed"][2] == 3
+
+def test_merged_noise_is_bit_identical():
+    """The noise of every image in a merged batch is exactly the noise it gets alone"""
+    requests = [make_request(5, 2), make_request([7], 1), make_request(123456, 2)]
+    data, groups = batching.merge_requests([(None, i, r) for i, r in enumerate(requests)])
+    merged = get_noise(*expand_seeds(data))
+
+    start = 0
+    for (id, size), request in zip(groups, requests):
+        separate = get_noise(*expand_seeds(request["data"]))
+        assert torch.equal(merged[:, start:start + size], separate)
+        start += size
+
+def test_batch_key():
+    """Only requests differing in prompt, seed and batch size share a key"""
+    key = batching.get_batch_key(make_request(1, 1))
+    assert key != None
+    assert batching.get_batch_key(make_request(2, 2, "a photo of a dog")) == key
+
+    other = make_request(1, 1)
+    other["data"]["steps"] = 30
+    assert batching.get_batch_key(other) != key
+
+    other = make_request(1, 1)
+    other["data"]["subseed"] = 5
+    assert batching.get_batch_key(other) == None
+
+class RecordingStorage():
+    def prefetch(self, models, keep):
+        pass
+
+class RecordingWrapper():
+    def __init__(self):
+        self.storage = RecordingStorage()
+        self.callback = None
+        self.calls = []
+
+    def reset(self):
+        pass
+
+    def set_request(self, request_id):
+        pass
+
+    def set(self, **kwargs):
+        self.calls += [kwargs]
+
+    def txt2img(self):
+        pass
+
+    def get_device_name(self):
+        return "recording"
+
+def test_batch_groups_stripped_from_requests():
+    """Clients cant route results elsewhere by setting batch_groups themselves"""
+    recording = RecordingWrapper()
+    inference = server.Inference(recording, False, False, lambda id, response: True)
+    inference.start()
+
+    request = make_request(1, 1)
+    request["data"]["batch_groups"] = [(12345, 1)]
+    inference.requests.put((0, 1, request))
+    inference.requests.join()
+    inference.stop()
+    inference.join()
+
+    assert recording.calls and not "batch_groups" in recording.calls[0]
+
+def test_malformed_requests_never_merged():
+    """A bad field in one request cant fail the requests it would have been merged with"""
+    bad = make_request("abc", 1)
+    assert batching.get_batch_key(bad) == None
+    bad = make_request(1, 1)
+    bad["data"]["batch_size"] = "two"
+    assert batching.get_batch_key(bad) == None
+
+    recording = RecordingWrapper()
+    responses = []
+    inference = server.Inference(recording, False, False, lambda id, response: responses.append(id) or True, max_batch=4)
+    inference.requests.put((0, 1, make_request(1, 1)))
+    inference.requests.put((1, 2, make_request("abc", 1)))
+    inference.requests.put((2, 3, make_request(2, 1)))
+    inference.start()
+    inference.requests.join()
+    inference.stop()
+    inference.join()
+
+    merged = [c for c in recording.calls if "batch_groups" in c]
+    assert len(merged) == 1 and [id for id, _ in merged[0]["batch_groups"]] == [1, 3]
+    assert recording.calls[-1]["seed"] == "abc"
+    assert responses == []
+
+def test_take_keeps_requests_when_accept_fails():
+    """An error while looking at a request leaves it queued"""
+    requests = server.RequestQueue()
+    for i in range(3):
+        requests.put((i, i, make_request(i, 1)))
+    def accept(item):
+        if item[1] == 1:
+            raise ValueError("malformed")
+        return True
+    taken = requests.take(accept, lambda: False)
+    assert [item[1] for item in taken] == [0, 2]
+    assert requests.get()[1] == 1
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Tests for composing classifier-free guidance
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+import torch
+
+import guidance
+
+SHAPE = (4, 8, 8)
+
+def make_denoiser(compositions, scale=7.0, cfg_pp=False, cfg_rescale=0.0, dtype=torch.float32):
+    denoiser = guidance.GuidedDenoiser.__new__(guidance.GuidedDenoiser)
+    denoiser.device, denoiser.dtype = torch.device("cpu"), dtype
+    denoiser.scale, denoiser.cfg_pp, denoiser.cfg_rescale = scale, cfg_pp, cfg_rescale
+    denoiser.cut = False
+    denoiser.compositions = compositions
+    denoiser.compile_compositions()
+    return denoiser
+
+def make_compositions(counts, dtype=torch.float32):
+    """Random area masks and prompt weights, counts is a (positive, negative) pair per batch item"""
+    generator = torch.Generator().manual_seed(0)
+    compositions = []
+    for pos_len, neg_len in counts:
+        masks = torch.rand((pos_len, 1, *SHAPE[1:]), generator=generator).to(dtype)
+        pos_weights = torch.rand((pos_len, 1, 1, 1), generator=generator).to(dtype)
+        neg_weights = (torch.rand((neg_len, 1, 1, 1), generator=generator) + 0.5).to(dtype)
+        compositions += [((masks, pos_weights), neg_weights)]
+    return compositions
+
+def make_prediction(compositions, dtype=torch.float32):
+    rows = sum([len(p) + len(n) for (_, p), n in compositions])
+    return torch.randn((rows, *SHAPE), generator=torch.Generator().manual_seed(1)).to(dtype)
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("cfg_pp", [False, True])
+@pytest.mark.parametrize("cfg_rescale", [0.0, 0.7])
+@pytest.mark.parametrize("batch", [1, 3])
+def test_stacked_matches_each(dtype, cfg_pp, cfg_rescale, batch):
+    """Composing the whole batch at once gives exactly what composing each item does"""
+    compositions = make_compositions([(3, 2)] * batch, dtype)
+    denoiser = make_denoiser(compositions, cfg_pp=cfg_pp, cfg_rescale=cfg_rescale, dtype=dtype)
+    pred = make_prediction(compositions, dtype)
+
+    each = denoiser.compose_each_prediction(pred)
+    each_uncond = denoiser.uncond_pred if cfg_pp else None
+
+    denoiser.stacked = denoiser.stack_compositions()
+    assert denoiser.stacked != None
+    stacked = denoiser.compose_predictions(pred)
+
+    assert torch.equal(each, stacked)
+    if cfg_pp:
+        assert torch.equal(each_uncond, denoiser.uncond_pred)
+
+def test_cpu_uses_each():
+    """On the CPU the per item loop is kept, and is what compose_predictions runs"""
+    compositions = make_compositions([(2, 1)] * 2)
+    denoiser = make_denoiser(compositions)
+    assert denoiser.stacked == None and denoiser.segments == None
+
+    pred = make_prediction(compositions)
+    assert torch.equal(denoiser.compose_predictions(pred), denoiser.compose_each_prediction(pred))
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("cfg_pp", [False, True])
+@pytest.mark.parametrize("cfg_rescale", [0.0, 0.7])
+def test_ragged_compositions(dtype, cfg_pp, cfg_rescale):
+    """Batch items with a different number of prompts or mask shapes are summed by row index instead"""
+    compositions = make_compositions([(2, 1), (3, 1), (1, 2)], dtype)
+    # an item without areas has a single value mask per prompt
+    (masks, pos_weights), neg_weights = compositions[1]
+    compositions[1] = ((masks[:, :, :1, :1].contiguous(), pos_weights), neg_weights)
+
+    denoiser = make_denoiser(compositions, cfg_pp=cfg_pp, cfg_rescale=cfg_rescale, dtype=dtype)
+    assert denoiser.stack_compositions() == None
+    pred = make_prediction(compositions, dtype)
+
+    each = denoiser.compose_each_prediction(pred)
+    each_uncond = denoiser.uncond_pred if cfg_pp else None
+
+    denoiser.segments = denoiser.segment_compositions()
+    assert denoiser.segments != None
+    segmented = denoiser.compose_predictions(pred)
+
+    # sums happen in a different order, only the rounding differs
+    tolerance = 1e-5 if dtype == torch.float32 else 5e-2
+    assert segmented.shape == (3, *SHAPE)
+    assert torch.allclose(each.float(), segmented.float(), rtol=tolerance, atol=tolerance)
+    if cfg_pp:
+        assert torch.allclose(each_uncond.float(), denoiser.uncond_pred.float(), rtol=tolerance, atol=tolerance)
+
+def test_model_inputs_expand_each_item():
+    """Every batch item is repeated once for each of its prompts, in order"""
+    compositions = make_compositions([(2, 1), (3, 2)])
+    denoiser = make_denoiser(compositions)
+    latents = torch.randn((2, *SHAPE))
+
+    inputs = denoiser.get_model_inputs(latents)
+    expected = torch.cat([latents[0:1]] * 3 + [latents[1:2]] * 5)
+    assert torch.equal(inputs, expected)
+    assert denoiser.positive_list == [0, 3]
+    assert denoiser.negative_rows.tolist() == [2, 6]
+
+def test_cutoff_uses_steps_run():
+    """The cutoff is a fraction of the steps the sampler runs, not of the whole schedule"""
+    denoiser = make_denoiser(make_compositions([(1, 1)]))
+    denoiser.cfg_cutoff, denoiser.similar = 0.5, False
+    denoiser.guidance = torch.zeros(SHAPE)
+
+    denoiser.set_steps(20)
+    denoiser.set_cutoff(5)
+    assert not denoiser.cut
+
+    # an img2img at 0.25 strength only runs a quarter of them
+    denoiser.set_steps(5)
+    denoiser.set_cutoff(3)
+    assert denoiser.cut
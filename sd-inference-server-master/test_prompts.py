@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Tests for parsing prompt schedules
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+import prompts
+
+PROMPTS = [
+    "a photo of a cat",
+    "[sunset:night sky:0.6], (detailed eyes:1.2), <lora:detail_tweaker:0.5>",
+    "a photo of a [cat|dog] sitting on a windowsill, [film grain::0.3]",
+    "[oil painting:photograph:12] of a lighthouse, <lora:painterly:[0.8:0.2:0.5]>",
+    "portrait of a knight, [gold|silver|bronze] trim, (intricate:[1.0:1.3:HR]), [mist:haze:0.4]",
+    "landscape, [spring|summer|autumn|winter], <lora:scenery:1,0.5,0.2:0.7>",
+    "[[a:b:0.2]:c:0.7], [d:[e|f]:5], [g::1], [:h:0.99]",
+]
+
+@pytest.mark.parametrize("steps", [1, 2, 3, 7, 20, 37, 50, 151])
+@pytest.mark.parametrize("HR", [False, True])
+def test_schedules_match_every_step(steps, HR):
+    """Walking the tree only where schedules trigger gives what walking every step does"""
+    for prompt in PROMPTS:
+        tree = prompts.prompt_grammar.parse(prompt)
+        assert prompts.get_schedules(tree, steps, HR) == prompts.get_schedules(tree, steps, HR, every_step=True), prompt
+
+def test_cached_schedules_are_copies():
+    """Changing a parsed schedule doesnt change what the next request gets"""
+    first = prompts.parse_prompt(PROMPTS[1], 20)
+    first[0][1][0][0] = "changed"
+    assert prompts.parse_prompt(PROMPTS[1], 20)[0][1][0][0] != "changed"
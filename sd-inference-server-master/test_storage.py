@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for moving cached models between the device and RAM
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+import torch
+
+import storage
+
+class Model(torch.nn.Linear):
+    @property
+    def device(self):
+        return self.weight.device
+
+def make_storage(folder, ram_budget=storage.DEFAULT_RAM_BUDGET):
+    model_storage = storage.ModelStorage(str(folder), torch.float32, ram_budget=ram_budget)
+    model = Model(64, 64)
+    model_storage.add("UNET", "model", model)
+    return model_storage, model
+
+def test_pinned_kept_across_loads(tmp_path):
+    """Loading to the device keeps the pinned copy the model was unloaded into"""
+    model_storage, model = make_storage(tmp_path)
+    pinned = torch.empty(model.weight.shape)
+    model.weight.pinned = pinned
+
+    # no device here, the copy to it is all that changes
+    def load(model, device, dtype=None):
+        for t in model_storage.get_tensors(model):
+            t.data = t.data.clone()
+    model_storage.load = load
+
+    model = model_storage.move(model, "model", "UNET", "cuda")
+    assert model.weight.pinned is pinned
+
+def test_pinned_released_under_ram_budget(tmp_path):
+    """Pinned copies go before any model when RAM is short"""
+    model_storage, model = make_storage(tmp_path, ram_budget=1)
+    model = model_storage.move(model, "model", "UNET", "meta")
+    model.weight.pinned = torch.empty(model.weight.shape)
+
+    model_storage.enforce_budget()
+    assert not hasattr(model.weight, "pinned")
+    assert "model" in model_storage.loaded["UNET"]
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a CUDA device")
+def test_unload_reuses_pinned(tmp_path):
+    """An unload, load, unload cycle copies back into the same pinned buffer"""
+    model_storage, model = make_storage(tmp_path)
+    model = model_storage.move(model, "model", "UNET", "cuda")
+    model = model_storage.move(model, "model", "UNET", "cpu")
+    pinned = model.weight.pinned
+    assert pinned.is_pinned()
+
+    model = model_storage.move(model, "model", "UNET", "cuda")
+    assert model.weight.pinned is pinned
+    model = model_storage.move(model, "model", "UNET", "cpu")
+    assert model.weight.pinned is pinned
+    assert model.weight.data.data_ptr() == pinned.data_ptr()
+
+def test_prefetched_counted_in_ram(tmp_path):
+    """Prefetched checkpoints count against the RAM budget and are dropped before any model"""
+    model_storage, model = make_storage(tmp_path)
+    state_dict = {"weight": torch.empty((256, 256))}
+    model_storage.prefetched[("UNET", "next")] = state_dict
+    assert model_storage.get_usage("ram") == model_storage.get_size(model) + state_dict["weight"].nbytes
+
+    model_storage.ram_budget = model_storage.get_size(model)
+    model_storage.enforce_budget()
+    assert model_storage.prefetched == {}
+    assert "model" in model_storage.loaded["UNET"]
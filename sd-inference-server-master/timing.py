@@ -0,0 +1,166 @@
+import time
+import threading
+import collections
+import contextlib
+import torch
+
+# seconds, the last bucket catches everything longer
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf")]
+WINDOW = 1024
+
+LOCAL = threading.local()
+
+class Timer():
+    # marks on the device timeline. cuda events are only read once the request is done, so nothing waits on them
+    def __init__(self, device):
+        self.device = torch.device(device) if device != None else None
+        self.cuda = self.device != None and self.device.type == "cuda"
+
+    def mark(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record(torch.cuda.current_stream(self.device))
+            return event
+        return time.perf_counter()
+
+    def elapsed(self, start, end):
+        if self.cuda:
+            end.synchronize()
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+class Profile():
+    # where the time of one request goes. stages are wall time between status changes,
+    # each step is split into the unet, the guidance around it and the sampler on the device timeline
+    def __init__(self):
+        self.stages = {}
+        self.stage = None
+        self.stage_start = None
+        self.timer = None
+        self.steps = []
+        self.step = None
+        self.totals = [0, 0, 0, 0, 0]
+        self.finished = False
+
+    def set_stage(self, stage):
+        now = time.perf_counter()
+        if self.stage != None:
+            self.stages[self.stage] = self.stages.get(self.stage, 0) + now - self.stage_start
+        self.stage, self.stage_start = stage, now
+
+    def begin_step(self, device):
+        if self.timer == None:
+            self.timer = Timer(device)
+        self.end_step()
+        self.step = [self.timer.mark(), None, [], []]
+
+    def end_step(self):
+        if self.step != None:
+            self.step[1] = self.timer.mark()
+            self.steps += [self.step]
+            self.step = None
+
+    @contextlib.contextmanager
+    def span(self, kind):
+        if self.step == None:
+            yield
+            return
+        start = self.timer.mark()
+        yield
+        self.step[2 if kind == "unet" else 3] += [(start, self.timer.mark())]
+
+    def get_steps(self):
+        self.end_step()
+        steps = []
+        for start, end, unet, guidance in self.steps:
+            total = self.timer.elapsed(start, end)
+            unet = sum([self.timer.elapsed(s, e) for s, e in unet])
+            guidance = sum([self.timer.elapsed(s, e) for s, e in guidance]) - unet
+            steps += [(total, unet, guidance, total - unet - guidance)]
+        self.steps = []
+        return steps
+
+    def summarize(self):
+        # compact enough to go into every result, also feeds the histograms
+        if self.stage != None:
+            self.set_stage(self.stage)
+        for step in self.get_steps():
+            for name, seconds in zip(["step", "unet", "guidance", "sampler"], step):
+                METRICS.observe(name, seconds)
+            self.totals = [t + s for t, s in zip(self.totals, (1,) + step)]
+
+        summary = {"stages": {k: round(v, 4) for k, v in self.stages.items()}}
+        count, total, unet, guidance, sampler = self.totals
+        if count:
+            summary.update({"steps": count, "step": round(total / count, 4), "unet": round(unet, 4), "guidance": round(guidance, 4), "sampler": round(sampler, 4)})
+        return summary
+
+    def finish(self, outcome="success"):
+        if self.finished:
+            return
+        self.finished = True
+        self.summarize()
+        for stage, seconds in self.stages.items():
+            METRICS.observe(stage, seconds)
+        # failed requests are kept apart, they would skew how long a generation takes
+        METRICS.observe("request" if outcome == "success" else f"request_{outcome}", sum(self.stages.values()))
+
+class Metrics():
+    # rolling windows of recent timings for percentiles, and running bucket counts since the start
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.samples = {}
+        self.buckets = {}
+        self.sums = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if not name in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.window)
+                self.buckets[name] = [0] * len(BUCKETS)
+                self.sums[name] = 0
+                self.counts[name] = 0
+            self.samples[name].append(seconds)
+            self.sums[name] += seconds
+            self.counts[name] += 1
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    self.buckets[name][i] += 1
+                    break
+
+    def get_stats(self):
+        with self.lock:
+            stats = {}
+            for name, samples in self.samples.items():
+                ordered = sorted(samples)
+                def percentile(p):
+                    return ordered[min(len(ordered)-1, int(len(ordered)*p))]
+                stats[name] = {
+                    "count": self.counts[name], "sum": self.sums[name], "buckets": {("+Inf" if b == float("inf") else str(b)): c for b, c in zip(BUCKETS, self.buckets[name])},
+                    "window": len(ordered), "mean": sum(ordered) / len(ordered),
+                    "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99), "max": ordered[-1]
+                }
+            return stats
+
+METRICS = Metrics()
+
+def begin():
+    LOCAL.profile = Profile()
+    return LOCAL.profile
+
+def current():
+    return getattr(LOCAL, "profile", None)
+
+def end(outcome="success"):
+    profile = current()
+    if profile != None:
+        profile.finish(outcome)
+    LOCAL.profile = None
+
+def span(kind):
+    profile = current()
+    if profile == None:
+        return contextlib.nullcontext()
+    return profile.span(kind)
@@ -11,6 +11,8 @@ import os
 import time
 import pickle
 import re
+import json
+import mmap
 import math
 
 import numpy as np
@@ -248,13 +250,54 @@ def apply_extents(inputs, extents):
         outputs[i] = inputs[i].crop(extent)
     return outputs
 
-def cast_state_dict(state_dict, dtype, device='cpu'):
+def cast_state_dict(state_dict, dtype, device='cpu', move=False):
+    # move also brings tensors already in the right dtype to the device, otherwise only cast ones are placed there
     for k in state_dict:
-        if type(state_dict[k]) == torch.Tensor and state_dict[k].dtype != dtype and state_dict[k].dtype in {torch.float16, torch.float32, torch.bfloat16}:
-            tmp = state_dict[k].clone().detach()
-            state_dict[k] = tmp.to(device, dtype=dtype)
+        if type(state_dict[k]) != torch.Tensor:
+            continue
+        if state_dict[k].dtype != dtype and state_dict[k].dtype in {torch.float16, torch.float32, torch.float64, torch.bfloat16}:
+            state_dict[k] = state_dict[k].to(device, dtype=dtype)
+        elif move:
+            state_dict[k] = state_dict[k].to(device)
     return state_dict
 
+def touch_tensor(tensor):
+    # reads a mapped tensor in from disk without copying it, one byte per page is enough
+    if tensor.numel() == 0:
+        return
+    tensor.detach().reshape(-1).view(torch.uint8)[::4096].sum()
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool
+}
+
+def map_safetensors(file):
+    # tensors of a safetensors file as copy-on-write views into the file, nothing is read until used.
+    # the pages are shared with every other process mapping the same file, until something writes to them.
+    # each tensor gets its own mapping, one for the whole file can exceed what the OS allows to commit
+    tensors = {}
+    with open(file, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+        metadata = header.pop("__metadata__", None) or {}
+
+        offset = 8 + header_size
+        for k, info in header.items():
+            dtype = SAFETENSORS_DTYPES[info["dtype"]]
+            start, end = info["data_offsets"]
+            start, end = offset + start, offset + end
+            if start == end:
+                tensors[k] = torch.empty(info["shape"], dtype=dtype)
+                continue
+            page = start - start % mmap.ALLOCATIONGRANULARITY
+            buffer = mmap.mmap(f.fileno(), end - page, access=mmap.ACCESS_COPY, offset=page)
+            t = torch.frombuffer(buffer, dtype=torch.uint8, offset=start - page, count=end - start)
+            if start % torch.empty(0, dtype=dtype).element_size() != 0:
+                t = t.clone()
+            tensors[k] = t.view(dtype).reshape(info["shape"])
+    return tensors, metadata
+
 class NoiseSchedule():
     def __init__(self, seeds, subseeds, width, height, device, dtype):
         self.seeds = seeds
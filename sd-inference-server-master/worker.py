@@ -0,0 +1,206 @@
+import multiprocessing
+import threading
+import time
+
+# GenerationParameters methods the server can call on a worker process
+METHODS = {"reset", "set", "txt2img", "img2img", "options", "upscale", "convert", "manage", "annotate",
+           "segmentation", "train_lora", "train_upload", "metadata", "cache_stats", "metrics", "set_request", "storage.clear_vram"}
+
+class WorkerError(Exception):
+    # an exception raised inside a worker process, keeps the message so Aborted/Read-only still match
+    def __init__(self, message, location="", trace=""):
+        super().__init__(message)
+        self.location = location
+        self.trace = trace
+
+def get_state(model_storage):
+    residency = {c: {m: str(model.device) for m, model in model_storage.loaded[c].items()} for c in model_storage.loaded}
+    return {"residency": residency, "prefetch": model_storage.prefetch_stats.copy()}
+
+def worker_main(calls, side, config):
+    import torch
+    import storage
+    import wrapper
+    import server
+    import encoder
+    import results
+    import prompts
+
+    encoder.configure(config["encoders"], config["png_compression"])
+    results.configure(config["results_budget"], config["results_ttl"], config["results_folder"], config["results_disk_budget"])
+    prompts.configure_cache(config["encoding_cache"])
+
+    model_storage = storage.ModelStorage(config["models"], torch.float16, torch.float32, config["ram_budget"], config["shared"], config["shared_size"], config["vram_budget"])
+    params = wrapper.GenerationParameters(model_storage, torch.device(config["device"]))
+    if config["pinned"]:
+        params.pin_device()
+    if config["public"]:
+        params.switch_public()
+    model_storage.pin_prefetch = config["pin_prefetch"]
+    if config["watch_models"]:
+        model_storage.watch_models()
+
+    lock = threading.Lock()
+    def callback(response, id=None):
+        with lock:
+            calls.send(("callback", response, id))
+            return calls.recv()
+    params.callback = callback
+
+    def serve_side():
+        # requests that must not wait behind the call currently running
+        while True:
+            try:
+                message = side.recv()
+            except EOFError:
+                return
+            if message[0] == "fetch":
+                side.send(params.fetch(message[1]))
+            elif message[0] == "prefetch":
+                model_storage.prefetch(*message[1:])
+            elif message[0] == "release":
+                model_storage.release(message[1])
+            elif message[0] == "stats":
+                side.send(params.get_stats())
+    threading.Thread(target=serve_side, daemon=True).start()
+
+    calls.send(("ready", {"device_name": params.get_device_name(), "path": model_storage.path}))
+
+    while True:
+        try:
+            message = calls.recv()
+        except EOFError:
+            break
+        if message == None:
+            break
+
+        name, args, kwargs = message
+        try:
+            target = params
+            for attr in name.split("."):
+                target = getattr(target, attr)
+            target(*args, **kwargs)
+            # results still being encoded call back over this pipe, which is only read while a call runs
+            params.encoder.flush()
+            reply = ("return", get_state(model_storage))
+        except Exception as e:
+            trace = ""
+            location = ""
+            if not str(e) in {"Aborted", "Read-only"}:
+                trace = server.log_traceback("WORKER")
+                location = server.get_location(e)
+            try:
+                params.encoder.flush()
+            except Exception:
+                pass
+            reply = ("raise", (str(e), location, trace), get_state(model_storage))
+
+        with lock:
+            calls.send(reply)
+
+class RemoteStorage():
+    # the parts of ModelStorage the server reads, mirrored from the worker process after every call
+    def __init__(self, remote, path):
+        self.remote = remote
+        self.path = path
+        self.residency = {}
+        self.prefetch_stats = {"hits": 0, "misses": 0}
+
+    def set_state(self, state):
+        self.residency = state["residency"]
+        self.prefetch_stats = state["prefetch"]
+
+    def get_residency(self, comp, name):
+        return self.residency.get(comp, {}).get(name, None)
+
+    def clear_vram(self):
+        self.remote.call("storage.clear_vram")
+
+    def prefetch(self, models, keep={}):
+        self.remote.send_side(("prefetch", models, keep))
+
+    def release(self, file):
+        self.remote.send_side(("release", file))
+
+class RemoteWrapper():
+    # runs a GenerationParameters in its own process over a pipe, the server drives it like a local one.
+    # callbacks are sent back while a call runs, their result tells the worker whether to abort
+    def __init__(self, device, models, ram_budget=0, vram_budget=0, shared=None, shared_size=0, pinned=False, public=False, pin_prefetch=False, encoders=4, png_compression=6,
+                 results_budget=0, results_ttl=0, results_folder=None, results_disk_budget=0, watch_models=False, encoding_cache=0):
+        config = {"device": str(device), "models": models, "ram_budget": ram_budget, "vram_budget": vram_budget, "shared": shared, "shared_size": shared_size,
+                  "pinned": pinned, "public": public, "pin_prefetch": pin_prefetch, "encoders": encoders, "png_compression": png_compression,
+                  "results_budget": results_budget, "results_ttl": results_ttl, "results_folder": results_folder, "results_disk_budget": results_disk_budget,
+                  "watch_models": watch_models, "encoding_cache": encoding_cache}
+
+        context = multiprocessing.get_context("spawn")
+        self.calls, worker_calls = context.Pipe()
+        self.side, worker_side = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(worker_calls, worker_side, config), daemon=True)
+        self.process.start()
+        worker_calls.close()
+        worker_side.close()
+
+        self.callback = None
+        # ids of delay_fetch results the worker holds, so fetches are routed to it. kept no longer than the worker keeps them
+        self.temporary = {}
+        self.results_ttl = results_ttl
+        self.lock = threading.Lock()
+        self.side_lock = threading.Lock()
+
+        _, info = self.calls.recv()
+        self.device_name = info["device_name"]
+        self.storage = RemoteStorage(self, info["path"])
+
+    def __getattr__(self, item):
+        if not item in METHODS:
+            raise AttributeError(item)
+        return lambda *args, **kwargs: self.call(item, *args, **kwargs)
+
+    def get_device_name(self):
+        return self.device_name
+
+    def call(self, name, *args, **kwargs):
+        with self.lock:
+            try:
+                self.calls.send((name, args, kwargs))
+                while True:
+                    message = self.calls.recv()
+                    if message[0] == "callback":
+                        _, response, id = message
+                        if response["type"] == "temporary":
+                            self.add_temporary(response["data"]["id"])
+                        alive = self.callback(response, id) if self.callback else True
+                        self.calls.send(alive)
+                        continue
+                    self.storage.set_state(message[-1])
+                    if message[0] == "raise":
+                        raise WorkerError(*message[1])
+                    return
+            except (EOFError, BrokenPipeError):
+                raise WorkerError("Worker process exited")
+
+    def send_side(self, message, reply=False):
+        with self.side_lock:
+            try:
+                self.side.send(message)
+                if reply:
+                    return self.side.recv()
+            except (EOFError, BrokenPipeError):
+                return None
+
+    def get_stats(self):
+        return self.send_side(("stats",), True)
+
+    def add_temporary(self, id):
+        # oldest first, so expiring stops at the first still within the ttl
+        now = time.monotonic()
+        for old in list(self.temporary):
+            if self.temporary.get(old, now) + self.results_ttl >= now:
+                break
+            self.temporary.pop(old, None)
+        self.temporary[id] = now
+
+    def fetch(self, id):
+        result = self.send_side(("fetch", id), True)
+        self.temporary.pop(id, None)
+        return result
@@ -3,12 +3,14 @@ import torchvision.transforms as transforms
 import PIL
 import PIL.Image
 import random
+import time
 import io
 import os
 import safetensors.torch
 import shutil
 import tomesd
 import contextlib
+import functools
 import numpy as np
 
 DIRECTML_AVAILABLE = False
@@ -38,6 +40,10 @@ import preview
 import segmentation
 import merge
 import models
+import encoder
+import results
+import timing
+import metrics
 
 DEFAULTS = {
     "strength": 0.75, "sampler": "Euler a", "clip_skip": 1, "eta": 1,
@@ -46,11 +52,11 @@ DEFAULTS = {
 }
 
 TYPES = {
-    int: ["width", "height", "steps", "seed", "batch_size", "clip_skip", "mask_blur", "hr_steps", "padding"],
-    float: ["scale", "eta", "hr_factor", "hr_eta", "hr_scale"],
+    int: ["width", "height", "steps", "seed", "batch_size", "clip_skip", "mask_blur", "hr_steps", "padding", "png_compression", "cache_interval"],
+    float: ["scale", "eta", "hr_factor", "hr_eta", "hr_scale", "cfg_cutoff", "cfg_similarity"],
 }
 
-STATIC = ["storage", "device", "device_names", "callback", "last_models_modified", "last_models_config", "dataset", "public", "temporary"]
+STATIC = ["storage", "device", "device_names", "callback", "last_models_modified", "last_models_config", "dataset", "public", "temporary", "worker_device", "encoder", "request_id"]
 
 SAMPLER_CLASSES = {
     "Euler": samplers_k.Euler,
@@ -131,6 +137,25 @@ def model_name(x):
 class AbortError(RuntimeError):
     pass
 
+def profiled(function):
+    # a generation is timed from start to however it ends, a failed one mustnt leave its profile for the next
+    @functools.wraps(function)
+    def run(self, *args, **kwargs):
+        self.profile = timing.begin()
+        outcome = "error"
+        try:
+            result = function(self, *args, **kwargs)
+            outcome = "success"
+            return result
+        except Exception as e:
+            if str(e) == "Aborted":
+                outcome = "aborted"
+            raise
+        finally:
+            timing.end(outcome)
+            self.profile = None
+    return run
+
 class GenerationParameters():
     def __init__(self, storage: storage.ModelStorage, device):
         self.storage = storage
@@ -142,9 +167,10 @@ class GenerationParameters():
         for i in range(torch.cuda.device_count()):
             original = torch.cuda.get_device_name(i)
             name = original
-            i = 2
+            n = 2
             while name in self.device_names:
-                name = original + f" ({i})"
+                name = original + f" ({n})"
+                n += 1
             self.device_names += [name]
         
         if DIRECTML_AVAILABLE:
@@ -156,12 +182,37 @@ class GenerationParameters():
         self.last_models_config = None
 
         self.callback = None
-        self.temporary = {}
+        self.temporary = results.get_store()
+
+        self.worker_device = None
+
+        self.encoder = encoder.get_pool()
+        self.request_id = None
 
     def switch_public(self):
         self.public = True
 
+    def pin_device(self):
+        # this wrapper is one worker of a device pool, requests are routed to it so ignore their device choice
+        self.worker_device = self.device
+
+    def set_request(self, request_id):
+        # responses delivered in the background are sent to the request that produced them, not whichever is current by then
+        self.request_id = request_id
+
+    def get_device_name(self):
+        device = self.worker_device or self.device
+        if device.type == "cpu":
+            return "CPU"
+        if device.type == "cuda":
+            idx = device.index or 0
+            if idx < torch.cuda.device_count():
+                return self.device_names[idx]
+        return None
+
     def set_status(self, status, reset=True):
+        if self.profile:
+            self.profile.set_stage(status)
         if self.callback:
             if not self.callback({"type": "status", "data": {"message": status, "reset": reset}}):
                 self.storage.do_gc()
@@ -174,6 +225,13 @@ class GenerationParameters():
                 raise AbortError("Aborted")
 
     def on_step(self, progress, latents=None):
+        if self.profile:
+            self.profile.end_step()
+
+        if self.progress_sent and self.progress_sent.done() and not self.progress_sent.result():
+            self.storage.do_gc()
+            raise AbortError("Aborted")
+
         step = self.current_step
         total = self.total_steps
         rate = progress["rate"]
@@ -184,6 +242,7 @@ class GenerationParameters():
         
         progress = {"current": step, "total": total, "rate": rate, "remaining": remaining, "unit": "it/s"}
         
+        groups = None
         interval = int(self.preview_interval or 0)
         if latents != None and self.show_preview and step % interval == 0:
             if self.show_preview == "Full":
@@ -192,13 +251,41 @@ class GenerationParameters():
                 images = preview.model_preview(latents, self.vae)
             else:
                 images = preview.cheap_preview(latents, self.vae)
-            for i in range(len(images)):
-                bytesio = io.BytesIO()
-                images[i].save(bytesio, format='JPEG', quality=80)
-                images[i] = bytesio.getvalue()
-            progress["previews"] = images
+            progress["previews"] = [self.encoder.encode(i, "JPEG", quality=80) for i in images]
+            if self.batch_groups:
+                groups = self.get_batch_groups(len(images))
+
+        # sent once the previews are encoded, an abort is noticed on the following step
+        self.progress_sent = self.encoder.deliver(self.send_progress, progress, groups, self.request_id)
+        if self.progress_sent.done() and not self.progress_sent.result():
+            self.storage.do_gc()
+            raise AbortError("Aborted")
 
-        self.set_progress(progress)
+    def send_progress(self, progress, groups, request_id):
+        if "previews" in progress:
+            progress["previews"] = [f.result() for f in progress["previews"]]
+        if not self.callback:
+            return True
+        if groups == None:
+            return self.callback({"type": "progress", "data": progress}, request_id)
+        alive = False
+        for id, start, end in groups:
+            data = progress.copy()
+            data["previews"] = progress["previews"][start:end]
+            if self.callback({"type": "progress", "data": data}, id):
+                alive = True
+        return alive
+
+    def get_batch_groups(self, count):
+        # requests merged by the batching scheduler each get their own slice of the outputs
+        if not self.batch_groups:
+            return [(self.request_id, 0, count)]
+        groups = []
+        start = 0
+        for id, size in self.batch_groups:
+            groups += [(id, start, start + size)]
+            start += size
+        return groups
 
     def on_download(self, progress):
         if not progress["rate"]:
@@ -290,39 +377,65 @@ class GenerationParameters():
         if self.callback:
             self.set_status("Fetching")
 
-            if self.delay_fetch:
-                id = random.randrange(2147483646)
-                self.temporary[id] = (images, metadata)
-                images_data = []
-                for i in images:
-                    bytesio = io.BytesIO()
-                    im = i.copy()
-                    im.thumbnail((256,256), PIL.Image.Resampling.LANCZOS)
-                    im.save(bytesio, format="JPEG")
-                    images_data += [bytesio.getvalue()]
-                self.callback({"type": "temporary", "data": {"id": id, "images": images_data, "metadata": metadata, "type": "JPEG"}})
-            else:
-                images_data = []
-                for i in images:
-                    bytesio = io.BytesIO()
-                    i.save(bytesio, format="PNG")
-                    images_data += [bytesio.getvalue()]
-                self.callback({"type": "result", "data": {"images": images_data, "metadata": metadata, "type": "PNG"}})
+            if self.profile:
+                profile = self.profile.summarize()
+                for m in metadata:
+                    m["timing"] = profile
+
+            for request_id, start, end in self.get_batch_groups(len(images)):
+                self.send_complete(images[start:end], metadata[start:end], request_id)
         self.storage.do_gc()
 
+    def send_complete(self, images, metadata, request_id):
+        # encoded and sent in the background, the next step or request doesnt wait on it
+        format = self.output_format or "PNG"
+        if not format in encoder.FORMATS:
+            raise ValueError(f"unknown image format: {format}")
+
+        if self.delay_fetch:
+            # stored before the thumbnails are sent, so its there for any fetch they prompt
+            id = random.randrange(2147483646)
+            images_data = [self.encoder.encode(i, format, self.png_compression) for i in images]
+            self.encoder.deliver(self.store_result, id, images_data, metadata, encoder.FORMATS[format], time.perf_counter())
+            images_data = [self.encoder.encode(i, "JPEG", size=(256,256)) for i in images]
+            self.encoder.deliver(self.send_result, {"type": "temporary", "data": {"id": id, "images": images_data, "metadata": metadata, "type": "JPEG"}}, request_id, time.perf_counter())
+        elif self.stream:
+            header = {"type": "result", "data": {"count": len(images), "metadata": metadata, "type": encoder.FORMATS[format], "stream": True}}
+            self.encoder.deliver(self.send_stream, header, images, format, self.png_compression, request_id, time.perf_counter())
+        else:
+            images_data = [self.encoder.encode(i, format, self.png_compression) for i in images]
+            self.encoder.deliver(self.send_result, {"type": "result", "data": {"images": images_data, "metadata": metadata, "type": encoder.FORMATS[format]}}, request_id, time.perf_counter())
+
+    def send_result(self, response, request_id, submitted):
+        # encoding is the wait from submitting until every image is done, sending is the callback itself
+        response["data"]["images"] = [f.result() for f in response["data"]["images"]]
+        encoded = time.perf_counter()
+        self.callback(response, request_id)
+        timing.METRICS.observe("encode", encoded - submitted)
+        timing.METRICS.observe("send", time.perf_counter() - encoded)
+
+    def store_result(self, id, images, metadata, type, submitted):
+        self.temporary.put(id, [f.result() for f in images], metadata, type)
+        timing.METRICS.observe("store", time.perf_counter() - submitted)
+
+    def send_stream(self, header, images, format, compression, request_id, submitted):
+        # a header then each image on its own, only a few encoded ahead of the one being sent
+        self.callback(header, request_id)
+        ahead = max(self.encoder.workers, 1)
+        encoding = [self.encoder.encode(i, format, compression) for i in images[:ahead]]
+        for index in range(len(images)):
+            if index + ahead < len(images):
+                encoding += [self.encoder.encode(images[index + ahead], format, compression)]
+            image, encoding[index] = encoding[index].result(), None
+            self.callback({"type": "result_image", "data": {"index": index, "image": image}}, request_id)
+        timing.METRICS.observe("stream", time.perf_counter() - submitted)
+
     def fetch(self, id):
-        if id in self.temporary:
-            images, metadata = self.temporary[id]
-            del self.temporary[id]
-
-            images_data = []
-            for i in images:
-                bytesio = io.BytesIO()
-                i.save(bytesio, format="PNG")
-                images_data += [bytesio.getvalue()]
-            
-            return {"type": "result", "data": {"images": images_data, "metadata": metadata, "type": "PNG"}}
-        return None
+        result = self.temporary.get(id)
+        if result == None:
+            return None
+        images_data, metadata, type = result
+        return {"type": "result", "data": {"images": images_data, "metadata": metadata, "type": type}}
 
     def reset(self):
         for attr in list(self.__dict__.keys()):
@@ -398,7 +511,7 @@ class GenerationParameters():
         if self.cn and all([type(cn) == str for cn in self.cn]):
             self.cn_names = [c for c in self.cn]
         
-        self.storage.enforce_controlnet_limit(self.cn_names or [])
+        self.storage.keep("CN", self.cn_names or [])
         if self.cn_names:
             self.set_status("Loading ControlNet")
             self.cn = [self.storage.get_controlnet(cn, self.device, self.on_download) for cn in self.cn_names]
@@ -465,7 +578,7 @@ class GenerationParameters():
             allowed += [o["model"] for o in self.seg_opts]
         if self.cn_annotator:
             allowed += self.cn_annotator
-        self.storage.clear_annotators(allowed)
+        self.storage.keep("AN", allowed)
 
     def check_parameters(self):
         for attr, value in DEFAULTS.items():
@@ -474,8 +587,11 @@ class GenerationParameters():
 
         for t in TYPES:
             for attr in TYPES[t]:
-                if getattr(self, attr) != None:
-                    setattr(self, attr, t(getattr(self, attr)))
+                value = getattr(self, attr)
+                if type(value) == list:
+                    setattr(self, attr, [t(v) for v in value])
+                elif value != None:
+                    setattr(self, attr, t(value))
 
         if not self.sampler in SAMPLER_CLASSES:
             raise ValueError(f"unknown sampler: {self.sampler}")
@@ -483,6 +599,15 @@ class GenerationParameters():
         if (self.width or self.height) and not (self.width and self.height):
             raise ValueError("width and height must both be set")
         
+        if self.cfg_cutoff != None and not 0 <= self.cfg_cutoff <= 1:
+            raise ValueError("cfg_cutoff must be between 0 and 1")
+
+        if self.cfg_similarity != None and not -1 <= self.cfg_similarity <= 1:
+            raise ValueError("cfg_similarity must be between -1 and 1")
+
+        if self.cache_interval != None and self.cache_interval < 1:
+            raise ValueError("cache_interval must be at least 1")
+
         if self.vram_mode == "Minimal" and self.show_preview == "Full":
             raise ValueError("Full preview is incompatible with minimal VRAM")
         
@@ -498,15 +623,15 @@ class GenerationParameters():
         if self.hr_prediction_type:
             self.hr_prediction_type = self.hr_prediction_type.lower()
 
-        if self.hr_factor and self.hr_unet:
-            self.storage.set_ram_limit(2)
-        else:
-            self.storage.set_ram_limit(1)
+        self.storage.begin_request()
 
     def set_device(self):
         device = torch.device("cuda")
 
-        if self.public:
+        if self.worker_device:
+            # workers in a device pool stay on their own device, device_name was only a routing hint
+            self.device_name = self.get_device_name()
+        elif self.public:
             self.device = device
             return
 
@@ -528,7 +653,7 @@ class GenerationParameters():
             self.precision = forced
             self.vae_precision = forced
 
-        self.device = device
+        self.device = self.worker_device or device
     
     def set_attention(self):       
         if self.attention and self.attention in CROSS_ATTENTION:
@@ -652,6 +777,12 @@ class GenerationParameters():
                 m["clip_skip"] = self.clip_skip
                 if self.cfg_rescale:
                     m["cfg_rescale"] = format_float(self.cfg_rescale)
+                if self.cfg_cutoff:
+                    m["cfg_cutoff"] = format_float(self.cfg_cutoff)
+                if self.cfg_similarity:
+                    m["cfg_similarity"] = format_float(self.cfg_similarity)
+                if self.cache_interval and self.cache_interval > 1:
+                    m["cache_interval"] = self.cache_interval
                 if self.prediction_type:
                     m["prediction_type"] = self.prediction_type.capitalize()
 
@@ -745,7 +876,7 @@ class GenerationParameters():
 
         if lora_names:
             self.set_status("Loading LoRAs")
-            self.storage.enforce_network_limit(keep_models, "LoRA")
+            self.storage.keep("LoRA", keep_models)
             self.loras = [self.storage.get_lora(name, device) for name in lora_names]
 
             # Build networks first (let them grab the original forward)
@@ -766,7 +897,7 @@ class GenerationParameters():
                 if is_static:
                     lora.to("cpu", torch.float16)
         else:
-            self.storage.enforce_network_limit(keep_models, "LoRA")
+            self.storage.keep("LoRA", keep_models)
 
     def detach_networks(self):
         self.unet.additional.clear()
@@ -797,6 +928,7 @@ class GenerationParameters():
         return outputs
 
     @torch.inference_mode()
+    @profiled
     def txt2img(self):
         self.set_status("Configuring")
         self.check_parameters()
@@ -868,7 +1000,7 @@ class GenerationParameters():
         conditioning.encode(self.clip, area)
 
         self.set_status("Preparing")
-        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type, self.cfg_cutoff, self.cfg_similarity, self.cache_interval)
         noise = utils.NoiseSchedule(seeds, subseeds, self.width // 8, self.height // 8, device, self.unet.dtype)
         sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
@@ -1039,7 +1171,7 @@ class GenerationParameters():
         self.need_models(unet=True, vae=True, clip=True)
         conditioning.encode(self.clip, [])
         
-        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type, self.cfg_cutoff, self.cfg_similarity, self.cache_interval)
         noise = utils.NoiseSchedule(seeds, subseeds, width // 8, height // 8, device, self.unet.dtype)
         sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
@@ -1083,6 +1215,7 @@ class GenerationParameters():
         return images
 
     @torch.inference_mode()
+    @profiled
     def img2img(self):
         if self.tile_size:
             return self.tiled_img2img()
@@ -1173,7 +1306,7 @@ class GenerationParameters():
         self.need_models(unet=False, vae=False, clip=True)
         conditioning.encode(self.clip, self.area)
 
-        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type, self.cfg_cutoff, self.cfg_similarity, self.cache_interval)
         noise = utils.NoiseSchedule(seeds, subseeds, width // 8, height // 8, device, self.unet.dtype)
         sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
@@ -1281,7 +1414,7 @@ class GenerationParameters():
         self.need_models(unet=False, vae=False, clip=True)
         conditioning.encode(self.clip, [])
 
-        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type, self.cfg_cutoff, self.cfg_similarity, self.cache_interval)
         sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
         self.set_status("Upscaling")
@@ -1330,6 +1463,7 @@ class GenerationParameters():
         return images
     
     @torch.inference_mode()
+    @profiled
     def upscale(self):
         self.set_status("Loading")
         self.set_device()
@@ -1440,6 +1574,10 @@ class GenerationParameters():
         self.set_status("Configuring")
         self.check_parameters()
 
+        for file in [self.file, self.old_file]:
+            if file:
+                self.storage.release(os.path.join(self.storage.path, file))
+
         if self.operation == "build":
             self.build(self.file)
         elif self.operation == "build_lora":
@@ -1533,9 +1671,13 @@ class GenerationParameters():
             self.set_status("Converting")
             
             state_dict, metadata = convert.convert(old_file)
-            state_dict = convert.revert(metadata["model_type"], state_dict)
-            
-            safetensors.torch.save_file(state_dict, new_file, metadata)
+            state_dict = convert.revert(metadata["model_type"], convert.cast_fp16(state_dict))
+
+            # the state dict maps old_file, which may be the file being written
+            safetensors.torch.save_file(state_dict, new_file + ".tmp", metadata)
+            del state_dict
+            self.storage.do_gc()
+            os.replace(new_file + ".tmp", new_file)
 
             if new_file != old_file:
                 self.trash_model(old_file, delete=True)
@@ -1644,7 +1786,9 @@ class GenerationParameters():
             else:
                 file = os.path.join(self.storage.get_folder("SD"), file)
 
-        safetensors.torch.save_file(state_dict, file, metadata)
+        # the loaded models may map the file being written
+        safetensors.torch.save_file(state_dict, file + ".tmp", metadata)
+        os.replace(file + ".tmp", file)
 
     def build_lora(self, file):
         file_type = file.rsplit(".",1)[-1]
@@ -1740,6 +1884,22 @@ class GenerationParameters():
         if not self.callback({"type": "training_upload", "data": {"index": self.index}}):
             raise AbortError("Aborted")
         
+    def metrics(self):
+        if self.callback:
+            if not self.callback({"type": "metrics", "data": timing.METRICS.get_stats()}):
+                raise AbortError("Aborted")
+
+    def cache_stats(self):
+        if self.callback:
+            stats = {**self.storage.get_cache_stats(), "results": self.temporary.get_stats(), "encodings": prompts.ENCODING_CACHE.get_stats()}
+            if not self.callback({"type": "cache_stats", "data": stats}):
+                raise AbortError("Aborted")
+
+    def get_stats(self):
+        # read by the metrics endpoint from its own thread, so never goes through the callback
+        return {"pid": os.getpid(), "storage": self.storage.get_cache_stats(), "results": self.temporary.get_stats(), "encodings": prompts.ENCODING_CACHE.get_stats(),
+                "timing": timing.METRICS.get_stats(), "memory": metrics.get_memory(self.worker_device or self.device)}
+
     def metadata(self):
         self.set_status("Inspecting")
 